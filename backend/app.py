@@ -1,15 +1,41 @@
 import os 
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
+
+# before the app modules, which read their settings from the environment when imported
+load_dotenv('../.env')
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from db.transport import shared_transport
+from jobs.queue import job_queue
 from routes.router import api_router
+from telemetry.readiness import readiness
+from telemetry.tracing import TracingMiddleware, setup_tracing, shutdown_tracing
 
-load_dotenv('../.env')
 PORT = int(os.getenv("BACKEND_PORT", 8000))
 
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled connection to Supabase per worker, shared by every Database
+    shared_transport.open()
+    setup_tracing()
+    await job_queue.start()
+    # clients and SDKs are created in the background, the worker serves requests meanwhile (see /api/ready)
+    readiness.start()
+    yield
+    await readiness.stop()
+    # let the queued summaries and reports finish before closing their connections
+    await job_queue.stop()
+    await shared_transport.aclose()
+    shutdown_tracing()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(api_router, prefix="/api")
 
 # Middleware for CORS - This allows the frontend to communicate with the backend
@@ -20,6 +46,8 @@ app.add_middleware(
     allow_methods=["*"],  # Allow all methods
     allow_headers=["*"],  # Allow all headers
 )
+# outermost, so a request's span covers the whole stack
+app.add_middleware(TracingMiddleware)
 
 # Entry point for local dev
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+# Scripted patients replayed by the benchmark: their past symptom entries,
+# the messages they send in the symptom chat and the reason for their visit.
+CONVERSATIONS = [
+    {
+        "history": [
+            ("Tension Headache", "• Reports dull bilateral headache for two days.\n• Rates severity 4/10.\n• Relieved by rest."),
+            ("Seasonal Allergies", "• Reports sneezing and itchy eyes.\n• Symptoms worse outdoors."),
+            ("Recurring Headache", "• Reports headache behind the eyes most mornings.\n• Rates severity 6/10.\n• Ibuprofen helps partially."),
+        ],
+        "chronic_diseases": ["migraine"],
+        "medications": ["ibuprofen"],
+        "messages": [
+            "I've had a throbbing headache since yesterday morning.",
+            "It's behind my left eye and it's been constant.",
+            "About 8 out of 10, bright light makes it worse.",
+            "I feel a bit nauseous but no vomiting.",
+            "No, that's all.",
+        ],
+        "visit_reason": "Severe headache with light sensitivity",
+    },
+    {
+        "history": [
+            ("Dry Cough", "• Reports dry cough for three days.\n• Denies fever."),
+            ("Productive Cough", "• Reports cough now productive with green sputum.\n• Prescribed amoxicillin."),
+        ],
+        "chronic_diseases": ["asthma"],
+        "medications": ["salbutamol inhaler"],
+        "messages": [
+            "My cough came back and I'm short of breath.",
+            "It started four days ago and gets worse at night.",
+            "My inhaler helps for a couple of hours.",
+            "I also had a low fever yesterday.",
+            "Nothing else.",
+        ],
+        "visit_reason": "Persistent cough and shortness of breath",
+    },
+    {
+        "history": [
+            ("Right Knee Pain", "• Reports knee pain after a fall while running.\n• Mild swelling."),
+        ],
+        "chronic_diseases": [],
+        "medications": [],
+        "messages": [
+            "My right knee hurts when I climb stairs.",
+            "It's a sharp pain on the inside of the knee, for about a month.",
+            "Maybe 5 out of 10, ice helps a bit.",
+            "No, I'm done.",
+        ],
+        "visit_reason": "Worsening right knee pain",
+    },
+    {
+        "history": [],
+        "chronic_diseases": ["type 2 diabetes"],
+        "medications": ["metformin"],
+        "messages": [
+            "I've been really tired and thirsty for the past week.",
+            "I'm drinking a lot more water than usual and waking up at night to urinate.",
+            "My blood sugar readings have been higher than normal.",
+            "No, that's everything.",
+        ],
+        "visit_reason": "Fatigue and increased thirst",
+    },
+]
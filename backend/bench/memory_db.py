@@ -0,0 +1,107 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+from typing import Optional
+from uuid import UUID
+
+from db.cache import HistoryCursor, PatientCache, symptoms_page
+from db.db import _digest_rows, _patient_row, _patient_update_fields, _symptom_row
+from llm.stub_backend import LatencyModel
+
+
+class InMemoryDatabase:
+    """
+    Stand-in for AsyncDatabase keeping every table in process memory, for benchmarks.
+    Each call waits for a latency drawn from the given model, to stand in for the Supabase round trip.
+    Rows are built and validated by the same helpers as AsyncDatabase.
+    """
+
+    def __init__(self, latency: Optional[LatencyModel] = None):
+        self._latency = latency or LatencyModel()
+        self._patients: dict[str, dict] = {}
+        self._symptoms: dict[str, list[dict]] = {}
+        self._digests: dict[str, dict[str, dict]] = {}
+        # nothing to save on reads from memory, kept for the /admin/db_cache route
+        self.cache = PatientCache(0, 0)
+
+    async def connect(self) -> None:
+        # there is no client to create
+        pass
+
+    async def _round_trip(self) -> None:
+        await asyncio.sleep(self._latency.sample())
+
+    def seed_patient(self, patient_id: UUID, history: list[tuple[str, str]], chronic_diseases: Optional[list] = None,
+                     medications: Optional[list] = None) -> None:
+        """
+        Adds a patient with one past symptom entry per (title, summary) in history, one week apart.
+        """
+        row = _patient_row(patient_id, f"{patient_id}@bench.local", 40, "female", [], chronic_diseases, medications)
+        self._patients[row["patient_id"]] = row
+        start = datetime.now(UTC) - timedelta(weeks=len(history))
+        self._symptoms[row["patient_id"]] = [
+            _symptom_row(patient_id, summary, title, start + timedelta(weeks=index))
+            for index, (title, summary) in enumerate(history)
+        ]
+
+    async def add_patient(self, patient_id: UUID, email: str, age: int, gender: str, allergies: list = None, chronic_diseases: list = None, medications: list = None) -> dict:
+        row = _patient_row(patient_id, email, age, gender, allergies, chronic_diseases, medications)
+        await self._round_trip()
+        if row["patient_id"] in self._patients:
+            raise Exception("Insert failed: duplicate patient_id")
+        self._patients[row["patient_id"]] = row
+        return row["patient_id"]
+
+    async def update_patient_data(self, patient_id: UUID, email: Optional[str] = None,
+                                  age: Optional[int] = None, gender: Optional[str] = None, allergies: Optional[list] = None,
+                                  chronic_diseases: Optional[list] = None, medications: Optional[list] = None) -> dict:
+        update_fields = _patient_update_fields(email, age, gender, allergies, chronic_diseases, medications)
+        await self._round_trip()
+        patient = self._patients.get(str(patient_id))
+        if patient is None:
+            raise Exception("Update failed: no such patient")
+        patient.update(update_fields)
+        return dict(patient)
+
+    async def get_patient(self, patient_id: UUID) -> dict:
+        await self._round_trip()
+        patient = self._patients.get(str(patient_id))
+        if patient is None:
+            raise Exception("Fetch failed: no such patient")
+        return dict(patient)
+
+    async def add_symptom(self, patient_id: UUID, symptom_summary: str, title: str,
+                          timestamp: Optional[datetime] = None) -> dict:
+        row = _symptom_row(patient_id, symptom_summary, title, timestamp)
+        await self._round_trip()
+        self._symptoms.setdefault(row["patient_id"], []).append(row)
+        return dict(row)
+
+    async def get_symptoms_for_patient(self, patient_id: UUID) -> list[dict]:
+        await self._round_trip()
+        rows = sorted(self._symptoms.get(str(patient_id), []), key=lambda row: row["timestamp"])
+        return [{"timestamp": row["timestamp"], "title": row["title"], "summary": row["summary"]} for row in rows]
+
+    async def get_symptoms_page(self, patient_id: UUID, limit: int, cursor: Optional[HistoryCursor] = None,
+                                since: Optional[datetime] = None) -> list[dict]:
+        return symptoms_page(await self.get_symptoms_for_patient(patient_id), limit, cursor, since)
+
+    async def get_patient_by_email(self, email: str) -> UUID:
+        await self._round_trip()
+        for patient in self._patients.values():
+            if patient["email"] == email:
+                return UUID(patient["patient_id"])
+        raise Exception("Fetch failed: no such patient")
+
+    async def get_digests_for_patient(self, patient_id: UUID) -> list[dict]:
+        await self._round_trip()
+        digests = self._digests.get(str(patient_id), {})
+        return [{"period": period, "entry_count": digest["entry_count"], "digest": digest["digest"]}
+                for period, digest in sorted(digests.items())]
+
+    async def add_digests(self, patient_id: UUID, digests: list[dict]) -> list[dict]:
+        rows = _digest_rows(patient_id, digests)
+        await self._round_trip()
+        stored = self._digests.setdefault(str(patient_id), {})
+        for row in rows:
+            stored[row["period"]] = row
+        return rows
@@ -0,0 +1,343 @@
+"""
+End-to-end benchmark of the API: boots the FastAPI app in process, with the database and the LLM
+replaced by local stand-ins (InMemoryDatabase and the stub LLM backend), and replays scripted
+patients through /response, /save_summary and /doctor_report.
+
+Run from backend/:
+    python -m bench.run --patients 200 --concurrency 50 --output bench.json
+    python -m bench.run --baseline bench.json   # exits 1 if a metric regressed
+
+The stub LLM latencies are set with the STUB_LLM_* variables (see README).
+Startup is measured in fresh interpreters first: importing the app, and until its warm-up is done
+(see /api/ready); the run exits 1 if that takes longer than --startup-budget seconds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Optional
+from uuid import UUID, uuid4
+
+# the app reads these at import time
+os.environ["LLM_BACKEND"] = "stub"
+os.environ.setdefault("SUPABASE_URL", "http://supabase.invalid")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+# the stub has no provider quota, measure the app rather than the rate limits unless asked to
+os.environ.setdefault("LLM_RPM", "0")
+os.environ.setdefault("LLM_TPM", "0")
+
+import httpx
+
+from app import app
+from bench.conversations import CONVERSATIONS
+from bench.memory_db import InMemoryDatabase
+from llm.stub_backend import LatencyModel
+from routes import router
+
+ENDPOINTS = ("response", "save_summary", "doctor_report")
+_BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# run in a fresh interpreter, as a starting worker would
+_STARTUP_SCRIPT = """
+import asyncio, json, time
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+from telemetry.readiness import readiness
+
+async def warm_up():
+    async with app.router.lifespan_context(app):
+        return await readiness.wait()
+
+ready = asyncio.run(warm_up())
+print(json.dumps({"import_seconds": imported - start, "ready_seconds": time.perf_counter() - start, "ready": ready}))
+"""
+# metrics compared against a baseline, and whether higher is better
+_COMPARED_METRICS = {"p50": False, "p95": False, "p99": False, "throughput": True}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, min(len(sorted_values), round(p / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """
+    Collects request latencies and errors per endpoint, and the memory peak of each phase.
+    """
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.durations: dict[str, float] = {}
+        self.memory_peaks: dict[str, float] = {}
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> Optional[dict]:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            ok = response.is_success
+        except Exception as e:
+            print(f"{endpoint} failed: {e}", file=sys.stderr)
+            response, ok = None, False
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        if not ok:
+            self.errors[endpoint] += 1
+            return None
+        return response.json()
+
+    async def job(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> Optional[dict]:
+        """
+        Submits a background job and follows it until it finishes, recording the whole time it took.
+        """
+        start = time.perf_counter()
+        job = None
+        try:
+            response = await client.request(method, url, **kwargs)
+            if response.status_code == 202:
+                job = response.json()
+                while job["status"] in ("queued", "running"):
+                    job = (await client.get(f"/api/jobs/{job['job_id']}", params={"wait": 30})).json()
+        except Exception as e:
+            print(f"{endpoint} failed: {e}", file=sys.stderr)
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        if job is None or job["status"] != "done":
+            self.errors[endpoint] += 1
+            return None
+        return job["result"]
+
+    def summary(self, wall_time: float) -> dict[str, Any]:
+        results = {}
+        for endpoint in (*ENDPOINTS, "all"):
+            if endpoint == "all":
+                latencies = sorted(latency for values in self.latencies.values() for latency in values)
+                errors = sum(self.errors.values())
+                duration = wall_time
+            else:
+                latencies = sorted(self.latencies[endpoint])
+                errors = self.errors[endpoint]
+                duration = self.durations.get(endpoint, wall_time)
+            results[endpoint] = {
+                "requests": len(latencies),
+                "errors": errors,
+                "p50": round(percentile(latencies, 50), 4),
+                "p95": round(percentile(latencies, 95), 4),
+                "p99": round(percentile(latencies, 99), 4),
+                "mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+                "throughput": round(len(latencies) / duration, 2) if duration else 0.0,
+                "peak_memory_mib": self.memory_peaks.get(endpoint),
+            }
+        return results
+
+
+def measure_startup(runs: int, budget: Optional[float]) -> dict[str, Any]:
+    """
+    Best of runs fresh interpreters: seconds to import the app, and until its warm-up is done.
+    """
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT], cwd=_BACKEND_DIR, capture_output=True,
+                                text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    ready_seconds = min(sample["ready_seconds"] for sample in samples)
+    return {
+        "runs": runs,
+        "import_seconds": round(min(sample["import_seconds"] for sample in samples), 4),
+        "ready_seconds": round(ready_seconds, 4),
+        "ready": all(sample["ready"] for sample in samples),
+        "budget": budget,
+        "within_budget": budget is None or ready_seconds <= budget,
+    }
+
+
+def seed_patients(database: InMemoryDatabase, count: int, history_length: Optional[int]) -> list[tuple[UUID, dict]]:
+    """
+    Creates count patients, each assigned one of the scripted conversations in turn.
+    With history_length, every patient gets that many past entries, cycled from all scripted histories.
+    """
+    all_history = [entry for conversation in CONVERSATIONS for entry in conversation["history"]]
+    patients = []
+    for index in range(count):
+        conversation = CONVERSATIONS[index % len(CONVERSATIONS)]
+        history = conversation["history"]
+        if history_length is not None:
+            history = [all_history[(index + offset) % len(all_history)] for offset in range(history_length)]
+        patient_id = uuid4()
+        database.seed_patient(patient_id, history, conversation["chronic_diseases"], conversation["medications"])
+        patients.append((patient_id, conversation))
+    return patients
+
+
+async def chat(recorder: Recorder, client: httpx.AsyncClient, patient_id: UUID, conversation: dict) -> None:
+    for message in conversation["messages"]:
+        answer = await recorder.request(client, "response", "GET", f"/api/response/{patient_id}", params={"prompt": message})
+        if answer is None or answer["stop"]:
+            break
+
+
+async def save_summary(recorder: Recorder, client: httpx.AsyncClient, patient_id: UUID, conversation: dict) -> None:
+    await recorder.job(client, "save_summary", "POST", f"/api/save_summary/{patient_id}")
+
+
+async def doctor_report(recorder: Recorder, client: httpx.AsyncClient, patient_id: UUID, conversation: dict) -> None:
+    await recorder.job(client, "doctor_report", "POST", f"/api/doctor_report/{patient_id}",
+                       params={"prompt": conversation["visit_reason"]})
+
+
+async def full_flow(recorder: Recorder, client: httpx.AsyncClient, patient_id: UUID, conversation: dict) -> None:
+    await chat(recorder, client, patient_id, conversation)
+    await save_summary(recorder, client, patient_id, conversation)
+    await doctor_report(recorder, client, patient_id, conversation)
+
+
+async def run_all(flow, recorder: Recorder, client: httpx.AsyncClient, patients: list[tuple[UUID, dict]], concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(patient_id: UUID, conversation: dict) -> None:
+        async with semaphore:
+            await flow(recorder, client, patient_id, conversation)
+
+    await asyncio.gather(*(run_one(patient_id, conversation) for patient_id, conversation in patients))
+
+
+async def benchmark(args: argparse.Namespace) -> dict[str, Any]:
+    database = InMemoryDatabase(LatencyModel.parse(args.db_latency))
+    router.database = database
+    patients = seed_patients(database, args.patients, args.history_length)
+    recorder = Recorder()
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        if args.mode == "mixed":
+            # every patient runs its whole flow, endpoints interleave like in production
+            await run_all(full_flow, recorder, client, patients, args.concurrency)
+            if args.tracemalloc:
+                recorder.memory_peaks["all"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        else:
+            # one endpoint at a time across all patients, so each phase has its own memory peak
+            for endpoint, flow in zip(ENDPOINTS, (chat, save_summary, doctor_report)):
+                if args.tracemalloc:
+                    tracemalloc.reset_peak()
+                phase_start = time.perf_counter()
+                await run_all(flow, recorder, client, patients, args.concurrency)
+                recorder.durations[endpoint] = time.perf_counter() - phase_start
+                if args.tracemalloc:
+                    recorder.memory_peaks[endpoint] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+            if args.tracemalloc:
+                recorder.memory_peaks["all"] = max(recorder.memory_peaks.values())
+        wall_time = time.perf_counter() - start
+
+    if args.tracemalloc:
+        tracemalloc.stop()
+    return {
+        "config": {
+            "mode": args.mode,
+            "patients": args.patients,
+            "concurrency": args.concurrency,
+            "history_length": args.history_length,
+            "db_latency": args.db_latency,
+            "llm": {name: value for name, value in os.environ.items() if name.startswith("STUB_LLM_")},
+            "tracemalloc": args.tracemalloc,
+        },
+        "environment": environment(),
+        "wall_time": round(wall_time, 3),
+        "max_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        "endpoints": recorder.summary(wall_time),
+    }
+
+
+def environment() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "commit": commit}
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    """
+    Lists the metrics that are worse than in baseline by more than tolerance (a fraction).
+    """
+    regressions = []
+    for endpoint, metrics in results["endpoints"].items():
+        base_metrics = baseline.get("endpoints", {}).get(endpoint)
+        if not base_metrics:
+            continue
+        for metric, higher_is_better in _COMPARED_METRICS.items():
+            value, base = metrics[metric], base_metrics.get(metric)
+            if not base:
+                continue
+            change = (value - base) / base
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{endpoint} {metric}: {base} -> {value} ({change:+.0%})")
+    return regressions
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the chat, summary and doctor report flows.")
+    parser.add_argument("--patients", type=int, default=100, help="number of simulated patients")
+    parser.add_argument("--concurrency", type=int, default=20, help="patients served at the same time")
+    parser.add_argument("--mode", choices=("phased", "mixed"), default="phased",
+                        help="phased: one endpoint at a time, with a memory peak per endpoint; "
+                             "mixed: every patient runs its whole flow concurrently")
+    parser.add_argument("--history-length", type=int, default=None,
+                        help="past entries per patient (default: those of the scripted conversation)")
+    parser.add_argument("--db-latency", default="fixed:0.02",
+                        help="latency of each database call: fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false",
+                        help="skip memory tracing, which slows the run down")
+    parser.add_argument("--startup-runs", type=int, default=3,
+                        help="fresh interpreters started to measure the startup time, 0 skips it (default 3)")
+    parser.add_argument("--startup-budget", type=float, default=2.0,
+                        help="seconds a worker may take to import the app and warm up (default 2.0)")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative regression against the baseline (default 0.2)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = parse_args(argv)
+    startup = measure_startup(args.startup_runs, args.startup_budget) if args.startup_runs else None
+    results = asyncio.run(benchmark(args))
+    results["startup"] = startup
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    over_budget = startup is not None and not startup["within_budget"]
+    if over_budget:
+        print(f"STARTUP {startup['ready_seconds']}s, over the budget of {args.startup_budget}s", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("WARNING the baseline was run with a different configuration", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions or over_budget else 0
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+import bisect
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Callable, Hashable, Iterable, NamedTuple, Optional
+from uuid import UUID
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire ttl seconds after they were stored.
+    Used by Database to serve repeated reads without a Supabase round trip.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        # key -> (value, expiry time), least recently used first
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns the cached value, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def update(self, key: Hashable, update: Callable[[Any], None]) -> None:
+        """
+        Applies update to the cached value in place, if there is a live one.
+        Used for write-through, so a read after our own write sees it without refetching.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                update(entry[0])
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_values(self, value: Any) -> None:
+        """
+        Drops every entry holding value, for reverse lookups such as email -> patient_id.
+        """
+        with self._lock:
+            for key in [key for key, (cached, _) in self._entries.items() if cached == value]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self._max_size,
+                "ttl": self._ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def as_utc(timestamp: Optional[datetime]) -> Optional[datetime]:
+    """
+    The timestamp with UTC assumed if it has no offset, so it compares with the stored timestamps.
+    """
+    if timestamp is None or timestamp.tzinfo is not None:
+        return timestamp
+    return timestamp.replace(tzinfo=timezone.utc)
+
+
+def _row_timestamp(row: dict) -> datetime:
+    return as_utc(datetime.fromisoformat(row["timestamp"]))
+
+
+def symptom_fingerprint(row: dict) -> str:
+    """
+    Short hash of a symptom row's title and summary, telling apart rows with the same timestamp.
+    """
+    return hashlib.sha1(f"{row['title']}\n{row['summary']}".encode()).hexdigest()[:10]
+
+
+class HistoryCursor(NamedTuple):
+    """
+    Where a page of a symptom history ended: the timestamp of its oldest row and the fingerprints
+    of the rows with that timestamp already returned. The next page holds the rows up to and at
+    that timestamp which are not among those, so rows sharing a timestamp are neither skipped nor repeated.
+    """
+    timestamp: datetime
+    seen: tuple[str, ...] = ()
+
+    @classmethod
+    def after(cls, page: list[dict], previous: Optional["HistoryCursor"] = None) -> "HistoryCursor":
+        """
+        The cursor of the page following page, itself fetched with previous.
+        """
+        timestamp = _row_timestamp(page[-1])
+        seen = tuple(symptom_fingerprint(row) for row in page if _row_timestamp(row) == timestamp)
+        if previous is not None and previous.timestamp == timestamp:
+            seen = previous.seen + seen
+        return cls(timestamp, seen)
+
+    def encode(self) -> str:
+        return f"{self.timestamp.isoformat()}|{','.join(self.seen)}"
+
+    @classmethod
+    def decode(cls, cursor: str) -> "HistoryCursor":
+        """
+        Parses a cursor made by encode. Raises ValueError if it is not one.
+        """
+        timestamp, separator, seen = cursor.partition("|")
+        if not separator:
+            raise ValueError(f"Invalid history cursor {cursor!r}")
+        return cls(as_utc(datetime.fromisoformat(timestamp)), tuple(seen.split(",")) if seen else ())
+
+    def skip(self, rows: Iterable[dict], limit: int) -> list[dict]:
+        """
+        The first limit of rows (newest first, none newer than the cursor) not returned before the cursor.
+        """
+        seen = Counter(self.seen)
+        page = []
+        for row in rows:
+            if len(page) == limit:
+                break
+            if seen and _row_timestamp(row) == self.timestamp:
+                fingerprint = symptom_fingerprint(row)
+                if seen[fingerprint] > 0:
+                    seen[fingerprint] -= 1
+                    continue
+            page.append(row)
+        return page
+
+
+def symptoms_page(rows: list[dict], limit: int, cursor: Optional[HistoryCursor] = None,
+                  since: Optional[datetime] = None) -> list[dict]:
+    """
+    Copies of the newest rows (at most limit) of a timestamp-ordered symptom list that come after
+    cursor and are newer than since, newest first. Timestamps without an offset are taken as UTC.
+    """
+    since = as_utc(since)
+    start = 0 if since is None else bisect.bisect_right(rows, since, key=_row_timestamp)
+    if cursor is None:
+        return [dict(row) for row in reversed(rows[max(start, len(rows) - limit):])]
+    end = bisect.bisect_right(rows, cursor.timestamp, key=_row_timestamp)
+    newest_first = reversed(rows[max(start, end - limit - len(cursor.seen)):end])
+    return [dict(row) for row in cursor.skip(newest_first, limit)]
+
+
+class PatientCache:
+    """
+    Read-through cache of per-patient symptom lists and email -> patient_id mappings,
+    updated write-through by Database so reads after our own writes stay consistent.
+    Cached lists are copied in and out, callers are free to mutate what they get.
+    """
+
+    _SYMPTOM_FIELDS = ("timestamp", "title", "summary")
+
+    def __init__(self, max_size: int, ttl: float):
+        self._symptoms = TTLCache(max_size, ttl)
+        self._patient_ids = TTLCache(max_size, ttl)
+        # bumped by every symptom write, see symptoms_generation
+        self._symptom_writes = 0
+
+    def symptoms_generation(self) -> int:
+        """
+        Token to take before fetching symptoms and pass to set_symptoms, so a fetch
+        that raced with one of our writes doesn't cache a list missing that write.
+        """
+        return self._symptom_writes
+
+    def get_symptoms(self, patient_id: UUID) -> Optional[list[dict]]:
+        rows = self._symptoms.get(str(patient_id))
+        return None if rows is None else [dict(row) for row in rows]
+
+    def get_symptoms_page(self, patient_id: UUID, limit: int, cursor: Optional[HistoryCursor] = None,
+                          since: Optional[datetime] = None) -> Optional[list[dict]]:
+        """
+        A page of the cached symptom list, see symptoms_page, without copying the rest of the list.
+        """
+        rows = self._symptoms.get(str(patient_id))
+        return None if rows is None else symptoms_page(rows, limit, cursor, since)
+
+    def set_symptoms(self, patient_id: UUID, rows: list[dict], generation: int) -> None:
+        if generation == self._symptom_writes:
+            self._symptoms.set(str(patient_id), [dict(row) for row in rows])
+
+    def add_symptom(self, row: dict) -> None:
+        """
+        Appends an inserted symptom row to the cached list of its patient, keeping timestamp order.
+        """
+        cached_row = {field: row.get(field) for field in self._SYMPTOM_FIELDS}
+
+        def append(rows: list[dict]) -> None:
+            rows.append(cached_row)
+            if len(rows) > 1 and rows[-2]["timestamp"] > cached_row["timestamp"]:
+                rows.sort(key=lambda cached: cached["timestamp"])
+
+        self._symptom_writes += 1
+        self._symptoms.update(str(row["patient_id"]), append)
+
+    def invalidate_symptoms(self, patient_ids: Iterable[str]) -> None:
+        """
+        Drops the cached symptom lists of the patients, e.g. after a bulk insert.
+        """
+        self._symptom_writes += 1
+        for patient_id in set(patient_ids):
+            self._symptoms.pop(str(patient_id))
+
+    def get_patient_id(self, email: str) -> Optional[UUID]:
+        return self._patient_ids.get(email)
+
+    def set_patient_id(self, email: str, patient_id: UUID) -> None:
+        self._patient_ids.set(email, UUID(str(patient_id)))
+
+    def update_patient_email(self, patient_id: UUID, email: str) -> None:
+        patient_id = UUID(str(patient_id))
+        self._patient_ids.pop_values(patient_id)
+        self._patient_ids.set(email, patient_id)
+
+    def stats(self) -> dict:
+        return {"symptoms": self._symptoms.stats(), "patient_ids": self._patient_ids.stats()}
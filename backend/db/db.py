@@ -1,80 +1,217 @@
+import asyncio
+import contextvars
+import functools
 import os
+import threading
+from concurrent.futures import Future
 from uuid import UUID
 
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from postgrest import AsyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+from postgrest.exceptions import APIError
 from datetime import datetime, UTC
-from typing import Optional
+from typing import Any, Awaitable, Callable, Iterable, Iterator, NamedTuple, Optional
+
+from db.cache import HistoryCursor, PatientCache, as_utc
+from db.transport import SharedTransport, shared_transport
+from telemetry.tracing import traced
 
 GENDERS = ('male', 'female')
 
 load_dotenv()  # Load variables from .env
 
+# checked when the first client is created, so the app can be imported (and report itself not ready) without them
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Missing Supabase credentials in environment variables")
+# read cache of symptom lists and email lookups, 0 disables it
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", 1024))
+DB_CACHE_TTL = float(os.getenv("DB_CACHE_TTL", 60))  # seconds
+# rows sent per insert request by the bulk methods
+DB_BULK_CHUNK_SIZE = int(os.getenv("DB_BULK_CHUNK_SIZE", 500))
+
+
+def _validate_gender(gender: Optional[str]) -> None:
+    if gender is not None and gender not in GENDERS:
+        raise ValueError(f"Gender should be one of {GENDERS}, but got {gender}")
+
+
+def _validate_age(age: Optional[int]) -> None:
+    if age is not None and age < 0:
+        raise ValueError("Age must be a non-negative integer")
+
+
+def _patient_row(patient_id: UUID, email: str, age: int, gender: str, allergies: Optional[list],
+                 chronic_diseases: Optional[list], medications: Optional[list]) -> dict:
+    gender = gender.lower()
+    _validate_gender(gender)
+    _validate_age(age)
+    return {
+        "patient_id": str(patient_id),
+        'email': email,
+        "age": age,
+        "gender": gender,
+        "allergies": allergies if allergies is not None else [],
+        "chronic_diseases": chronic_diseases if chronic_diseases is not None else [],
+        "medications": medications if medications is not None else []
+    }
+
+
+def _patient_update_fields(email: Optional[str], age: Optional[int], gender: Optional[str],
+                           allergies: Optional[list], chronic_diseases: Optional[list],
+                           medications: Optional[list]) -> dict:
+    _validate_gender(gender)
+    _validate_age(age)
+    return {k: v for k, v in {
+        "email": email,
+        "age": age,
+        "gender": gender,
+        "allergies": allergies,
+        "chronic_diseases": chronic_diseases,
+        "medications": medications
+    }.items() if v is not None}
+
+
+def _symptom_row(patient_id: UUID, symptom_summary: str, title: str, timestamp: Optional[datetime]) -> dict:
+    if timestamp is None:
+        timestamp = datetime.now(UTC)
+    return {
+        "patient_id": str(patient_id),
+        "timestamp": as_utc(timestamp).isoformat(),
+        "title": title,
+        "summary": symptom_summary
+    }
+
+
+class RowError(NamedTuple):
+    """
+    A row a bulk insert rejected: its position in the input and why.
+    """
+    index: int
+    error: str
+
+
+class BulkResult(NamedTuple):
+    """
+    Outcome of a bulk insert: the inserted rows as returned by the database, and the rejected rows.
+    """
+    inserted: list[dict]
+    errors: list[RowError]
+
+
+def _bulk_patient_row(patient: dict) -> dict:
+    return _patient_row(UUID(str(patient["patient_id"])), patient["email"], patient["age"], patient["gender"],
+                        patient.get("allergies"), patient.get("chronic_diseases"), patient.get("medications"))
+
+
+def _bulk_symptom_row(symptom: dict) -> dict:
+    timestamp = symptom.get("timestamp")
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return _symptom_row(UUID(str(symptom["patient_id"])), symptom["summary"], symptom["title"], timestamp)
+
+
+def _validated_rows(items: Iterable[dict], build: Callable[[dict], dict]) -> tuple[list[tuple[int, dict]], list[RowError]]:
+    """
+    Builds the row of every item with the same checks as the single-row methods.
+    Returns the valid rows with their position in items, and the errors of the invalid ones.
+    """
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            rows.append((index, build(item)))
+        except KeyError as e:
+            errors.append(RowError(index, f"Missing field {e}"))
+        except (AttributeError, TypeError, ValueError) as e:
+            errors.append(RowError(index, str(e)))
+    return rows, errors
 
-class Database:
-    def __init__(self):
-        self.supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+def _chunks(rows: list, size: int) -> Iterator[list]:
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _rest_client(make_session: Callable) -> AsyncPostgrestClient:
+    """
+    Creates a PostgREST client for the Supabase project whose HTTP session runs on the shared transport.
+    We only ever use the database API, so this skips the auth/storage/realtime clients create_client sets up.
+    """
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ValueError("Missing Supabase credentials in environment variables")
+    client = AsyncPostgrestClient(f"{SUPABASE_URL}/rest/v1",
+                                  headers={**DEFAULT_POSTGREST_CLIENT_HEADERS,
+                                           "apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"})
+    # keep the url and headers postgrest prepared, but not its private connection pool
+    client.session = make_session(client.session.base_url, client.session.headers)
+    return client
+
+
+def _digest_rows(patient_id: UUID, digests: list[dict]) -> list[dict]:
+    return [{
+        "patient_id": str(patient_id),
+        "period": digest["period"],
+        "entry_count": digest["entry_count"],
+        "digest": digest["digest"]
+    } for digest in digests]
+
+
+class AsyncDatabase:
+    """
+    The patients, symptoms and digests tables of the Supabase project, through the async PostgREST client.
+    The client is created on first use. Scripts use it through the blocking Database.
+    """
+    def __init__(self, transport: SharedTransport = shared_transport):
+        self._transport = transport
+        self._supabase: Optional[AsyncPostgrestClient] = None
+        self.cache = PatientCache(DB_CACHE_SIZE, DB_CACHE_TTL)
+
+    async def _client(self) -> AsyncPostgrestClient:
+        if self._supabase is None:
+            self._supabase = _rest_client(self._transport.async_client)
+        return self._supabase
+
+    async def connect(self) -> None:
+        """
+        Creates the client ahead of the first query, raising if the credentials are missing.
+        """
+        await self._client()
 
     # ------------
     # Patients
     # ------------
 
-    def add_patient(self, patient_id: UUID, email: str, age: int, gender: str, allergies: list = None, chronic_diseases: list = None, medications: list = None) -> dict:
-        gender = gender.lower()
-        if gender not in GENDERS:
-            raise ValueError(f"Gender should be one of {GENDERS}, but got {gender}")
-        if age < 0:
-            raise ValueError("Age must be a non-negative integer")
-        if allergies is None:
-            allergies = []
-        if chronic_diseases is None:
-            chronic_diseases = []
-        if medications is None:
-            medications = []
+    @traced("db.add_patient")
+    async def add_patient(self, patient_id: UUID, email: str, age: int, gender: str, allergies: list = None, chronic_diseases: list = None, medications: list = None) -> dict:
+        row = _patient_row(patient_id, email, age, gender, allergies, chronic_diseases, medications)
+        supabase = await self._client()
         try:
-            response = self.supabase.table("patients").insert({
-                "patient_id": str(patient_id),
-                'email': email,
-                "age": age,
-                "gender": gender,
-                "allergies": allergies,
-                "chronic_diseases": chronic_diseases,
-                "medications": medications
-            }).execute()
+            response = await supabase.table("patients").insert(row).execute()
         except Exception as e:
             raise Exception(f"Insert failed: {str(e)}")
+        self.cache.set_patient_id(email, response.data[0]["patient_id"])
         return response.data[0]["patient_id"]
 
-    def update_patient_data(self, patient_id: UUID, email: Optional[str] = None,
-                            age: Optional[int] = None, gender: Optional[str] = None, allergies: Optional[list] = None,
-                            chronic_diseases: Optional[list] = None, medications: Optional[list] = None) -> dict:
-        if gender is not None and gender not in GENDERS:
-            raise ValueError(f"Gender should be one of {GENDERS}, but got {gender}")
-        if age is not None and age < 0:
-            raise ValueError("Age must be a non-negative integer")
-        update_fields = {k: v for k, v in {
-            "email": email,
-            "age": age,
-            "gender": gender,
-            "allergies": allergies,
-            "chronic_diseases": chronic_diseases,
-            "medications": medications
-        }.items() if v is not None}
-
+    @traced("db.update_patient_data")
+    async def update_patient_data(self, patient_id: UUID, email: Optional[str] = None,
+                                  age: Optional[int] = None, gender: Optional[str] = None, allergies: Optional[list] = None,
+                                  chronic_diseases: Optional[list] = None, medications: Optional[list] = None) -> dict:
+        update_fields = _patient_update_fields(email, age, gender, allergies, chronic_diseases, medications)
+        supabase = await self._client()
         try:
-            response = self.supabase.table("patients").update(update_fields).eq("patient_id", patient_id).execute()
+            response = await supabase.table("patients").update(update_fields).eq("patient_id", patient_id).execute()
         except Exception as e:
             raise Exception(f"Update failed: {str(e)}")
+        if email is not None:
+            self.cache.update_patient_email(patient_id, email)
         return response.data[0]
 
-    def get_patient(self, patient_id: UUID) -> dict:
+    @traced("db.get_patient")
+    async def get_patient(self, patient_id: UUID) -> dict:
+        supabase = await self._client()
         try:
-            response = self.supabase.table("patients").select("*").eq("patient_id", patient_id).single().execute()
+            response = await supabase.table("patients").select("*").eq("patient_id", patient_id).single().execute()
         except Exception as e:
             raise Exception(f"Fetch failed: {str(e)}")
         return response.data
@@ -83,48 +220,245 @@ class Database:
     # Symptoms
     # ------------
 
-    def add_symptom(self, patient_id: UUID, symptom_summary: str, title: str,
-                    timestamp: Optional[datetime] = None) -> dict:
-        if timestamp is None:
-            timestamp = datetime.now(UTC)
-
+    @traced("db.add_symptom")
+    async def add_symptom(self, patient_id: UUID, symptom_summary: str, title: str,
+                          timestamp: Optional[datetime] = None) -> dict:
+        supabase = await self._client()
         try:
-            response = self.supabase.table("symptoms").insert({
-                "patient_id": str(patient_id),
-                "timestamp": timestamp.isoformat(),
-                "title": title,
-                "summary": symptom_summary
-            }).execute()
+            response = await supabase.table("symptoms").insert(
+                _symptom_row(patient_id, symptom_summary, title, timestamp)
+            ).execute()
         except Exception as e:
             raise Exception(f"Insert failed: {str(e)}")
 
-        # return the symptom without the patient_id and id fields
         if not response.data or len(response.data) == 0:
             raise Exception("Insert did not return any data")
 
-        return response.data[0]  # usually returns a list
+        self.cache.add_symptom(response.data[0])
+        return response.data[0]
 
-    def get_symptoms_for_patient(self, patient_id: UUID) -> list[dict]:
+    @traced("db.get_symptoms_for_patient")
+    async def get_symptoms_for_patient(self, patient_id: UUID) -> list[dict]:
+        cached = self.cache.get_symptoms(patient_id)
+        if cached is not None:
+            return cached
+        generation = self.cache.symptoms_generation()
+        supabase = await self._client()
         try:
-            response = self.supabase.table("symptoms") \
+            response = await supabase.table("symptoms") \
                 .select("timestamp, title, summary") \
                 .eq("patient_id", str(patient_id)) \
                 .order("timestamp", desc=False) \
                 .execute()
         except Exception as e:
             raise Exception(f"Fetch failed: {str(e)}")
+        self.cache.set_symptoms(patient_id, response.data, generation)
         return response.data  # List of rows
 
-    def get_patient_by_email(self, email: str) -> UUID:
+    @traced("db.get_symptoms_page")
+    async def get_symptoms_page(self, patient_id: UUID, limit: int, cursor: Optional[HistoryCursor] = None,
+                                since: Optional[datetime] = None) -> list[dict]:
+        """
+        Fetch up to limit symptoms of a patient, newest first, that come after cursor (see HistoryCursor.after)
+        and are newer than since. since is taken as UTC if it has no offset.
+        Served from the cached symptom list when there is one, without loading the whole history otherwise.
+        """
+        since = as_utc(since)
+        cached = self.cache.get_symptoms_page(patient_id, limit, cursor, since)
+        if cached is not None:
+            return cached
+        supabase = await self._client()
+        query = supabase.table("symptoms") \
+            .select("timestamp, title, summary") \
+            .eq("patient_id", str(patient_id))
+        if cursor is not None:
+            # rows at the cursor's timestamp already returned are fetched again and skipped
+            query = query.lte("timestamp", cursor.timestamp.isoformat())
+        if since is not None:
+            query = query.gt("timestamp", since.isoformat())
+        try:
+            response = await query.order("timestamp", desc=True) \
+                .limit(limit if cursor is None else limit + len(cursor.seen)).execute()
+        except Exception as e:
+            raise Exception(f"Fetch failed: {str(e)}")
+        return response.data if cursor is None else cursor.skip(response.data, limit)
+
+    @traced("db.get_patient_by_email")
+    async def get_patient_by_email(self, email: str) -> UUID:
         """
         Fetch a user by their email address.
-        Returns None if no user is found.
+        Raises if no user is found.
         """
+        cached = self.cache.get_patient_id(email)
+        if cached is not None:
+            return cached
+        supabase = await self._client()
         try:
-            response = self.supabase.table("patients").select("*").eq("email", email).single().execute()
-            return UUID(response.data["patient_id"])
+            response = await supabase.table("patients").select("*").eq("email", email).single().execute()
+            patient_id = UUID(response.data["patient_id"])
         except Exception as e:
             raise Exception(f"Fetch failed: {str(e)}")
+        self.cache.set_patient_id(email, patient_id)
+        return patient_id
+
+    # ------------
+    # Symptom digests
+    # ------------
+
+    @traced("db.get_digests_for_patient")
+    async def get_digests_for_patient(self, patient_id: UUID) -> list[dict]:
+        """
+        Fetch the stored period digests of a patient's older symptom entries.
+        """
+        supabase = await self._client()
+        try:
+            response = await supabase.table("symptom_digests") \
+                .select("period, entry_count, digest") \
+                .eq("patient_id", str(patient_id)) \
+                .order("period", desc=False) \
+                .execute()
+        except Exception as e:
+            raise Exception(f"Fetch failed: {str(e)}")
+        return response.data
+
+    @traced("db.add_digests")
+    async def add_digests(self, patient_id: UUID, digests: list[dict]) -> list[dict]:
+        """
+        Store period digests, replacing the previous digest of the same period.
+        """
+        supabase = await self._client()
+        try:
+            response = await supabase.table("symptom_digests") \
+                .upsert(_digest_rows(patient_id, digests), on_conflict="patient_id,period") \
+                .execute()
+        except Exception as e:
+            raise Exception(f"Insert failed: {str(e)}")
+        return response.data
+
+    # ------------
+    # Bulk ingestion
+    # ------------
+
+    async def _insert_rows(self, table: str, rows: list[tuple[int, dict]], result: BulkResult) -> None:
+        """
+        Inserts rows in one request. If the database rejects the request, the rows are inserted
+        again in halves to single out the rejected ones, so the valid rows still get in.
+        """
+        supabase = await self._client()
+        try:
+            response = await supabase.table(table).insert([row for _, row in rows]).execute()
+        except APIError as e:
+            if len(rows) == 1:
+                result.errors.append(RowError(rows[0][0], e.message or str(e)))
+                return
+            middle = len(rows) // 2
+            await self._insert_rows(table, rows[:middle], result)
+            await self._insert_rows(table, rows[middle:], result)
+            return
+        except Exception as e:
+            # not an answer about the rows, e.g. the database is unreachable
+            result.errors.extend(RowError(index, f"Insert failed: {str(e)}") for index, _ in rows)
+            return
+        result.inserted.extend(response.data)
+
+    @traced("db.add_patients")
+    async def add_patients(self, patients: Iterable[dict], chunk_size: int = DB_BULK_CHUNK_SIZE) -> BulkResult:
+        """
+        Insert many patients, chunk_size per request. Each patient is a dict of add_patient's arguments.
+        Invalid and rejected patients are reported per row in the result, the others are inserted.
+        """
+        rows, errors = _validated_rows(patients, _bulk_patient_row)
+        result = BulkResult([], errors)
+        for chunk in _chunks(rows, chunk_size):
+            await self._insert_rows("patients", chunk, result)
+        for row in result.inserted:
+            self.cache.set_patient_id(row["email"], row["patient_id"])
+        result.errors.sort()
+        return result
+
+    @traced("db.add_symptoms")
+    async def add_symptoms(self, symptoms: Iterable[dict], chunk_size: int = DB_BULK_CHUNK_SIZE) -> BulkResult:
+        """
+        Insert many symptoms, chunk_size per request. Each symptom is a dict with patient_id, title,
+        summary and optionally timestamp (a datetime or an ISO 8601 string, now by default).
+        Invalid and rejected symptoms are reported per row in the result, the others are inserted.
+        """
+        rows, errors = _validated_rows(symptoms, _bulk_symptom_row)
+        result = BulkResult([], errors)
+        for chunk in _chunks(rows, chunk_size):
+            await self._insert_rows("symptoms", chunk, result)
+        self.cache.invalidate_symptoms(row["patient_id"] for _, row in rows)
+        result.errors.sort()
+        return result
+
+
+class _LoopThread:
+    """
+    A background event loop on which Database runs the coroutines of its AsyncDatabase.
+    Started on first use; the coroutines run in the caller's context, so their spans nest under the caller's.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    def run(self, coroutine: Awaitable) -> Any:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="database-loop", daemon=True).start()
+        context = contextvars.copy_context()
+        future = Future()
+
+        def done(task: asyncio.Task) -> None:
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start() -> None:
+            self._loop.create_task(coroutine, context=context).add_done_callback(done)
+
+        self._loop.call_soon_threadsafe(start)
+        return future.result()
+
+
+_loop_thread = _LoopThread()
+# the async connection pool of the blocking Database, bound to its loop rather than to the app's
+_loop_transport = SharedTransport(shared_transport.config)
+
+
+def _blocking(method: Callable[..., Awaitable]) -> Callable:
+    @functools.wraps(method)
+    def call(self: "Database", *args, **kwargs):
+        return _loop_thread.run(method(self.async_database, *args, **kwargs))
+    return call
+
+
+class Database:
+    """
+    Blocking front of AsyncDatabase for scripts and the importer: every method runs the AsyncDatabase
+    one on a background event loop. The app itself uses AsyncDatabase.
+    """
+
+    def __init__(self, transport: SharedTransport = _loop_transport):
+        self.async_database = AsyncDatabase(transport)
+        self.cache = self.async_database.cache
+
+    connect = _blocking(AsyncDatabase.connect)
+    add_patient = _blocking(AsyncDatabase.add_patient)
+    update_patient_data = _blocking(AsyncDatabase.update_patient_data)
+    get_patient = _blocking(AsyncDatabase.get_patient)
+    add_symptom = _blocking(AsyncDatabase.add_symptom)
+    get_symptoms_for_patient = _blocking(AsyncDatabase.get_symptoms_for_patient)
+    get_symptoms_page = _blocking(AsyncDatabase.get_symptoms_page)
+    get_patient_by_email = _blocking(AsyncDatabase.get_patient_by_email)
+    get_digests_for_patient = _blocking(AsyncDatabase.get_digests_for_patient)
+    add_digests = _blocking(AsyncDatabase.add_digests)
+    add_patients = _blocking(AsyncDatabase.add_patients)
+    add_symptoms = _blocking(AsyncDatabase.add_symptoms)
 
 # Example usage:
 # db = Database(url="...", key="...")
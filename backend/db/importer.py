@@ -0,0 +1,112 @@
+"""
+Streams patients or symptoms from a JSONL or CSV file into the database with the bulk insert methods.
+
+    python -m db.importer symptoms history.jsonl
+    python -m db.importer patients patients.csv --chunk-size 200 --errors rejected.jsonl
+
+Records are read and inserted one chunk at a time, so memory stays bounded whatever the file size.
+Fields are named like the arguments of Database.add_patient / add_symptom (patient_id, email, age,
+gender, allergies, chronic_diseases, medications / patient_id, title, summary, timestamp); in CSV
+files, list fields hold their items separated by ';'. Rejected records are written as JSON lines
+with their line number and error, and the exit status is 1 if there were any.
+"""
+import argparse
+import csv
+import json
+import sys
+from itertools import islice
+from typing import IO, Any, Iterator, Union
+
+from db.db import DB_BULK_CHUNK_SIZE, Database
+
+LIST_FIELDS = ("allergies", "chronic_diseases", "medications")
+
+
+def read_jsonl(file: IO[str]) -> Iterator[tuple[int, Union[dict, Exception]]]:
+    """
+    Yields (line number, record) for every non-blank line, or the parse error in place of the record.
+    """
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, e
+
+
+def read_csv(file: IO[str]) -> Iterator[tuple[int, Union[dict, Exception]]]:
+    """
+    Yields (line number, record) for every row after the header, with list fields split on ';'
+    and age converted to an integer. Empty cells are left out of the record.
+    """
+    reader = csv.DictReader(file)
+    for row in reader:
+        record: dict[str, Any] = {field: value for field, value in row.items() if field and value not in (None, "")}
+        try:
+            for field in LIST_FIELDS:
+                if field in record:
+                    record[field] = [item.strip() for item in record[field].split(";") if item.strip()]
+            if "age" in record:
+                record["age"] = int(record["age"])
+        except ValueError as e:
+            yield reader.line_num, e
+            continue
+        yield reader.line_num, record
+
+
+def import_records(database: Database, kind: str, records: Iterator[tuple[int, Union[dict, Exception]]],
+                   chunk_size: int, errors: IO[str]) -> tuple[int, int]:
+    """
+    Inserts the records chunk by chunk, writing every rejected record to errors.
+    Returns the number of inserted and of rejected records.
+    """
+    insert = database.add_patients if kind == "patients" else database.add_symptoms
+    inserted = rejected = 0
+    while chunk := list(islice(records, chunk_size)):
+        line_numbers, batch = [], []
+        for line_number, record in chunk:
+            if isinstance(record, Exception):
+                errors.write(json.dumps({"line": line_number, "error": f"Unreadable record: {record}"}) + "\n")
+                rejected += 1
+            else:
+                line_numbers.append(line_number)
+                batch.append(record)
+        result = insert(batch, chunk_size=chunk_size)
+        for error in result.errors:
+            errors.write(json.dumps({"line": line_numbers[error.index], "error": error.error}) + "\n")
+        inserted += len(result.inserted)
+        rejected += len(result.errors)
+        print(f"{inserted} {kind} inserted, {rejected} rejected", file=sys.stderr)
+    return inserted, rejected
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Import patients or symptoms from a JSONL or CSV file.")
+    parser.add_argument("kind", choices=("patients", "symptoms"))
+    parser.add_argument("path", help="the file to import, '-' for stdin")
+    parser.add_argument("--format", choices=("jsonl", "csv"),
+                        help="file format, guessed from the extension by default (jsonl unless it ends with .csv)")
+    parser.add_argument("--chunk-size", type=int, default=DB_BULK_CHUNK_SIZE, help="records per insert request")
+    parser.add_argument("--errors", help="file receiving the rejected records as JSON lines (default: stderr)")
+    args = parser.parse_args(argv)
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be a positive integer")
+
+    file_format = args.format or ("csv" if args.path.endswith(".csv") else "jsonl")
+    source = sys.stdin if args.path == "-" else open(args.path, newline="" if file_format == "csv" else None)
+    errors = open(args.errors, "w") if args.errors else sys.stderr
+    try:
+        records = read_csv(source) if file_format == "csv" else read_jsonl(source)
+        inserted, rejected = import_records(Database(), args.kind, records, args.chunk_size, errors)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if errors is not sys.stderr:
+            errors.close()
+    print(f"Done: {inserted} {args.kind} inserted, {rejected} rejected", file=sys.stderr)
+    return 1 if rejected else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
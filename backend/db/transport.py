@@ -0,0 +1,139 @@
+import asyncio
+import os
+import random
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+
+# requests that never reached the server, safe to retry whatever the method
+_CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# failures that are only safe to retry for requests without side effects
+_IDEMPOTENT_ERRORS = (httpx.ReadTimeout, httpx.RemoteProtocolError)
+_IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+_RETRY_STATUSES = frozenset((502, 503, 504))
+
+
+@dataclass(frozen=True)
+class TransportConfig:
+    """
+    Connection pooling, timeout and retry settings of the HTTP transport to Supabase.
+    """
+    pool_size: int = 20
+    max_keepalive: int = 10
+    keepalive_expiry: float = 30.0
+    http2: bool = True
+    connect_timeout: float = 3.0
+    read_timeout: float = 10.0
+    retries: int = 2
+    backoff_base: float = 0.1
+    backoff_max: float = 2.0
+
+    @classmethod
+    def from_env(cls) -> "TransportConfig":
+        return cls(
+            pool_size=int(os.getenv("SUPABASE_POOL_SIZE", cls.pool_size)),
+            max_keepalive=int(os.getenv("SUPABASE_MAX_KEEPALIVE", cls.max_keepalive)),
+            keepalive_expiry=float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", cls.keepalive_expiry)),
+            http2=os.getenv("SUPABASE_HTTP2", str(cls.http2)).lower() in ("1", "true", "yes"),
+            connect_timeout=float(os.getenv("SUPABASE_CONNECT_TIMEOUT", cls.connect_timeout)),
+            read_timeout=float(os.getenv("SUPABASE_READ_TIMEOUT", cls.read_timeout)),
+            retries=int(os.getenv("SUPABASE_RETRIES", cls.retries)),
+            backoff_base=float(os.getenv("SUPABASE_RETRY_BACKOFF", cls.backoff_base)),
+            backoff_max=float(os.getenv("SUPABASE_RETRY_BACKOFF_MAX", cls.backoff_max)),
+        )
+
+    @property
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.max_keepalive,
+                            keepalive_expiry=self.keepalive_expiry)
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+    def backoff(self, attempt: int) -> float:
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+def _should_retry(request: httpx.Request, error: Optional[Exception], response: Optional[httpx.Response]) -> bool:
+    if error is not None:
+        return isinstance(error, _CONNECT_ERRORS) or (
+            isinstance(error, _IDEMPOTENT_ERRORS) and request.method in _IDEMPOTENT_METHODS)
+    return response.status_code in _RETRY_STATUSES and request.method in _IDEMPOTENT_METHODS
+
+
+class _AsyncRetryTransport(httpx.AsyncBaseTransport):
+    """
+    Retries a bounded number of times on top of the pool of a SharedTransport.
+    Closing it is a no-op: the pool is shared by many clients and closed by SharedTransport.
+    """
+
+    def __init__(self, shared: "SharedTransport"):
+        self._shared = shared
+        self._config = shared.config
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(self._config.retries + 1):
+            error, response = None, None
+            try:
+                response = await self._shared._get_async_pool().handle_async_request(request)
+            except httpx.TransportError as e:
+                error = e
+            last_attempt = attempt == self._config.retries
+            if last_attempt or not _should_retry(request, error, response):
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                await response.aclose()
+            await asyncio.sleep(self._config.backoff(attempt))
+
+    async def aclose(self) -> None:
+        pass
+
+
+class SharedTransport:
+    """
+    One pooled, keep-alive HTTP transport per process, shared by every database client.
+
+    Clients created with async_client() only carry their base url and headers; connections,
+    HTTP/2 streams and retries are handled by the shared pool, which is opened lazily (or by
+    open() in the app lifespan) and released by aclose(). The pool belongs to the event loop
+    that first uses it.
+    """
+
+    def __init__(self, config: TransportConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._async_pool: Optional[httpx.AsyncHTTPTransport] = None
+
+    def open(self) -> None:
+        """
+        Creates the connection pool up front rather than on the first query.
+        """
+        self._get_async_pool()
+
+    def _get_async_pool(self) -> httpx.AsyncHTTPTransport:
+        with self._lock:
+            if self._async_pool is None:
+                self._async_pool = httpx.AsyncHTTPTransport(http2=self.config.http2, limits=self.config.limits)
+            return self._async_pool
+
+    def async_client(self, base_url: httpx.URL | str, headers: httpx.Headers | dict) -> httpx.AsyncClient:
+        return httpx.AsyncClient(base_url=base_url, headers=headers, timeout=self.config.timeout, follow_redirects=True,
+                                 transport=_AsyncRetryTransport(self))
+
+    async def aclose(self) -> None:
+        """
+        Closes the pool. Clients created before keep working and open a new pool on next use.
+        """
+        with self._lock:
+            pool, self._async_pool = self._async_pool, None
+        if pool is not None:
+            await pool.aclose()
+
+
+shared_transport = SharedTransport(TransportConfig.from_env())
@@ -0,0 +1,283 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable, Optional
+from uuid import uuid4
+
+from db.cache import TTLCache
+from telemetry.metrics import metrics
+from telemetry.tracing import span
+from user.state_store import SessionStateStore
+
+# jobs run concurrently by each worker process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 16))
+# jobs waiting to run before new ones are refused
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", 1000))
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", 120))  # seconds
+# how long the result of a finished job can be fetched
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", 10 * 60))  # seconds
+JOB_RESULT_MAX_SIZE = int(os.getenv("JOB_RESULT_MAX_SIZE", 10000))
+
+jobs_total = metrics.counter("jobs_total", "Finished background jobs, by kind and outcome.")
+job_wait = metrics.histogram("job_wait_seconds", "Time background jobs spent queued before running, by kind.")
+job_run = metrics.histogram("job_run_seconds", "Time background jobs took to run, by kind.")
+# order of the job statuses, a published status never goes back to an earlier one
+_STAGES = {"queued": 0, "running": 1, "done": 2, "failed": 2}
+
+jobs_coalesced = metrics.counter("jobs_coalesced_total", "Submissions answered with an identical job not started yet, by kind.")
+
+
+class QueueFull(Exception):
+    """
+    Raised by JobQueue.submit when JOB_MAX_PENDING jobs are already waiting.
+    """
+
+
+class Job:
+    """
+    A unit of background work and, once it has run, its result or error.
+    """
+
+    def __init__(self, kind: str, key: Hashable, run: Callable[[], Awaitable[Any]], coalesce: Optional[Hashable] = None):
+        self.id = str(uuid4())
+        self.kind = kind
+        self.key = key
+        self.status = "queued"
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created = time.monotonic()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.coalesce = coalesce
+        self._run = run
+        self._done = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Waits up to timeout seconds for the job to finish. Returns whether it has.
+        """
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.done
+
+    def to_dict(self) -> dict[str, Any]:
+        job = {"job_id": self.id, "kind": self.kind, "status": self.status}
+        if self.started is not None:
+            job["queued_seconds"] = round(self.started - self.created, 3)
+        if self.finished is not None:
+            job["run_seconds"] = round(self.finished - self.started, 3)
+        if self.status == "done":
+            job["result"] = self.result
+        elif self.status == "failed":
+            job["error"] = self.error
+        return job
+
+
+class JobQueue:
+    """
+    Bounded pool of asyncio workers running background jobs, such as summaries and doctor reports.
+
+    Jobs sharing a key (a patient) run one at a time in submission order: a job only enters the
+    queue once the previous job with its key has finished, so it never holds a worker while waiting.
+    Submitting fails with QueueFull once max_pending jobs are waiting, for callers to shed load.
+    A submission with the same coalesce key as a job that has not started yet gets that job back
+    instead of queuing a duplicate, so retried requests share it. A job already running may have
+    read its inputs (e.g. the chat turns to summarize), so a submission then queues a new job.
+    Finished jobs can be looked up for result_ttl seconds.
+
+    Jobs run in the process that accepted them. With a store configured, their status is also
+    published there as they start and finish, so a worker sharing the store can answer a poll
+    for a job accepted by another one.
+    """
+    # seconds between reads of the store while load waits for a job of another worker
+    _LOAD_POLL_INTERVAL = 0.5
+
+    def __init__(self, workers: int = JOB_WORKERS, max_pending: int = JOB_MAX_PENDING, timeout: float = JOB_TIMEOUT,
+                 result_ttl: float = JOB_RESULT_TTL, result_max_size: int = JOB_RESULT_MAX_SIZE):
+        if workers <= 0:
+            raise ValueError("workers must be a positive integer")
+        self._worker_count = workers
+        self._max_pending = max_pending
+        self._timeout = timeout
+        self._queue: Optional[asyncio.Queue[Job]] = None
+        self._workers: list[asyncio.Task] = []
+        # key -> jobs with that key not finished yet, the first one is queued or running
+        self._chains: dict[Hashable, deque[Job]] = {}
+        self._active: dict[str, Job] = {}
+        # coalesce key -> the job not started yet submitted with it
+        self._coalesced: dict[Hashable, Job] = {}
+        self._finished = TTLCache(result_max_size, result_ttl)
+        self._result_ttl = result_ttl
+        self._store: Optional[SessionStateStore] = None
+        self.running = 0
+
+    def configure(self, store: Optional[SessionStateStore]) -> None:
+        """
+        Publishes the status of the jobs to store, where load finds the jobs of other workers.
+        With None, nothing is published and only the jobs of this queue can be polled.
+        """
+        self._store = store
+
+    @property
+    def pending(self) -> int:
+        """
+        Jobs submitted but not started yet, whether queued or waiting for an earlier job with their key.
+        """
+        return len(self._active) - self.running
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._work(), name=f"job-worker-{index}") for index in range(self._worker_count)]
+
+    async def stop(self, timeout: float = 30) -> None:
+        """
+        Lets the queued jobs finish for up to timeout seconds, then cancels the workers.
+        """
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Stopping the job queue with {len(self._active)} unfinished jobs")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, kind: str, key: Hashable, run: Callable[[], Awaitable[Any]], coalesce: Optional[Hashable] = None) -> Job:
+        """
+        Queues run() to be awaited by a worker after every job submitted earlier with the same key.
+
+        Args:
+            kind (str): What the job does, e.g. 'doctor_report'.
+            key (Hashable): Jobs with the same key run one at a time, in submission order.
+            run (Callable[[], Awaitable[Any]]): Produces the job's coroutine; its result becomes the job's result.
+            coalesce (Optional[Hashable]): Identifies identical jobs, e.g. (kind, key, arguments).
+                While a job submitted with it has not started, it is returned instead of queuing run.
+
+        Returns:
+            Job: The queued job, or the job not started yet it was coalesced with.
+
+        Raises:
+            QueueFull: If max_pending jobs are already waiting.
+        """
+        if self._queue is None:
+            raise RuntimeError("The job queue is not started")
+        if coalesce is not None and coalesce in self._coalesced:
+            jobs_coalesced.inc(kind=kind)
+            return self._coalesced[coalesce]
+        if self.pending >= self._max_pending:
+            raise QueueFull(f"{self.pending} jobs are already waiting")
+        job = Job(kind, key, run, coalesce)
+        self._active[job.id] = job
+        if coalesce is not None:
+            self._coalesced[coalesce] = job
+        chain = self._chains.get(key)
+        if chain is None:
+            self._chains[key] = deque((job,))
+            self._queue.put_nowait(job)
+        else:
+            chain.append(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._active.get(job_id) or self._finished.get(job_id)
+
+    async def publish(self, job: Job) -> None:
+        """
+        Saves the current status of job to the configured store, if any.
+        """
+        if self._store is None:
+            return
+        try:
+            if self._store.blocking:
+                await asyncio.to_thread(self._store.save_job, job.id, _STAGES[job.status], job.to_dict(), self._result_ttl)
+            else:
+                self._store.save_job(job.id, _STAGES[job.status], job.to_dict(), self._result_ttl)
+        except Exception as e:
+            print(f"Failed to publish job {job.kind} {job.id}: {e}")
+
+    async def load(self, job_id: str, wait: float = 0) -> Optional[dict[str, Any]]:
+        """
+        The status of a job published to the store, e.g. by another worker, as returned by Job.to_dict.
+        With wait, polls the store up to that many seconds for the job to finish.
+        """
+        if self._store is None:
+            return None
+        deadline = time.monotonic() + wait
+        while True:
+            if self._store.blocking:
+                job = await asyncio.to_thread(self._store.load_job, job_id)
+            else:
+                job = self._store.load_job(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in ("done", "failed") or remaining <= 0:
+                return job
+            await asyncio.sleep(min(self._LOAD_POLL_INTERVAL, remaining))
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job) -> None:
+        if job.coalesce is not None:
+            del self._coalesced[job.coalesce]
+        job.status = "running"
+        job.started = time.monotonic()
+        job_wait.observe(job.started - job.created, kind=job.kind)
+        self.running += 1
+        try:
+            await self.publish(job)
+            with span(f"job.{job.kind}"):
+                job.result = await asyncio.wait_for(job._run(), self._timeout)
+            job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = "Job timed out" if isinstance(e, asyncio.TimeoutError) else str(e)
+            print(f"Job {job.kind} {job.id} failed: {job.error}")
+        finally:
+            self.running -= 1
+            job.finished = time.monotonic()
+            job_run.observe(job.finished - job.started, kind=job.kind)
+            jobs_total.inc(kind=job.kind, status=job.status)
+            self._finish(job)
+        await self.publish(job)
+
+    def _finish(self, job: Job) -> None:
+        del self._active[job.id]
+        self._finished.set(job.id, job)
+        chain = self._chains[job.key]
+        chain.popleft()
+        if chain:
+            self._queue.put_nowait(chain[0])
+        else:
+            del self._chains[job.key]
+        job._done.set()
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._workers),
+            "running": self.running,
+            "pending": self.pending,
+            "max_pending": self._max_pending,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "keys": len(self._chains),
+        }
+
+
+job_queue = JobQueue()
+metrics.gauge("job_queue_pending", "Background jobs submitted but not started yet.", function=lambda: job_queue.pending)
+metrics.gauge("job_queue_running", "Background jobs running.", function=lambda: job_queue.running)
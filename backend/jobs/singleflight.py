@@ -0,0 +1,54 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from telemetry.metrics import metrics
+
+T = TypeVar("T")
+
+flight_calls = metrics.counter("singleflight_calls_total",
+                               "Coalesced calls, by operation and whether they ran the work or shared it.")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one in-flight computation.
+
+    Keys are tuples starting with the operation name, followed by its arguments,
+    e.g. ("patient_by_email", email). The first caller runs the work; callers arriving
+    while it is in flight await the same result, or exception. Nothing is kept once
+    the work finishes, so a later call runs it again.
+
+    The work runs in its own task: a caller that is cancelled, e.g. because its client
+    disconnected, does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: tuple, run: Callable[[], Awaitable[T]]) -> T:
+        """
+        Returns the result of run(), shared with every concurrent call with key.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(run())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            flight_calls.inc(operation=key[0], role="leader")
+        else:
+            flight_calls.inc(operation=key[0], role="shared")
+        return await asyncio.shield(task)
+
+    def _forget(self, key: tuple, task: asyncio.Future) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # retrieve the exception, it may have no caller left to re-raise it
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+flights = SingleFlight()
+metrics.gauge("singleflight_in_flight", "Coalesced computations in flight.", function=lambda: len(flights))
@@ -0,0 +1,269 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from typing import TYPE_CHECKING, AsyncIterator, List, NamedTuple, Optional
+
+from llm.model_registry import configure, models
+from llm.prefix_cache import PrefixKey, PrefixStore, prefix_cache
+from llm.scheduler import LLMScheduler, llm_scheduler
+from llm.usage import report_usage
+from llm.user_context import estimate_tokens
+
+if TYPE_CHECKING:
+    # the SDK takes most of the app's import time, it is imported by the Gemini backend when it is created
+    import google.generativeai as genai
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+
+
+class ChatTurn(NamedTuple):
+    """
+    One message of a chat history. role is 'user' or 'model'.
+    """
+    role: str
+    text: str
+
+
+class ChatSession(ABC):
+    """
+    A multi-turn chat with a fixed system instruction, as started by LLMBackend.start_chat.
+    """
+
+    @property
+    @abstractmethod
+    def history(self) -> List[ChatTurn]:
+        ...
+
+    @abstractmethod
+    async def send_async(self, text: str) -> str:
+        ...
+
+    @abstractmethod
+    def stream_async(self, text: str) -> AsyncIterator[str]:
+        """
+        Yields the reply in chunks as it is generated.
+        The exchange is added to the history once the stream has been fully consumed.
+        """
+
+
+class LLMBackend(ABC):
+    """
+    The LLM provider under LLMManager: one-shot generation and chat sessions.
+    """
+    name = "base"
+
+    @abstractmethod
+    async def generate_async(self, model_name: str, system_instruction: str, prompt: str, call_site: str, pinned: bool = False,
+                             response_schema: Optional[dict] = None, prefix: Optional[PrefixKey] = None,
+                             temperature: Optional[float] = None) -> str:
+        """
+        Runs a one-shot generation and returns the reply text.
+
+        Args:
+            model_name (str): The model to use.
+            system_instruction (str): The system prompt.
+            prompt (str): The user prompt.
+            call_site (str): What the generation is for (e.g. 'summary', 'report_hpi').
+            pinned (bool): Whether the system instruction is static, and worth keeping warm.
+            response_schema (Optional[dict]): If given, the reply is a JSON value following this
+                (OpenAPI subset) schema instead of free text.
+            prefix (Optional[PrefixKey]): If given, the system instruction is stable for this key and
+                may be served from the prefix cache instead of being resent.
+            temperature (Optional[float]): The sampling temperature, the model's default if None.
+        """
+
+    @abstractmethod
+    def start_chat(self, model_name: str, system_instruction: str, history: List[ChatTurn],
+                   prefix: Optional[PrefixKey] = None) -> ChatSession:
+        ...
+
+
+class GeminiPrefix(NamedTuple):
+    content: "genai.caching.CachedContent"
+    # the model calling the cached content
+    model: "genai.GenerativeModel"
+
+
+class GeminiPrefixStore(PrefixStore):
+    """
+    Gemini cached content: the system instruction is stored once and billed at the cached rate on every call.
+    """
+
+    def create(self, model_name: str, system_instruction: str, ttl: float) -> GeminiPrefix:
+        import google.generativeai as genai
+        content = genai.caching.CachedContent.create(model=model_name, system_instruction=system_instruction,
+                                                     ttl=timedelta(seconds=ttl))
+        return GeminiPrefix(content, genai.GenerativeModel.from_cached_content(content))
+
+    def delete(self, handle: GeminiPrefix) -> None:
+        handle.content.delete()
+
+
+async def _model_async(model_name: str, system_instruction: str, pinned: bool = False,
+                       prefix: Optional[PrefixKey] = None) -> "genai.GenerativeModel":
+    # the model of a cached prefix if there is one, the registry's model with the full instruction otherwise
+    cached = await prefix_cache.aget(model_name, system_instruction, prefix) if prefix is not None else None
+    return cached.model if cached is not None else models.get(model_name, system_instruction, pinned=pinned)
+
+
+def _report_usage(response) -> None:
+    # token counts of a response, or of a fully consumed stream
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        report_usage(usage.prompt_token_count, usage.candidates_token_count, usage.cached_content_token_count)
+
+
+class GeminiChatSession(ChatSession):
+    """
+    A Gemini chat. With a prefix key, the model is looked up again before every message,
+    so the chat moves to the cached prefix once it exists and off it when it expires:
+    the SDK's chat is then started again on the new model with the turns so far.
+    """
+
+    def __init__(self, chat: "genai.ChatSession", model: "genai.GenerativeModel", model_name: str,
+                 system_instruction: str, prefix: Optional[PrefixKey] = None):
+        self._chat = chat
+        self._model = model
+        self._model_name = model_name
+        self._system_instruction = system_instruction
+        self._prefix = prefix
+
+    @property
+    def history(self) -> List[ChatTurn]:
+        return [ChatTurn(msg.role, msg.parts[0].text) for msg in self._chat.history if msg.parts and msg.parts[0].text]
+
+    def _switch_model(self, model: "genai.GenerativeModel") -> None:
+        if model is not self._model:
+            self._chat = model.start_chat(history=self._chat.history)
+            self._model = model
+
+    async def _refresh_model_async(self) -> None:
+        if self._prefix is not None:
+            self._switch_model(await _model_async(self._model_name, self._system_instruction, prefix=self._prefix))
+
+    async def send_async(self, text: str) -> str:
+        await self._refresh_model_async()
+        response = await self._chat.send_message_async(text)
+        _report_usage(response)
+        return response.text
+
+    async def stream_async(self, text: str) -> AsyncIterator[str]:
+        await self._refresh_model_async()
+        response = await self._chat.send_message_async(text, stream=True)
+        async for chunk in response:
+            # the final chunk of a stream may only carry the finish reason
+            if chunk.parts:
+                yield chunk.text
+        _report_usage(response)
+
+
+class GeminiBackend(LLMBackend):
+    """
+    Google Gemini through google.generativeai, with models shared through the model registry.
+    """
+    name = "gemini"
+
+    def __init__(self, api_key: Optional[str]):
+        configure(api_key=api_key)
+        prefix_cache.configure(GeminiPrefixStore())
+
+    @staticmethod
+    def _generation_config(response_schema: Optional[dict], temperature: Optional[float]) -> Optional["genai.GenerationConfig"]:
+        if response_schema is None and temperature is None:
+            return None
+        import google.generativeai as genai
+        if response_schema is None:
+            return genai.GenerationConfig(temperature=temperature)
+        return genai.GenerationConfig(response_mime_type="application/json", response_schema=response_schema,
+                                      temperature=temperature)
+
+    async def generate_async(self, model_name: str, system_instruction: str, prompt: str, call_site: str, pinned: bool = False,
+                             response_schema: Optional[dict] = None, prefix: Optional[PrefixKey] = None,
+                             temperature: Optional[float] = None) -> str:
+        model = await _model_async(model_name, system_instruction, pinned=pinned, prefix=prefix)
+        response = await model.generate_content_async(prompt, generation_config=self._generation_config(response_schema, temperature))
+        _report_usage(response)
+        return response.text
+
+    def start_chat(self, model_name: str, system_instruction: str, history: List[ChatTurn],
+                   prefix: Optional[PrefixKey] = None) -> ChatSession:
+        # the model is looked up per message, see GeminiChatSession
+        model = models.get(model_name, system_instruction)
+        chat = model.start_chat(history=[{"role": turn.role, "parts": [turn.text]} for turn in history])
+        return GeminiChatSession(chat, model, model_name, system_instruction, prefix)
+
+
+class ScheduledChatSession(ChatSession):
+    """
+    A chat session whose turns go through the LLM scheduler, in the interactive lane.
+    """
+
+    def __init__(self, session: ChatSession, system_instruction: str, scheduler: LLMScheduler):
+        self._session = session
+        self._system_instruction = system_instruction
+        self._scheduler = scheduler
+
+    @property
+    def history(self) -> List[ChatTurn]:
+        return self._session.history
+
+    def _prompt_tokens(self, text: str) -> int:
+        # every turn resends the system instruction and the whole history
+        return estimate_tokens(self._system_instruction) + estimate_tokens(text) + sum(
+            estimate_tokens(turn.text) for turn in self._session.history)
+
+    async def send_async(self, text: str) -> str:
+        return await self._scheduler.call_async("chat", self._prompt_tokens(text), lambda: self._session.send_async(text))
+
+    def stream_async(self, text: str) -> AsyncIterator[str]:
+        return self._scheduler.stream_async("chat", self._prompt_tokens(text), lambda: self._session.stream_async(text))
+
+
+class ScheduledBackend(LLMBackend):
+    """
+    Routes every call of a backend through the LLM scheduler: rate limits, concurrency cap,
+    priority lanes and retries of rate limited or failed calls.
+    """
+
+    def __init__(self, backend: LLMBackend, scheduler: LLMScheduler = llm_scheduler):
+        self.backend = backend
+        self.name = backend.name
+        self._scheduler = scheduler
+
+    async def generate_async(self, model_name: str, system_instruction: str, prompt: str, call_site: str, pinned: bool = False,
+                             response_schema: Optional[dict] = None, prefix: Optional[PrefixKey] = None,
+                             temperature: Optional[float] = None) -> str:
+        return await self._scheduler.call_async(
+            call_site, estimate_tokens(system_instruction) + estimate_tokens(prompt),
+            lambda: self.backend.generate_async(model_name, system_instruction, prompt, call_site, pinned=pinned,
+                                                response_schema=response_schema, prefix=prefix, temperature=temperature))
+
+    def start_chat(self, model_name: str, system_instruction: str, history: List[ChatTurn],
+                   prefix: Optional[PrefixKey] = None) -> ChatSession:
+        return ScheduledChatSession(self.backend.start_chat(model_name, system_instruction, history, prefix=prefix),
+                                    system_instruction, self._scheduler)
+
+
+_backends: dict[str, LLMBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(api_key: Optional[str], name: str = LLM_BACKEND) -> LLMBackend:
+    """
+    Returns the process-wide backend selected by LLM_BACKEND ('gemini' or 'stub'),
+    behind the process-wide LLM scheduler.
+    """
+    with _backends_lock:
+        backend = _backends.get(name)
+        if backend is None:
+            if name == "gemini":
+                backend = GeminiBackend(api_key)
+            elif name == "stub":
+                from llm.stub_backend import StubBackend
+                backend = StubBackend.from_env()
+            else:
+                raise ValueError(f"Unknown LLM backend {name!r}, expected 'gemini' or 'stub'")
+            backend = ScheduledBackend(backend)
+            _backends[name] = backend
+        return backend
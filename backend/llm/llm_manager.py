@@ -1,16 +1,91 @@
-import google.generativeai as genai
+import asyncio
+import json
 import os
-from typing import Optional, List, Any
-from dotenv import load_dotenv
-import datetime
-
-# Load environment variables from .env file
-load_dotenv()
-# Ensure the API key is set in the environment
-api_key = os.getenv('API_KEY')
+import time
+from typing import Optional, List, Any, AsyncIterator, Awaitable, TypeVar
+
+from llm.backends import ChatSession, ChatTurn, LLMBackend, get_backend
+from llm.prefix_cache import PrefixKey, context_hash, prefix_cache, prompt_version
+from llm.response_cache import cache_key, cache_requests, response_cache
+from llm.usage import LLMCall, account
+from llm.user_context import NO_CONTEXT_STRING, UserContext, estimate_tokens, format_context_entry
+from telemetry.metrics import metrics
+from telemetry.tracing import Span, span
+
+# approximate token budget of the patient history in prompts, 0 disables compaction
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 6000))
+# share of the budget reserved for the digests of older entries
+CONTEXT_DIGEST_SHARE = float(os.getenv("CONTEXT_DIGEST_SHARE", 0.25))
+# number of past entries retrieved for the doctor report HPI, 0 sends the whole context
+HPI_RETRIEVAL_TOP_K = int(os.getenv("HPI_RETRIEVAL_TOP_K", 8))
+# approximate token budget of the chat turns resent with every message, older turns are folded into a running digest; 0 keeps them all
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", 0))
+# one-shot generations served from the response cache when their inputs repeat, generated at temperature 0
+# so a cached reply is the one a new call would return
+LLM_CACHE_CALL_SITES = frozenset(filter(None, os.getenv(
+    "LLM_CACHE_CALL_SITES", "summary_title,report_reason,report_hpi,report_impression,report_structured").split(",")))
+# generate the summary with its title, and the doctor report, in one JSON generation each
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "false").lower() in ("1", "true", "yes")
+
+T = TypeVar("T")
+
+llm_chars = metrics.counter("llm_chars_total", "Characters sent to and received from the LLM, by call site and direction.")
+structured_fallbacks = metrics.counter("llm_structured_fallbacks_total",
+                                       "Structured generations that could not be parsed and fell back to one call per field, by call site.")
+
+
+def _object_schema(*fields: str) -> dict:
+    return {"type": "object", "properties": {field: {"type": "string"} for field in fields}, "required": list(fields)}
+
+
+def parse_structured(text: str, schema: dict) -> dict[str, str]:
+    """
+    Parse the reply of a structured generation.
+
+    Args:
+        text (str): The JSON reply.
+        schema (dict): The object schema the reply was generated with.
+
+    Returns:
+        dict: The required fields of the schema, stripped.
+
+    Raises:
+        ValueError: If the reply is not a JSON object, or a required field is missing, not a string or blank.
+    """
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Structured reply is not valid JSON: {e}") from e
+    if not isinstance(value, dict):
+        raise ValueError("Structured reply is not a JSON object.")
+    fields = {}
+    for field in schema["required"]:
+        if not isinstance(value.get(field), str) or not value[field].strip():
+            raise ValueError(f"Structured reply has no '{field}' text.")
+        fields[field] = value[field].strip()
+    return fields
+
+
+async def timed(timings: dict[str, float], stage: str, awaitable: Awaitable[T]) -> T:
+    """
+    Await awaitable and record how long it took, in seconds, under timings[stage].
+    """
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 3)
 
 class LLMManager:
-    _NO_CONTEXT_STRING = "No past medical summary provided."
+    _NO_CONTEXT_STRING = NO_CONTEXT_STRING
+    _CONTEXT_PLACEHOLDER = "\x00user_context\x00"
+    # generations derived from the patient history, cached under the patient's tag
+    _HISTORY_CALL_SITES = frozenset(("summary", "report_hpi", "report_impression", "context_digest",
+                                     "summary_structured", "report_structured"))
+    # sampling temperature of the cached generations
+    _CACHED_TEMPERATURE = 0.0
+    _SUMMARY_SCHEMA = _object_schema("summary", "title")
+    _REPORT_SCHEMA = _object_schema("reason", "HPI", "impression")
     
     _SYMPTOM_SYSTEM_PROMPT_TEMPLATE = (
     "You are an empathetic and helpful medical assistant. Your primary goal is to thoroughly understand a user's current symptoms. "
@@ -156,176 +231,587 @@ class LLMManager:
 )
 
 
-    def __init__(self, api_key: str=api_key, model_name: str = 'gemini-2.5-flash-preview-05-20', user_context: Any = None, end_text: str = "FINISHED"):
-        genai.configure(api_key=api_key)
+    _CONTEXT_DIGEST_SYSTEM_PROMPT = (
+        "You are a medical record summarization assistant. You will be given the symptom entries a patient logged during one period, "
+        "each formatted as '[timestamp] title: summary'. Condense them into a compact digest that will stand in for these entries in the patient's history.\n\n"
+        "The digest should:\n"
+        "- Keep the dates (at least day and month) of significant events.\n"
+        "- Keep symptom names, severity, duration, and any treatments or self-care measures mentioned.\n"
+        "- Group recurring or related symptoms together and state how often they occurred.\n"
+        "- Drop repetition and minor details that do not help a clinician understand the patient's history.\n"
+        "- Remain strictly factual. Do NOT add any diagnosis, interpretation or medical advice.\n\n"
+        "Use at most 5 bullet points, each starting with the '•' character followed by a single space, all on a single line separated by spaces.\n"
+        "Return ONLY the digest."
+    )
+
+    _CHAT_DIGEST_SYSTEM_PROMPT = (
+        "You are a medical interview note-taker. A symptom interview is too long to keep in full, so its oldest turns are replaced by a running digest. "
+        "You will be given the current digest, if there is one, and the turns to fold into it, each formatted as 'User: ...' or 'Assistant: ...'.\n\n"
+        "Return the updated digest, which must:\n"
+        "- Keep every symptom the user reported with its details: onset, duration, severity, nature, location, aggravating and alleviating factors, associated symptoms, self-care tried.\n"
+        "- Keep pertinent negatives (e.g. 'denies fever') and which questions the assistant already asked, so they are not asked again.\n"
+        "- Merge the new turns with the current digest, without repetition.\n"
+        "- Remain strictly factual. Do NOT add any diagnosis, interpretation or medical advice.\n\n"
+        "Use bullet points, each starting with the '•' character followed by a single space, one per line.\n"
+        "Return ONLY the digest."
+    )
+    # appended to the symptom prompt once turns have been folded out of the chat session
+    _CHAT_DIGEST_SECTION = (
+        "\n\nEarlier in this interview (digest of the turns that are no longer shown; do not ask again about what it covers):\n"
+        "{chat_digest}"
+    )
+    # versions of the prompts whose rendered instruction is kept in the prefix cache
+    _SYMPTOM_PROMPT_VERSION = prompt_version(_SYMPTOM_SYSTEM_PROMPT_TEMPLATE + _CHAT_DIGEST_SECTION)
+    _HPI_PROMPT_VERSION = prompt_version(_DOCTOR_REPORT_HPI_SYSTEM_PROMPT)
+    # stand in for the visit reason and the entries retrieved for it in a cached HPI instruction, both are sent in the prompt
+    _VISIT_REASON_IN_PROMPT = "given in the message below"
+    _RETRIEVED_ENTRIES_IN_PROMPT = "(the past entries relevant to the current reason for visit are given in the message below)"
+
+    # structured mode: the single-field prompts above, each answering one field of a JSON object
+    _SUMMARY_STRUCTURED_SYSTEM_PROMPT = (
+        "You will produce a JSON object with two fields, 'summary' and 'title', following the instructions of each section below. "
+        "Write the summary first, then base the title on it.\n\n"
+        "=== Field 'summary' ===\n" + _SUMMARY_SYSTEM_PROMPT + "\n\n"
+        "=== Field 'title' ===\n" + _SUMMARY_TITLE_SYSTEM_PROMPT.replace(
+            "Based on the summary you will be given", "Based on the summary you wrote in the 'summary' field")
+    )
+    _DOCTOR_REPORT_STRUCTURED_SYSTEM_PROMPT = (
+        "You will produce the sections of a doctor's report as a JSON object with three fields, 'reason', 'HPI' and 'impression', "
+        "following the instructions of each section below. Wherever a section says to return ONLY its text, that text is the value of its field.\n\n"
+        "=== Field 'reason' ===\n" + _DOCTOR_REPORT_REASON_TITLE_SYSTEM_PROMPT + "\n\n"
+        "=== Field 'HPI' ===\n" + _DOCTOR_REPORT_HPI_SYSTEM_PROMPT + "\n\n"
+        "=== Field 'impression' ===\n" + _DOCTOR_REPORT_IMPRESSION_SYSTEM_PROMPT
+    )
+
+    def __init__(self, api_key: Optional[str] = None, model_name: str = 'gemini-2.5-flash-preview-05-20', user_context: Any = None, end_text: str = "FINISHED",
+                 token_budget: int = CONTEXT_TOKEN_BUDGET, digest_share: float = CONTEXT_DIGEST_SHARE,
+                 hpi_top_k: int = HPI_RETRIEVAL_TOP_K, backend: Optional[LLMBackend] = None,
+                 cache_tag: Optional[str] = None, cache_call_sites: frozenset[str] = LLM_CACHE_CALL_SITES,
+                 structured_output: bool = LLM_STRUCTURED_OUTPUT, history_budget: int = CHAT_HISTORY_TOKEN_BUDGET):
+        # read here rather than at import, once app.py has loaded the .env file
+        self._backend: LLMBackend = backend or get_backend(api_key or os.getenv('API_KEY'))
+        # summaries and doctor reports are tried as a single JSON generation before one call per field
+        self.structured_output: bool = structured_output
+        # cached generations derived from this user context are dropped when it changes
+        self._cache_tag: Optional[str] = cache_tag
+        self._cache_call_sites: frozenset[str] = cache_call_sites
         self._model_name: str = model_name
-        self.formatted_user_context_str: str = self.__format_user_context(user_context)
+        self._hpi_top_k: int = hpi_top_k
+        self._token_budget: int = token_budget
+        self._digest_share: float = digest_share
+        self._history_budget: int = history_budget
+        self.user_context: UserContext = UserContext(user_context)
         self._end_text: str = end_text
-        current_symptom_prompt = self._SYMPTOM_SYSTEM_PROMPT_TEMPLATE.format(
+        # the symptom prompt is rendered once around a placeholder, the context is spliced in between
+        self._symptom_prompt_head, self._symptom_prompt_tail = self._SYMPTOM_SYSTEM_PROMPT_TEMPLATE.format(
             end_text=self._end_text,
-            user_context_string=self.formatted_user_context_str
-        )
-        self.symptom_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=current_symptom_prompt
-        )
-        self.chat_session: Optional[genai.ChatSession] = self.symptom_model.start_chat(history=[])
-
-    def __format_user_context(self, context_data: List[dict[str, Any]]) -> str:
-        """
-        Receives a list of dicts with keys 'title', 'summary', and 'timestamp',
-        and returns a nicely formatted string for historical context in prompts.
-        """
-        if not context_data:
-            return self._NO_CONTEXT_STRING
-        if isinstance(context_data, str):
-            return context_data
-        elif isinstance(context_data, list):
-            formatted_entries = []
-            for item in context_data:
-                title = item.get('title', 'No Title')
-                summary = item.get('summary', 'No Summary')
-                timestamp = item.get('timestamp', None)
-                if isinstance(timestamp, (int, float)):
-                    # If timestamp is a Unix timestamp
-                    try:
-                        dt = datetime.datetime.fromtimestamp(timestamp)
-                        timestamp_str = dt.strftime('%Y-%m-%d %H:%M')
-                    except Exception:
-                        timestamp_str = str(timestamp)
-                elif isinstance(timestamp, str):
-                    timestamp_str = timestamp
-                else:
-                    timestamp_str = 'Unknown Time'
-                formatted_entries.append(f"[{timestamp_str}] {title}: {summary}")
-            return "\n".join(formatted_entries)
-        else:
-            raise ValueError("Not supported user context type.")
-
-    def __format_history_to_string(self, history: List[Any]) -> str:
+            user_context_string=self._CONTEXT_PLACEHOLDER
+        ).split(self._CONTEXT_PLACEHOLDER)
+        self.chat_session: Optional[ChatSession] = None
+        # whether the user context changed since the chat session was started
+        self._context_changed: bool = False
+        # running digest of the oldest chat turns, folded out of the session to bound its prompt, and how many turns it covers
+        self.chat_digest: str = ""
+        self.digested_turns: int = 0
+        # chat turns already covered by a summary, so the same conversation is not summarized twice
+        self.summarized_turns: int = 0
+        self._restart_chat_session(history=[])
+
+    @property
+    def formatted_user_context_str(self) -> str:
+        return self.user_context.text
+
+    def __format_history_to_string(self, history: List[ChatTurn]) -> str:
         if not history:
             return "No conversation history."
         return "\n".join(
-            f"{'User' if msg.role == 'user' else 'Assistant'}: {msg.parts[0].text}"
-            for msg in history if msg.parts and msg.parts[0].text
+            f"{'User' if turn.role == 'user' else 'Assistant'}: {turn.text}"
+            for turn in history
         )
 
-    def get_response(self, user_text: str) -> str:
+    def _restart_chat_session(self, history: List[ChatTurn]) -> None:
         """
-        Send user input to the chat session and return the assistant's response.
+        Start a new symptom chat session with the current user context and the given history.
+        """
+        current_symptom_prompt = self._symptom_prompt_head + self.user_context.text + self._symptom_prompt_tail
+        if self.chat_digest:
+            current_symptom_prompt += self._CHAT_DIGEST_SECTION.format(chat_digest=self.chat_digest)
+        prefix = self._prefix_key("symptom", self._SYMPTOM_PROMPT_VERSION, self._end_text, self.user_context.text, self.chat_digest)
+        self.chat_session = self._backend.start_chat(self._model_name, current_symptom_prompt, history, prefix=prefix)
+        self._context_changed = False
+
+    def _prefix_key(self, prompt: str, version: str, *context: str) -> PrefixKey:
+        """
+        The prefix cache key of a system instruction rendered from the given prompt version and context parts.
+        """
+        return PrefixKey(prompt, version, context_hash("\x00".join(context)), self._cache_tag)
 
-        Args:
-            user_text (str): The user's message to send to the assistant.
+    async def _invalidate_cached_history(self) -> None:
+        """
+        Drop the cached generations and prefixes derived from the previous user context of this patient.
+        """
+        if self._cache_tag is not None:
+            prefix_cache.invalidate(self._cache_tag)
+            await response_cache.ainvalidate(self._cache_tag)
 
-        Returns:
-            str: The assistant's response text.
+    def _apply_context_change(self) -> None:
+        """
+        Switch the symptom model to the updated context. A chat that is under way switches before its
+        next message and keeps its history, so a turn in flight while e.g. a summary is saved is not lost.
+        """
+        if self.chat_session and self.chat_session.history:
+            self._context_changed = True
+            return
+        self._restart_chat_session(history=[])
+
+    def _cache_entry(self, system_instruction: str, prompt: str, call_site: str,
+                     response_schema: Optional[dict] = None) -> tuple[Optional[str], Optional[str]]:
+        """
+        The response cache key and tag of a generation, or a None key if call_site is not cached.
+        """
+        if call_site not in self._cache_call_sites or not response_cache.enabled:
+            return None, None
+        config = {"backend": self._backend.name, "temperature": self._CACHED_TEMPERATURE}
+        if response_schema is not None:
+            config["schema"] = response_schema
+        key = cache_key(self._model_name, system_instruction, prompt, config)
+        return key, self._cache_tag if call_site in self._HISTORY_CALL_SITES else None
+
+    @staticmethod
+    def _cacheable(response: str, response_schema: Optional[dict]) -> bool:
+        # structured replies that do not parse are retried field by field, keeping them would skip the retry
+        if not response:
+            return False
+        if response_schema is None:
+            return True
+        try:
+            parse_structured(response, response_schema)
+        except ValueError:
+            return False
+        return True
+
+    async def _generate(self, system_instruction: str, prompt: str, call_site: str, pinned: bool = False,
+                        response_schema: Optional[dict] = None, prefix: Optional[PrefixKey] = None) -> str:
+        """
+        Run a one-shot generation with the given system instruction and return the stripped text.
+        call_site names what the generation is for, e.g. 'summary'.
+        Pass pinned=True for static system prompts, so their model is never evicted from the registry.
+        Pass response_schema to get a JSON reply following it, see parse_structured.
+        Pass prefix if the system instruction is stable for that key, so it can be served from the prefix cache.
+        Generations of the call sites in cache_call_sites are served from the response cache when their inputs repeat,
+        and run at temperature 0, so the cached reply is the one a new call would return.
         """
+        key, tag = self._cache_entry(system_instruction, prompt, call_site, response_schema)
+        temperature = self._CACHED_TEMPERATURE if key is not None else None
+        with span(f"llm.{call_site}", model=self._model_name) as llm_span:
+            if key is not None:
+                cached = await response_cache.aget(key)
+                cache_requests.inc(call_site=call_site, result="miss" if cached is None else "hit")
+                llm_span.set("cache", "miss" if cached is None else "hit")
+                if cached is not None:
+                    return cached
+            with account(call_site, self._model_name, self._cache_tag) as call:
+                response = await self._backend.generate_async(self._model_name, system_instruction, prompt, call_site, pinned=pinned,
+                                                              response_schema=response_schema, prefix=prefix,
+                                                              temperature=temperature)
+                self._record_exchange(llm_span, call, len(system_instruction) + len(prompt), response)
+        response = response.strip()
+        if key is not None and self._cacheable(response, response_schema):
+            await response_cache.aset(key, response, tag=tag)
+        return response
+
+    def _check_session(self) -> None:
         if not self.chat_session:
             raise ValueError("Session not started. Call reset_symptom_session() or initialize the class again.")
+        if self._context_changed:
+            # the context changed since the previous message, see _apply_context_change
+            self._restart_chat_session(history=self.chat_session.history)
+
+    def _total_turns(self) -> int:
+        # turns of the whole interview, including those folded into the chat digest
+        return self.digested_turns + len(self.chat_session.history)
+
+    def _summary_prompt(self) -> str:
+        if not self.chat_session or not self._total_turns():
+            raise ValueError("No current interaction history available to summarize.")
+        if self._total_turns() <= self.summarized_turns:
+            raise ValueError("No new interaction since the last summary.")
+        with span("format.summary_prompt", turns=self._total_turns()):
+            conversation_text = self.__format_history_to_string(self.chat_session.history)
+        if self.chat_digest:
+            conversation_text = f"Digest of the earlier turns:\n{self.chat_digest}\n\nLatest turns:\n{conversation_text}"
+        return f"Current medical interaction details:\n{conversation_text}"
+
+    def _claim_summary(self) -> tuple[int, int]:
+        """
+        Marks the current chat turns as summarized before the summary is generated, so a concurrent
+        summary of the same turns finds nothing new. Returns the previous and the new mark for _release_summary.
+        """
+        claim = (self.summarized_turns, self._total_turns())
+        self.summarized_turns = claim[1]
+        return claim
+
+    def _release_summary(self, claim: tuple[int, int]) -> None:
+        # the summary failed, unless a later one claimed the turns since
+        if self.summarized_turns == claim[1]:
+            self.summarized_turns = claim[0]
+
+    @staticmethod
+    def _record_exchange(llm_span: Span, call: LLMCall, prompt_chars: int, response: str) -> None:
+        llm_span.set("prompt_chars", prompt_chars)
+        llm_span.set("response_chars", len(response))
+        if call.prompt_tokens is not None:
+            llm_span.set("prompt_tokens", call.prompt_tokens)
+            llm_span.set("cached_tokens", call.cached_tokens)
+        llm_chars.inc(prompt_chars, call_site=call.call_site, direction="prompt")
+        llm_chars.inc(len(response), call_site=call.call_site, direction="response")
+        # what the token counts are estimated from if the backend reports none
+        call.prompt_chars = call.prompt_chars or prompt_chars
+        call.response_chars = len(response)
+
+    def _chat_prompt_chars(self, user_text: str) -> int:
+        # a chat turn resends the whole session history along with the user text
+        return len(user_text) + sum(len(turn.text) for turn in self.chat_session.history)
+
+    @staticmethod
+    def _parse_or_fall_back(response: str, schema: dict, call_site: str) -> Optional[dict[str, str]]:
+        """
+        The fields of a structured reply, or None if it does not parse and the caller should
+        fall back to one generation per field.
+        """
         try:
-            response = self.chat_session.send_message(user_text)
-            return response.text
-        except Exception as e:
-            raise
+            return parse_structured(response, schema)
+        except ValueError as e:
+            print(f"Structured {call_site} reply rejected, generating field by field: {e}")
+            structured_fallbacks.inc(call_site=call_site)
+            return None
+
+    @staticmethod
+    def _summary_dict(summary: str, title: str) -> dict[str, str]:
+        if not summary:
+            raise ValueError("Summary generation failed. No summary text returned.")
+        if not title:
+            raise ValueError("Title generation failed. No title text returned.")
+        return {"title": title, "summary": summary}
 
-    def get_summary(self) -> dict[str, str]:
+    def _plan_digests(self, stored_digests: List[dict[str, Any]]) -> tuple[int, List[Optional[dict[str, Any]]], List[tuple[str, List[dict[str, Any]]]]]:
         """
-        Summarize the current chat session as a concise medical interaction summary.
+        Plans the compaction of the user context.
+        Returns the number of entries to fold, the digest of each folded period (None where it
+        still has to be generated) and the periods whose digest has to be generated.
+        A stored digest is reused when it covers the same number of entries of its period.
+        """
+        if not self._token_budget:
+            return 0, [], []
+        folded, periods = self.user_context.plan_compaction(self._token_budget, self._digest_share)
+        stored = {(digest['period'], digest['entry_count']): digest for digest in stored_digests}
+        digests = [stored.get((period, len(entries))) for period, entries in periods.items()]
+        missing = [(period, entries) for period, entries in periods.items() if (period, len(entries)) not in stored]
+        return folded, digests, missing
+
+    def needs_compaction(self) -> bool:
+        """
+        Whether the user context exceeds the token budget, see compact_context.
+        """
+        return bool(self._token_budget) and self.user_context.plan_compaction(self._token_budget, self._digest_share)[0] > 0
+
+    @staticmethod
+    def _digest_prompt(period: str, entries: List[dict[str, Any]]) -> str:
+        entries_text = "\n".join(format_context_entry(entry) for entry in entries)
+        return f"Symptom entries from {period}:\n{entries_text}"
+
+    def _apply_digests(self, folded: int, digests: List[Optional[dict[str, Any]]],
+                       missing: List[tuple[str, List[dict[str, Any]]]], texts: List[str]) -> List[dict[str, Any]]:
+        new_digests = [{"period": period, "entry_count": len(entries), "digest": text}
+                       for (period, entries), text in zip(missing, texts)]
+        generated = iter(new_digests)
+        self.user_context.apply_digests([digest or next(generated) for digest in digests], folded)
+        self._apply_context_change()
+        return new_digests
+
+    async def compact_context(self, stored_digests: Optional[List[dict[str, Any]]] = None) -> List[dict[str, Any]]:
+        """
+        Fit the user context in the token budget: the most recent entries are kept verbatim
+        and older entries are replaced by one digest per calendar month, the missing digests
+        being generated concurrently.
+
+        Args:
+            stored_digests (Optional[List[dict[str, Any]]]): Digests saved by earlier compactions,
+                dicts with keys 'period', 'entry_count' and 'digest'. Matching ones are reused.
 
         Returns:
-            dict: A dictionary with keys 'title' and 'summary' for the current medical interaction.
+            List[dict[str, Any]]: The digests that had to be generated, to be stored for reuse.
         """
-        if not self.chat_session or not self.chat_session.history:
-            raise ValueError("No current interaction history available to summarize.")
+        folded, digests, missing = self._plan_digests(stored_digests or [])
+        if not folded:
+            return []
+        texts = await asyncio.gather(*(
+            self._generate(self._CONTEXT_DIGEST_SYSTEM_PROMPT, self._digest_prompt(period, entries), "context_digest", pinned=True)
+            for period, entries in missing
+        ))
+        return self._apply_digests(folded, digests, missing, list(texts))
+
+    def _check_report_inputs(self, visit_reason: str) -> None:
+        if not visit_reason:
+            raise ValueError("Visit reason must be provided for the doctor report.")
+        if self.user_context.is_empty():
+            raise ValueError("User context must be provided for the doctor report.")
 
-        summary_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=self._SUMMARY_SYSTEM_PROMPT
-        )
-        conversation_text = self.__format_history_to_string(self.chat_session.history)
-        prompt_for_summary = f"Current medical interaction details:\n{conversation_text}"
-        answer_dict =  {"title": "", "summary": ""}
-        try:
-            response = summary_model.generate_content(prompt_for_summary)
-            answer_dict['summary'] = response.text.strip()
-        except Exception as e:
-            raise e
-        title_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=self._SUMMARY_TITLE_SYSTEM_PROMPT
-        )
+    def _plan_history_fold(self) -> int:
+        """
+        The number of oldest chat turns to fold into the chat digest before the next message, 0 if the
+        history fits the budget. Turns are folded down to half the budget, so the digest is not regenerated
+        on every message, and the kept turns start with a user message.
+        """
+        if not self._history_budget:
+            return 0
+        history = self.chat_session.history
+        tokens = [estimate_tokens(turn.text) for turn in history]
+        kept = sum(tokens)
+        if kept <= self._history_budget:
+            return 0
+        fold = 0
+        while fold < len(history) and (kept > self._history_budget // 2 or history[fold].role != "user"):
+            kept -= tokens[fold]
+            fold += 1
+        return fold
+
+    def _chat_digest_prompt(self, turns: List[ChatTurn]) -> str:
+        current = f"Current digest:\n{self.chat_digest}\n\n" if self.chat_digest else ""
+        return f"{current}Turns to fold in:\n{self.__format_history_to_string(turns)}"
+
+    def _apply_history_fold(self, turns: List[ChatTurn], digest: str) -> None:
+        history = self.chat_session.history
+        if not digest or history[:len(turns)] != turns:
+            # nothing generated, or the session moved on (e.g. was reset) during the generation
+            return
+        self.chat_digest = digest
+        self.digested_turns += len(turns)
+        self._restart_chat_session(history=history[len(turns):])
+
+    async def _fold_history(self) -> None:
+        fold = self._plan_history_fold()
+        if not fold:
+            return
+        turns = self.chat_session.history[:fold]
         try:
-            response = title_model.generate_content(answer_dict['summary'])
-            answer_dict['title'] = response.text.strip()
+            digest = await self._generate(self._CHAT_DIGEST_SYSTEM_PROMPT, self._chat_digest_prompt(turns), "chat_digest", pinned=True)
         except Exception as e:
-            raise e
-        if not answer_dict['summary']:
-            raise ValueError("Summary generation failed. No summary text returned.")
-        if not answer_dict['title']:
-            raise ValueError("Title generation failed. No title text returned.")
-        return answer_dict
-                
+            print(f"Chat history folding failed, sending the full history: {e}")
+            return
+        self._apply_history_fold(turns, digest)
 
+    async def get_response(self, user_text: str) -> str:
+        """
+        Send user input to the chat session and return the assistant's response.
 
+        Args:
+            user_text (str): The user's message to send to the assistant.
 
-    def get_doctor_report(self, visit_reason: str) -> dict[str, str]:
+        Returns:
+            str: The assistant's response text.
         """
-        Generate a clinical note split into reason (title), HPI, and Impression.
+        self._check_session()
+        await self._fold_history()
+        with span("llm.chat", model=self._model_name) as llm_span, account("chat", self._model_name, self._cache_tag) as call:
+            call.prompt_chars = self._chat_prompt_chars(user_text)
+            response = await self.chat_session.send_async(user_text)
+            self._record_exchange(llm_span, call, len(user_text), response)
+        return response
+
+    async def stream_response(self, user_text: str) -> AsyncIterator[str]:
+        """
+        Send user input to the chat session and yield the assistant's response as it is generated.
+        The exchange is only added to the chat history once the stream has been fully consumed.
 
         Args:
-            visit_reason (str): The reason for the patient's visit.
+            user_text (str): The user's message to send to the assistant.
+
+        Yields:
+            str: Consecutive chunks of the assistant's response text.
+        """
+        self._check_session()
+        await self._fold_history()
+        with span("llm.chat_stream", model=self._model_name) as llm_span, account("chat", self._model_name, self._cache_tag) as call:
+            call.prompt_chars = self._chat_prompt_chars(user_text)
+            chunks = []
+            async for chunk in self.chat_session.stream_async(user_text):
+                if not chunks:
+                    llm_span.set("first_chunk_seconds", round(time.perf_counter() - llm_span.start, 3))
+                chunks.append(chunk)
+                yield chunk
+            llm_span.set("chunks", len(chunks))
+            self._record_exchange(llm_span, call, len(user_text), "".join(chunks))
+
+    async def get_summary(self, timings: Optional[dict[str, float]] = None) -> dict[str, str]:
+        """
+        Summarize the current chat session as a concise medical interaction summary.
+        With structured_output, the summary and its title are first tried as a single JSON generation.
+
+        Args:
+            timings (Optional[dict[str, float]]): If given, receives the duration in seconds of the
+                'summary' and 'summary_title' stages, or of the 'summary_structured' stage.
 
         Returns:
-            dict: Dictionary with keys 'reason', 'HPI', and 'Impression'.
+            dict: A dictionary with keys 'title' and 'summary' for the current medical interaction.
+
+        Raises:
+            ValueError: If there is no chat turn since the last summary, or the generation failed.
         """
-        if not visit_reason:
-            raise ValueError("Visit reason must be provided for the doctor report.")
-        if not self.formatted_user_context_str or self.formatted_user_context_str == self._NO_CONTEXT_STRING:
-            raise ValueError("User context must be provided for the doctor report.")
+        timings = {} if timings is None else timings
+        prompt_for_summary = self._summary_prompt()
+        claim = self._claim_summary()
+        try:
+            if self.structured_output:
+                structured = self._parse_or_fall_back(
+                    await timed(timings, "summary_structured", self._generate(
+                        self._SUMMARY_STRUCTURED_SYSTEM_PROMPT, prompt_for_summary, "summary_structured",
+                        pinned=True, response_schema=self._SUMMARY_SCHEMA)),
+                    self._SUMMARY_SCHEMA, "summary_structured")
+                if structured is not None:
+                    return self._summary_dict(structured["summary"], structured["title"])
+            # the title is generated from the summary, so these two calls are inherently sequential
+            summary = await timed(timings, "summary", self._generate(self._SUMMARY_SYSTEM_PROMPT, prompt_for_summary, "summary", pinned=True))
+            title = await timed(timings, "summary_title", self._generate(self._SUMMARY_TITLE_SYSTEM_PROMPT, summary, "summary_title", pinned=True))
+            return self._summary_dict(summary, title)
+        except BaseException:
+            self._release_summary(claim)
+            raise
 
-        # 1. Generate Title (Reason)
-        title_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=self._DOCTOR_REPORT_REASON_TITLE_SYSTEM_PROMPT.format(visit_reason=visit_reason)
+    def _hpi_context(self, visit_reason: str, background: Optional[str] = None) -> str:
+        """
+        The part of the user context the HPI is built from: the past entries most relevant
+        to the visit reason (plus digests and background), or the whole context if retrieval is off.
+        """
+        with span("format.hpi_context", entries=len(self.user_context)) as format_span:
+            if not self._hpi_top_k:
+                text = self.user_context.text
+                text = f"{background}\n{text}" if background else text
+            else:
+                text = self.user_context.relevant_text(visit_reason, self._hpi_top_k, background=background)
+            format_span.set("context_chars", len(text))
+        return text
+
+    def _hpi_request(self, visit_reason: str, background: Optional[str] = None) -> tuple[str, str, Optional[PrefixKey]]:
+        """
+        The system instruction, prompt and prefix cache key of the HPI generation.
+        When the prefix cache is on, the visit reason moves from the instruction to the prompt, and with retrieval
+        so do the entries retrieved for it: the instruction then only holds what is the same for every report
+        of the patient, the whole history, or with retrieval the background and the digests.
+        """
+        if not prefix_cache.enabled:
+            return (
+                self._DOCTOR_REPORT_HPI_SYSTEM_PROMPT.format(user_context_string=self._hpi_context(visit_reason, background),
+                                                             visit_reason=visit_reason),
+                "Now generate the history of present illness.",
+                None
+            )
+        prompt = f"Current Reason for Visit: \"{visit_reason}\"\n"
+        if not self._hpi_top_k:
+            context = self._hpi_context(visit_reason, background)
+        else:
+            with span("format.hpi_context", entries=len(self.user_context)) as format_span:
+                stable = [background] if background else []
+                stable.extend(self.user_context.digest_lines())
+                entries = self.user_context.relevant_entries(visit_reason, self._hpi_top_k)
+                context = "\n".join(stable + [self._RETRIEVED_ENTRIES_IN_PROMPT])
+                prompt += "Past entries relevant to it:\n" + ("\n".join(entries) if entries else NO_CONTEXT_STRING) + "\n"
+                format_span.set("context_chars", len(context) + len(prompt))
+        return (
+            self._DOCTOR_REPORT_HPI_SYSTEM_PROMPT.format(user_context_string=context, visit_reason=self._VISIT_REASON_IN_PROMPT),
+            prompt + "Now generate the history of present illness.",
+            self._prefix_key("report_hpi", self._HPI_PROMPT_VERSION, context)
         )
+
+    async def get_report_reason(self, visit_reason: str) -> str:
+        """
+        Generate the concise 'reason for visit' title of the doctor report.
+
+        Args:
+            visit_reason (str): The reason for the patient's visit.
+
+        Returns:
+            str: The reason title.
+        """
         try:
-            title_response = title_model.generate_content("Generate a concise title for the reason for visit.")
-            title = title_response.text.strip()
+            return await self._generate(
+                self._DOCTOR_REPORT_REASON_TITLE_SYSTEM_PROMPT.format(visit_reason=visit_reason),
+                "Generate a concise title for the reason for visit.",
+                "report_reason"
+            )
         except Exception as e:
             raise RuntimeError("Failed to generate reason/title") from e
 
-        # 2. Generate HPI
-        hpi_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=self._DOCTOR_REPORT_HPI_SYSTEM_PROMPT.format(user_context_string=self.formatted_user_context_str, visit_reason=title)
-        )
+    async def _report_hpi(self, visit_reason: str, background: Optional[str] = None) -> str:
         try:
-            hpi_response = hpi_model.generate_content("Now generate the history of present illness.")
-            hpi = hpi_response.text.strip()
+            system_instruction, prompt, prefix = self._hpi_request(visit_reason, background)
+            return await self._generate(system_instruction, prompt, "report_hpi", prefix=prefix)
         except Exception as e:
             raise RuntimeError("Failed to generate HPI") from e
 
-        # 3. Generate Impression
-        impression_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=self._DOCTOR_REPORT_IMPRESSION_SYSTEM_PROMPT.format(
-                visit_reason=title,
-                hpi=hpi
+    async def _report_impression(self, title: str, hpi: str) -> str:
+        try:
+            return await self._generate(
+                self._DOCTOR_REPORT_IMPRESSION_SYSTEM_PROMPT.format(visit_reason=title, hpi=hpi),
+                "Now generate the overall impression.",
+                "report_impression"
             )
+        except Exception as e:
+            raise RuntimeError("Failed to generate Impression") from e
+
+    def _structured_report_instruction(self, visit_reason: str, background: Optional[str] = None) -> str:
+        return self._DOCTOR_REPORT_STRUCTURED_SYSTEM_PROMPT.format(
+            visit_reason=visit_reason,
+            user_context_string=self._hpi_context(visit_reason, background),
+            hpi="(the HPI you wrote in the 'HPI' field)"
         )
+
+    async def _structured_report(self, visit_reason: str, background: Optional[str] = None) -> Optional[dict[str, str]]:
         try:
-            impression_response = impression_model.generate_content("Now generate the overall impression.")
-            impression = impression_response.text.strip()
+            response = await self._generate(self._structured_report_instruction(visit_reason, background),
+                                            "Now generate the doctor's report.", "report_structured",
+                                            response_schema=self._REPORT_SCHEMA)
         except Exception as e:
-            raise RuntimeError("Failed to generate Impression") from e
+            raise RuntimeError("Failed to generate report") from e
+        return self._parse_or_fall_back(response, self._REPORT_SCHEMA, "report_structured")
 
+    async def get_doctor_report(self, visit_reason: str, reason: Optional[Awaitable[str]] = None,
+                                timings: Optional[dict[str, float]] = None, background: Optional[str] = None) -> dict[str, str]:
+        """
+        Generate a clinical note split into reason (title), HPI, and Impression.
+        With structured_output, the whole note is first tried as a single JSON generation.
+        Otherwise, or if its reply does not parse, the reason title and the HPI, which only depend
+        on the visit reason, are generated concurrently, then the impression from both.
+
+        Args:
+            visit_reason (str): The reason for the patient's visit.
+            reason (Optional[Awaitable[str]]): The reason title if the caller already started
+                generating it (see get_report_reason); generated here otherwise.
+                Passing it skips the structured generation.
+            timings (Optional[dict[str, float]]): If given, receives the duration in seconds of the
+                'reason', 'hpi' and 'impression' stages, or of the 'report_structured' stage.
+            background (Optional[str]): Patient background (e.g. chronic conditions) given to the HPI
+                along with the retrieved past entries.
+
+        Returns:
+            dict: Dictionary with keys 'reason', 'HPI', and 'Impression'.
+        """
+        timings = {} if timings is None else timings
+        self._check_report_inputs(visit_reason)
+        if self.structured_output and reason is None:
+            report = await timed(timings, "report_structured", self._structured_report(visit_reason, background))
+            if report is not None:
+                return report
+        if reason is None:
+            reason = timed(timings, "reason", self.get_report_reason(visit_reason))
+        title, hpi = await asyncio.gather(reason, timed(timings, "hpi", self._report_hpi(visit_reason, background)))
+        impression = await timed(timings, "impression", self._report_impression(title, hpi))
         return {
             "reason": title,
             "HPI": hpi,
             "impression": impression
         }
 
-
     def reset_symptom_session(self, new_user_context: Optional[Any] = None) -> None:
         """
         Reset the symptom chat session, optionally updating the user context.
@@ -337,21 +823,16 @@ class LLMManager:
             None
         """
         if new_user_context is not None:
-            self.formatted_user_context_str = self.__format_user_context(new_user_context)
-        
-        current_symptom_prompt = self._SYMPTOM_SYSTEM_PROMPT_TEMPLATE.format(
-            end_text=self._end_text,
-            user_context_string=self.formatted_user_context_str
-        )
-        self.symptom_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=current_symptom_prompt
-        )
-        self.chat_session = self.symptom_model.start_chat(history=[])
+            self.user_context.replace(new_user_context)
+        self.summarized_turns = 0
+        self.chat_digest = ""
+        self.digested_turns = 0
+        self._restart_chat_session(history=[])
 
-    def extend_user_context(self, new_context_entries: Any) -> None:
+    async def extend_user_context(self, new_context_entries: Any) -> None:
         """
-        Extend the user context with new entries and update the chat session.
+        Extend the user context with new entries.
+        The chat session switches to the extended context before its next message, keeping its history.
 
         Args:
             new_context_entries (Any): New context information to append to the existing user context.
@@ -359,29 +840,14 @@ class LLMManager:
         Returns:
             None
         """
-        new_context_string = self.__format_user_context(new_context_entries)
-        if not new_context_string or new_context_string == self._NO_CONTEXT_STRING:
-            return
-        if not self.formatted_user_context_str or self.formatted_user_context_str == self._NO_CONTEXT_STRING:
-            self.formatted_user_context_str = new_context_string
-        elif self.formatted_user_context_str != self._NO_CONTEXT_STRING:
-            self.formatted_user_context_str += "\n" + new_context_string
-
-        # Update system prompt for symptom model and re-initialize session with current history
-        current_symptom_prompt = self._SYMPTOM_SYSTEM_PROMPT_TEMPLATE.format(
-            end_text=self._end_text,
-            user_context_string=self.formatted_user_context_str
-        )
-        current_history = self.chat_session.history if self.chat_session else []
-        self.symptom_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=current_symptom_prompt
-        )
-        self.chat_session = self.symptom_model.start_chat(history=current_history)
+        if self.user_context.append(new_context_entries):
+            await self._invalidate_cached_history()
+            self._apply_context_change()
 
-    def replace_user_context(self, new_full_context: Any) -> None:
+    async def replace_user_context(self, new_full_context: Any) -> None:
         """
-        Replace the user context entirely and update the chat session.
+        Replace the user context entirely.
+        The chat session switches to the new context before its next message, keeping its history.
 
         Args:
             new_full_context (Any): The new user context to replace the existing context.
@@ -389,15 +855,42 @@ class LLMManager:
         Returns:
             None
         """
-        self.formatted_user_context_str = self.__format_user_context(new_full_context)
-        current_symptom_prompt = self._SYMPTOM_SYSTEM_PROMPT_TEMPLATE.format(
-            end_text=self._end_text,
-            user_context_string=self.formatted_user_context_str
-        )
-        current_history = self.chat_session.history if self.chat_session else []
-        self.symptom_model = genai.GenerativeModel(
-            model_name=self._model_name,
-            system_instruction=current_symptom_prompt
-        )
-        self.chat_session = self.symptom_model.start_chat(history=current_history)
+        self.user_context.replace(new_full_context)
+        await self._invalidate_cached_history()
+        self._apply_context_change()
+
+
+
+    def export_history(self) -> List[List[str]]:
+        """
+        The turns of the current chat session as JSON-serializable [role, text] pairs, see restore_state.
+        If turns were folded into the chat digest, the history starts with a ['digest', digest, turn count] entry.
+
+        Returns:
+            List[List[str]]: The chat history, oldest turn first.
+        """
+        self._check_session()
+        history = [[turn.role, turn.text] for turn in self.chat_session.history]
+        if self.chat_digest:
+            history.insert(0, ["digest", self.chat_digest, str(self.digested_turns)])
+        return history
 
+    def restore_state(self, history: List[List[str]], user_context: Optional[UserContext] = None) -> None:
+        """
+        Resume a chat session saved with export_history, possibly by another process.
+        The restored session is started with the current user context.
+
+        Args:
+            history (List[List[str]]): The chat turns, as returned by export_history.
+            user_context (Optional[UserContext]): The user context to resume with, if it changed.
+
+        Returns:
+            None
+        """
+        if user_context is not None:
+            self.user_context = user_context
+        self.chat_digest, self.digested_turns = "", 0
+        if history and history[0][0] == "digest":
+            self.chat_digest, self.digested_turns = history[0][1], int(history[0][2])
+            history = history[1:]
+        self._restart_chat_session(history=[ChatTurn(role, text) for role, text in history])
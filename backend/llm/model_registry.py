@@ -0,0 +1,93 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import google.generativeai as genai
+
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", 256))
+
+_configured_api_key = None
+_configure_lock = threading.Lock()
+
+
+def configure(api_key: str) -> None:
+    """
+    Configure the Gemini SDK once per process, instead of on every LLMManager construction.
+    Reconfigures only if a different api key is passed.
+    """
+    global _configured_api_key
+    # imported here rather than with the module, so the app starts without paying for the SDK until Gemini is used
+    import google.generativeai as genai
+    with _configure_lock:
+        if _configured_api_key != api_key:
+            genai.configure(api_key=api_key)
+            _configured_api_key = api_key
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of GenerativeModel instances keyed by (model_name, system_instruction).
+
+    Models for static system prompts are pinned and live for the whole process.
+    Models for templated prompts (filled with a visit reason or patient context)
+    are kept in a bounded LRU, so one-off prompts can't grow the registry without limit.
+    """
+
+    def __init__(self, max_size: int = MODEL_CACHE_SIZE):
+        self._max_size = max_size
+        self._pinned: dict[tuple[str, str], "genai.GenerativeModel"] = {}
+        self._models: OrderedDict[tuple[str, str], "genai.GenerativeModel"] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model_name: str, system_instruction: str, pinned: bool = False) -> "genai.GenerativeModel":
+        """
+        Return the model for (model_name, system_instruction), building it on first use.
+
+        Args:
+            model_name (str): The Gemini model name.
+            system_instruction (str): The system prompt of the model.
+            pinned (bool): Whether the prompt is static and the model should never be evicted.
+
+        Returns:
+            genai.GenerativeModel: The shared model instance.
+        """
+        key = (model_name, system_instruction)
+        with self._lock:
+            model = self._pinned.get(key)
+            if model is None:
+                model = self._models.get(key)
+                if model is not None:
+                    self._models.move_to_end(key)
+            if model is not None:
+                self.hits += 1
+                return model
+            self.misses += 1
+            import google.generativeai as genai
+            model = genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+            if pinned:
+                self._pinned[key] = model
+            else:
+                self._models[key] = model
+                while len(self._models) > self._max_size:
+                    self._models.popitem(last=False)
+                    self.evictions += 1
+            return model
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pinned": len(self._pinned),
+                "cached": len(self._models),
+                "max_size": self._max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+models = ModelRegistry()
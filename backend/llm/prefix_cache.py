@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, NamedTuple, Optional
+
+from llm.user_context import estimate_tokens
+from telemetry.metrics import metrics
+
+# keep the large stable system prompts (symptom interview, HPI with the patient history) as provider-side cached content
+LLM_PREFIX_CACHE = os.getenv("LLM_PREFIX_CACHE", "false").lower() in ("1", "true", "yes")
+LLM_PREFIX_CACHE_TTL = float(os.getenv("LLM_PREFIX_CACHE_TTL", 15 * 60))  # seconds
+# cached prefixes alive per worker
+LLM_PREFIX_CACHE_SIZE = int(os.getenv("LLM_PREFIX_CACHE_SIZE", 256))
+# approximate tokens below which a prefix is sent as is; the provider refuses to cache small contents
+LLM_PREFIX_CACHE_MIN_TOKENS = int(os.getenv("LLM_PREFIX_CACHE_MIN_TOKENS", 1024))
+# a handle is no longer handed out this many seconds before the provider expires it, so calls in flight can finish
+_EXPIRY_MARGIN = 30.0
+
+prefix_requests = metrics.counter("llm_prefix_cache_requests_total",
+                                  "Cached prefix lookups, by prompt and result (hit, seen, created, failed).")
+
+
+def prompt_version(template: str) -> str:
+    """
+    Version of a prompt template: changes whenever its text does.
+    """
+    return hashlib.sha1(template.encode()).hexdigest()[:12]
+
+
+def context_hash(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class PrefixKey(NamedTuple):
+    """
+    Identifies a cacheable system prompt: which prompt, its template version, and a hash of the
+    patient context it was rendered with. tag, e.g. the patient id, groups the prefixes to drop
+    together when that patient's history changes. It is part of the key, so prefixes are never
+    shared between tags and dropping one tag's prefixes leaves the others cached.
+    """
+    prompt: str
+    version: str
+    context: str
+    tag: Optional[str] = None
+
+
+class PrefixStore(ABC):
+    """
+    Where cached prefixes live: the provider's cached content, or a local stand-in.
+    """
+
+    @abstractmethod
+    def create(self, model_name: str, system_instruction: str, ttl: float) -> Any:
+        """
+        Caches system_instruction for model_name for ttl seconds and returns the handle the backend calls the model with.
+        """
+
+    @abstractmethod
+    def delete(self, handle: Any) -> None:
+        ...
+
+
+class LocalPrefixStore(PrefixStore):
+    """
+    In-process stand-in for provider-side caching, for the stub backend and tests:
+    handles are names of the cached instructions it keeps.
+    """
+
+    def __init__(self):
+        self.contents: dict[str, str] = {}
+        self.created = 0
+        self._lock = threading.Lock()
+
+    def create(self, model_name: str, system_instruction: str, ttl: float) -> str:
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/local-{self.created}"
+            self.contents[name] = system_instruction
+        return name
+
+    def delete(self, handle: str) -> None:
+        with self._lock:
+            self.contents.pop(handle, None)
+
+
+class _Prefix(NamedTuple):
+    handle: Any
+    tag: Optional[str]
+    expires: float
+
+
+class PrefixCache:
+    """
+    Process-wide registry of cached prefixes, by PrefixKey and model.
+
+    A prefix is created in the store the second time its key is asked for within the ttl, so one-off
+    prompts are never paid for, and reused until it expires or invalidate(tag) drops it. Prefixes
+    under min_tokens are not cached. The store is set by the backend, see configure; until then,
+    and while LLM_PREFIX_CACHE is off, every lookup misses and callers send the full instruction.
+    """
+
+    def __init__(self, enabled: bool = LLM_PREFIX_CACHE, max_size: int = LLM_PREFIX_CACHE_SIZE,
+                 ttl: float = LLM_PREFIX_CACHE_TTL, min_tokens: int = LLM_PREFIX_CACHE_MIN_TOKENS):
+        self.enabled = enabled
+        self._store: Optional[PrefixStore] = None
+        self._max_size = max_size
+        self._ttl = ttl
+        self._min_tokens = min_tokens
+        self._prefixes: OrderedDict[tuple, _Prefix] = OrderedDict()
+        # keys asked for once, with the time after which that no longer counts and their tag
+        self._seen: OrderedDict[tuple, tuple[float, Optional[str]]] = OrderedDict()
+        self._creating: set[tuple] = set()
+        # keys dropped by invalidate, never cached again: a chat started before the change may still ask for them
+        self._retired: OrderedDict[tuple, None] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.created = 0
+        self.failures = 0
+        self.invalidated = 0
+
+    def configure(self, store: PrefixStore) -> None:
+        with self._lock:
+            self._store = store
+
+    def _claim(self, model_name: str, system_instruction: str, key: PrefixKey) -> tuple[Any, bool]:
+        """
+        Returns (handle, False) for a live prefix, (None, True) if the caller should create it, (None, False) otherwise.
+        """
+        if not self.enabled or self._store is None or estimate_tokens(system_instruction) < self._min_tokens:
+            return None, False
+        cache_key = (model_name, *key)
+        now = time.time()
+        with self._lock:
+            prefix = self._prefixes.get(cache_key)
+            if prefix is not None and prefix.expires > now:
+                self._prefixes.move_to_end(cache_key)
+                self.hits += 1
+                prefix_requests.inc(prompt=key.prompt, result="hit")
+                return prefix.handle, False
+            if prefix is not None:
+                del self._prefixes[cache_key]
+            if cache_key in self._creating or cache_key in self._retired:
+                # another call is creating it, or its context is outdated: this one goes uncached
+                return None, False
+            if self._seen.pop(cache_key, (0.0, None))[0] <= now:
+                self._seen[cache_key] = (now + self._ttl, key.tag)
+                while len(self._seen) > self._max_size:
+                    self._seen.popitem(last=False)
+                prefix_requests.inc(prompt=key.prompt, result="seen")
+                return None, False
+            self._creating.add(cache_key)
+            return None, True
+
+    def _create(self, model_name: str, system_instruction: str, key: PrefixKey) -> Any:
+        cache_key = (model_name, *key)
+        evicted = []
+        try:
+            handle = self._store.create(model_name, system_instruction, self._ttl)
+        except Exception as e:
+            print(f"Prefix caching failed for {key.prompt}, sending the full instruction: {e}")
+            with self._lock:
+                self._creating.discard(cache_key)
+                self.failures += 1
+            prefix_requests.inc(prompt=key.prompt, result="failed")
+            return None
+        with self._lock:
+            self._creating.discard(cache_key)
+            self._prefixes[cache_key] = _Prefix(handle, key.tag, time.time() + self._ttl - _EXPIRY_MARGIN)
+            while len(self._prefixes) > self._max_size:
+                evicted.append(self._prefixes.popitem(last=False)[1].handle)
+            self.created += 1
+        prefix_requests.inc(prompt=key.prompt, result="created")
+        self._delete(evicted)
+        return handle
+
+    def get(self, model_name: str, system_instruction: str, key: PrefixKey) -> Any:
+        """
+        Returns the handle of the cached prefix for key, creating it if it is due, or None to send the full instruction.
+        """
+        handle, create = self._claim(model_name, system_instruction, key)
+        if create:
+            handle = self._create(model_name, system_instruction, key)
+        return handle
+
+    async def aget(self, model_name: str, system_instruction: str, key: PrefixKey) -> Any:
+        """
+        Async variant of get, creating the prefix in a thread.
+        """
+        handle, create = self._claim(model_name, system_instruction, key)
+        if create:
+            handle = await asyncio.to_thread(self._create, model_name, system_instruction, key)
+        return handle
+
+    def invalidate(self, tag: str) -> int:
+        """
+        Drops every prefix with tag, e.g. because the patient's history changed, and returns how many there were.
+        """
+        with self._lock:
+            keys = [key for key, prefix in self._prefixes.items() if prefix.tag == tag]
+            handles = [self._prefixes.pop(key).handle for key in keys]
+            seen = [key for key, (_, seen_tag) in self._seen.items() if seen_tag == tag]
+            for key in seen:
+                del self._seen[key]
+            for key in keys + seen:
+                self._retired[key] = None
+            while len(self._retired) > self._max_size:
+                self._retired.popitem(last=False)
+            self.invalidated += len(handles)
+        self._delete(handles)
+        return len(handles)
+
+    def _delete(self, handles: list) -> None:
+        # deleting is a provider call, run off the caller's thread (or event loop); unused prefixes expire anyway
+        if not handles or self._store is None:
+            return
+        store = self._store
+
+        def delete_all() -> None:
+            for handle in handles:
+                try:
+                    store.delete(handle)
+                except Exception as e:
+                    print(f"Deleting cached prefix failed, it will expire: {e}")
+
+        threading.Thread(target=delete_all, name="prefix-cache-delete", daemon=True).start()
+
+    def __len__(self) -> int:
+        return len(self._prefixes)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled and self._store is not None,
+                "size": len(self._prefixes),
+                "max_size": self._max_size,
+                "ttl": self._ttl,
+                "min_tokens": self._min_tokens,
+                "hits": self.hits,
+                "created": self.created,
+                "failures": self.failures,
+                "invalidated": self.invalidated,
+            }
+
+
+prefix_cache = PrefixCache()
+metrics.gauge("llm_prefix_cache_size", "Cached prefixes alive in this worker.", function=lambda: len(prefix_cache))
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from telemetry.metrics import metrics
+
+# generations kept in memory per worker, 0 disables the cache
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 2048))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 60 * 60))  # seconds
+# SQLite file of the on-disk tier, shared by workers and kept across restarts; unset keeps the cache in memory only
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")
+
+cache_requests = metrics.counter("llm_cache_requests_total", "LLM response cache lookups, by call site and result.")
+
+
+def cache_key(model_name: str, system_instruction: str, prompt: str, config: Optional[dict[str, Any]] = None) -> str:
+    """
+    Content address of a generation: a hash of everything its output depends on.
+    """
+    payload = json.dumps([model_name, system_instruction, prompt, config], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache of LLM generations by content address (see cache_key), in a bounded in-memory LRU
+    and optionally an SQLite file that survives restarts.
+
+    Entries can carry a tag, such as the patient whose history they were generated from,
+    and invalidate(tag) drops every entry with that tag from both tiers.
+    """
+
+    def __init__(self, max_size: int = LLM_CACHE_SIZE, ttl: float = LLM_CACHE_TTL, path: Optional[str] = LLM_CACHE_PATH):
+        self._max_size = max_size
+        self._ttl = ttl
+        # key -> (value, tag, expiry time), least recently used first
+        self._entries: OrderedDict[str, tuple[str, Optional[str], float]] = OrderedDict()
+        self._tags: dict[str, set[str]] = {}
+        self._lock = threading.Lock()
+        self._disk: Optional[sqlite3.Connection] = None
+        self._disk_lock = threading.Lock()
+        if path and max_size > 0:
+            self._disk = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            with self._disk_lock:
+                self._disk.execute("PRAGMA journal_mode=WAL")
+                self._disk.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache ("
+                    " key TEXT PRIMARY KEY, value TEXT NOT NULL, tag TEXT, expires REAL NOT NULL)"
+                )
+                self._disk.execute("CREATE INDEX IF NOT EXISTS llm_cache_tag ON llm_cache (tag)")
+                self._disk.execute("DELETE FROM llm_cache WHERE expires < ?", (time.time(),))
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size > 0
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        with self._disk_lock:
+            row = self._disk.execute("SELECT value, tag, expires FROM llm_cache WHERE key = ? AND expires >= ?",
+                                     (key, time.time())).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._set_memory(key, row[0], row[1], row[2])
+        with self._lock:
+            self.disk_hits += 1
+        return row[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached generation, or None.
+        """
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        if self._disk is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return self._get_disk(key)
+
+    async def aget(self, key: str) -> Optional[str]:
+        """
+        Async variant of get, reading the on-disk tier in a thread.
+        """
+        if not self.enabled:
+            return None
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        if self._disk is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return await asyncio.to_thread(self._get_disk, key)
+
+    def _set_memory(self, key: str, value: str, tag: Optional[str], expires: float) -> None:
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, tag, expires)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self._max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _set_disk(self, key: str, value: str, tag: Optional[str], expires: float) -> None:
+        with self._disk_lock:
+            self._disk.execute("INSERT OR REPLACE INTO llm_cache (key, value, tag, expires) VALUES (?, ?, ?, ?)",
+                               (key, value, tag, expires))
+
+    def set(self, key: str, value: str, tag: Optional[str] = None) -> None:
+        if not self.enabled:
+            return
+        expires = time.time() + self._ttl
+        self._set_memory(key, value, tag, expires)
+        if self._disk is not None:
+            self._set_disk(key, value, tag, expires)
+
+    async def aset(self, key: str, value: str, tag: Optional[str] = None) -> None:
+        """
+        Async variant of set, writing the on-disk tier in a thread.
+        """
+        if not self.enabled:
+            return
+        expires = time.time() + self._ttl
+        self._set_memory(key, value, tag, expires)
+        if self._disk is not None:
+            await asyncio.to_thread(self._set_disk, key, value, tag, expires)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[1] is not None:
+            keys = self._tags.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[entry[1]]
+
+    def _invalidate_memory(self, tag: str) -> None:
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def _invalidate_disk(self, tag: str) -> None:
+        with self._disk_lock:
+            self._disk.execute("DELETE FROM llm_cache WHERE tag = ?", (tag,))
+
+    def invalidate(self, tag: str) -> None:
+        """
+        Drops every entry stored with tag.
+        """
+        if not self.enabled:
+            return
+        self._invalidate_memory(tag)
+        if self._disk is not None:
+            self._invalidate_disk(tag)
+
+    async def ainvalidate(self, tag: str) -> None:
+        """
+        Async variant of invalidate, deleting from the on-disk tier in a thread.
+        """
+        if not self.enabled:
+            return
+        self._invalidate_memory(tag)
+        if self._disk is not None:
+            await asyncio.to_thread(self._invalidate_disk, tag)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self._max_size,
+                "ttl": self._ttl,
+                "disk": self._disk is not None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,66 @@
+import math
+import re
+from collections import Counter
+from typing import Hashable
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "i", "in", "is", "it",
+    "its", "my", "of", "on", "or", "reports", "that", "the", "this", "to", "was", "were", "with",
+))
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercase word tokens of text, without stopwords.
+    """
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in _STOPWORDS]
+
+
+class BM25Index:
+    """
+    Incremental Okapi BM25 index over short documents, such as symptom entries.
+
+    Documents are added one at a time and kept in an inverted index, so a search
+    only scores the documents that share a term with the query.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self._k1 = k1
+        self._b = b
+        # term -> {doc_id: term frequency}
+        self._postings: dict[str, dict[Hashable, int]] = {}
+        self._lengths: dict[Hashable, int] = {}
+        self._total_length = 0
+
+    def add(self, doc_id: Hashable, text: str) -> None:
+        if doc_id in self._lengths:
+            raise ValueError(f"Document {doc_id!r} is already indexed")
+        tokens = tokenize(text)
+        for term, frequency in Counter(tokens).items():
+            self._postings.setdefault(term, {})[doc_id] = frequency
+        self._lengths[doc_id] = len(tokens)
+        self._total_length += len(tokens)
+
+    def search(self, query: str, k: int) -> list[tuple[Hashable, float]]:
+        """
+        Returns the (doc_id, score) of the k best matching documents, best first.
+        Documents that share no term with the query are never returned.
+        """
+        if not self._lengths or k <= 0:
+            return []
+        doc_count = len(self._lengths)
+        average_length = self._total_length / doc_count or 1
+        scores: dict[Hashable, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                length_norm = 1 - self._b + self._b * self._lengths[doc_id] / average_length
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self._k1 + 1) / (frequency + self._k1 * length_norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def __len__(self) -> int:
+        return len(self._lengths)
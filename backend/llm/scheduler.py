@@ -0,0 +1,364 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from llm.user_context import estimate_tokens
+from telemetry.metrics import metrics
+
+# provider quotas of the API key, shared by every worker process using it; 0 disables the limit
+LLM_RPM = float(os.getenv("LLM_RPM", 1000))  # requests per minute
+LLM_TPM = float(os.getenv("LLM_TPM", 1_000_000))  # estimated prompt and response tokens per minute
+# calls in flight at once per worker, halved on every rate limit error and grown back on success
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", 3))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", 0.5))  # seconds, doubled on every retry
+LLM_RETRY_BACKOFF_MAX = float(os.getenv("LLM_RETRY_BACKOFF_MAX", 8))  # seconds
+
+# lanes in priority order: the patient waits on chat turns, then on doctor reports
+LANES = ("interactive", "report", "background")
+CALL_SITE_LANES = {
+    "chat": "interactive",
+    # folds the oldest turns of a chat before its next message is sent
+    "chat_digest": "interactive",
+    "report_reason": "report",
+    "report_hpi": "report",
+    "report_impression": "report",
+    "report_structured": "report",
+}
+# HTTP status codes of provider errors worth retrying: rate limited, overloaded or timed out
+RETRIABLE_CODES = frozenset((429, 500, 503, 504))
+
+queue_wait = metrics.histogram("llm_queue_wait_seconds", "Time LLM calls waited for a slot and for the rate limits, by lane.")
+llm_retries = metrics.counter("llm_retries_total", "LLM calls retried after a retriable provider error, by call site and code.")
+llm_overloaded = metrics.counter("llm_overloaded_total", "LLM calls given up after LLM_RETRIES retries, by call site.")
+
+
+class LLMOverloaded(Exception):
+    """
+    Raised when an LLM call still fails with a retriable error (e.g. 429) after every retry.
+    retry_after is a hint, in seconds, for when the caller may try again.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def error_code(error: Exception) -> Optional[int]:
+    """
+    The HTTP status code of a provider error, as google.api_core exceptions carry it, or None.
+    """
+    code = getattr(error, "code", None)
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Rate limit of per_minute units per minute, allowing bursts of up to a minute's worth.
+    A disabled bucket (per_minute <= 0) never makes callers wait.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self._rate = per_minute / 60
+        self._tokens = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.per_minute, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        Takes amount units, going into debt if there are not enough,
+        and returns the seconds to wait until the debt is paid back.
+        """
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill(now)
+        self._tokens -= min(amount, self.per_minute)
+        return 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+
+    def charge(self, amount: float, now: float) -> None:
+        """
+        Takes amount units without waiting, e.g. for tokens only known once the response arrived.
+        """
+        if self.per_minute <= 0:
+            return
+        self._refill(now)
+        self._tokens -= amount
+
+
+class LLMScheduler:
+    """
+    Admission control for outbound LLM calls, shared by every LLMManager of the process.
+
+    A call first waits for one of the concurrency slots, which are handed out by lane priority
+    (chat turns before doctor reports before summaries and digests, first come first served within
+    a lane), then for the request and token rate limits. Calls failing with a retriable provider error
+    are retried with jittered exponential backoff; a rate limit error also pauses every call for the
+    backoff delay and halves the concurrency limit, which grows back by one slot per limit successes.
+
+    Works from threads and from the event loop alike.
+    """
+
+    def __init__(self, rpm: float = LLM_RPM, tpm: float = LLM_TPM, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 retries: int = LLM_RETRIES, backoff: float = LLM_RETRY_BACKOFF, backoff_max: float = LLM_RETRY_BACKOFF_MAX):
+        if max_concurrency <= 0:
+            raise ValueError("max_concurrency must be a positive integer")
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._max_concurrency = max_concurrency
+        self._limit = float(max_concurrency)
+        self._retries = retries
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._active = 0
+        # [priority, sequence, wake, granted] - heap of the calls waiting for a slot
+        self._waiters: list[list] = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self.succeeded = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    @staticmethod
+    def lane(call_site: str) -> str:
+        return CALL_SITE_LANES.get(call_site, "background")
+
+    # slots
+
+    def _try_acquire(self, priority: int) -> bool:
+        # called with the lock held; calls of a lane never overtake queued calls of the same or a higher lane
+        if self._active < int(self._limit) and not (self._waiters and self._waiters[0][0] <= priority):
+            self._active += 1
+            return True
+        return False
+
+    def _enqueue(self, priority: int, wake: Callable[[], None]) -> list:
+        entry = [priority, next(self._sequence), wake, False]
+        heapq.heappush(self._waiters, entry)
+        return entry
+
+    def _wake_waiters(self) -> None:
+        # called with the lock held
+        while self._waiters and self._active < int(self._limit):
+            entry = heapq.heappop(self._waiters)
+            entry[3] = True
+            self._active += 1
+            entry[2]()
+
+    def _release(self) -> None:
+        with self._lock:
+            self._active -= 1
+            self._wake_waiters()
+
+    def _abandon(self, entry: list) -> None:
+        # a waiting call gave up: take it out of the queue, or hand on the slot it was just granted
+        with self._lock:
+            if entry[3]:
+                self._active -= 1
+                self._wake_waiters()
+            else:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+
+    def _admission_delay(self, prompt_tokens: int) -> float:
+        now = time.monotonic()
+        with self._lock:
+            return max(self._paused_until - now,
+                       self._requests.reserve(1, now),
+                       self._tokens.reserve(prompt_tokens, now))
+
+    def _acquire(self, lane: str, prompt_tokens: int) -> None:
+        start = time.monotonic()
+        priority = LANES.index(lane)
+        with self._lock:
+            event = None
+            if not self._try_acquire(priority):
+                event = threading.Event()
+                self._enqueue(priority, event.set)
+        if event is not None:
+            event.wait()
+        try:
+            delay = self._admission_delay(prompt_tokens)
+            if delay > 0:
+                time.sleep(delay)
+        except BaseException:
+            self._release()
+            raise
+        queue_wait.observe(time.monotonic() - start, lane=lane)
+
+    async def _acquire_async(self, lane: str, prompt_tokens: int) -> None:
+        start = time.monotonic()
+        priority = LANES.index(lane)
+        with self._lock:
+            future = entry = None
+            if not self._try_acquire(priority):
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                entry = self._enqueue(priority, lambda: loop.call_soon_threadsafe(_resolve, future))
+        if future is not None:
+            try:
+                await future
+            except asyncio.CancelledError:
+                self._abandon(entry)
+                raise
+        try:
+            delay = self._admission_delay(prompt_tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            self._release()
+            raise
+        queue_wait.observe(time.monotonic() - start, lane=lane)
+
+    # outcomes
+
+    def _succeeded(self, response_tokens: int) -> None:
+        with self._lock:
+            self.succeeded += 1
+            self._tokens.charge(response_tokens, time.monotonic())
+            if self._limit < self._max_concurrency:
+                self._limit = min(self._max_concurrency, self._limit + 1 / self._limit)
+                self._wake_waiters()
+
+    def _retry_delay(self, error: Exception, attempt: int, call_site: str) -> float:
+        """
+        Returns the backoff before retrying after error, or raises if it is not worth retrying.
+        """
+        code = error_code(error)
+        if code not in RETRIABLE_CODES:
+            raise error
+        delay = random.uniform(0, min(self._backoff_max, self._backoff * 2 ** attempt))
+        with self._lock:
+            if code == 429:
+                self.rate_limited += 1
+                self._limit = max(1.0, self._limit / 2)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        if attempt >= self._retries:
+            llm_overloaded.inc(call_site=call_site)
+            raise LLMOverloaded(f"The LLM provider is unavailable ({code}), retry later", retry_after=self._backoff_max) from error
+        with self._lock:
+            self.retries += 1
+        llm_retries.inc(call_site=call_site, code=str(code))
+        print(f"LLM call {call_site} failed with {code}, retrying in {delay:.2f}s (attempt {attempt + 1}/{self._retries})")
+        return delay
+
+    # calls
+
+    def call(self, call_site: str, prompt_tokens: int, run: Callable[[], str]) -> str:
+        """
+        Runs the blocking LLM call run() once admitted, retrying it on retriable errors.
+
+        Args:
+            call_site (str): What the call is for (e.g. 'chat', 'summary'), which picks its lane.
+            prompt_tokens (int): Estimated tokens sent, counted against the token rate limit.
+            run (Callable[[], str]): Makes the call and returns the reply text.
+
+        Returns:
+            str: The reply text.
+
+        Raises:
+            LLMOverloaded: If the call still failed with a retriable error after every retry.
+        """
+        lane = self.lane(call_site)
+        for attempt in itertools.count():
+            self._acquire(lane, prompt_tokens)
+            try:
+                response = run()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, call_site)
+            else:
+                self._succeeded(estimate_tokens(response))
+                return response
+            finally:
+                self._release()
+            time.sleep(delay)
+
+    async def call_async(self, call_site: str, prompt_tokens: int, run: Callable[[], Awaitable[str]]) -> str:
+        """
+        Async variant of call.
+        """
+        lane = self.lane(call_site)
+        for attempt in itertools.count():
+            await self._acquire_async(lane, prompt_tokens)
+            try:
+                response = await run()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, call_site)
+            else:
+                self._succeeded(estimate_tokens(response))
+                return response
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    async def stream_async(self, call_site: str, prompt_tokens: int, run: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Streaming variant of call_async, holding the slot until the stream ends.
+        The call is only retried while it has not yielded anything.
+        """
+        lane = self.lane(call_site)
+        for attempt in itertools.count():
+            await self._acquire_async(lane, prompt_tokens)
+            response_chars = 0
+            try:
+                async for chunk in run():
+                    response_chars += len(chunk)
+                    yield chunk
+            except Exception as e:
+                if response_chars:
+                    raise
+                delay = self._retry_delay(e, attempt, call_site)
+            else:
+                self._succeeded(response_chars // 4)
+                return
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return len(self._waiters)
+
+    @property
+    def active(self) -> int:
+        with self._lock:
+            return self._active
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": len(self._waiters),
+                "queued_by_lane": {lane: sum(1 for entry in self._waiters if entry[0] == index) for index, lane in enumerate(LANES)},
+                "concurrency_limit": int(self._limit),
+                "max_concurrency": self._max_concurrency,
+                "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 3),
+                "rpm": self._requests.per_minute,
+                "tpm": self._tokens.per_minute,
+                "succeeded": self.succeeded,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+            }
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+llm_scheduler = LLMScheduler()
+metrics.gauge("llm_calls_active", "LLM calls in flight.", function=lambda: llm_scheduler.active)
+metrics.gauge("llm_calls_queued", "LLM calls waiting for a slot.", function=lambda: llm_scheduler.queued)
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import math
+import os
+import random
+import re
+from typing import AsyncIterator, List, Optional
+
+from llm.backends import ChatSession, ChatTurn, LLMBackend
+from llm.prefix_cache import LocalPrefixStore, PrefixKey, prefix_cache
+from llm.usage import report_usage
+from llm.user_context import estimate_tokens
+
+# latency specs, see LatencyModel.parse
+STUB_LLM_CHAT_LATENCY = os.getenv("STUB_LLM_CHAT_LATENCY", "lognormal:0.8:0.4")
+STUB_LLM_GENERATE_LATENCY = os.getenv("STUB_LLM_GENERATE_LATENCY", "lognormal:1.5:0.4")
+# delay between two streamed chunks
+STUB_LLM_CHUNK_LATENCY = os.getenv("STUB_LLM_CHUNK_LATENCY", "fixed:0.05")
+# number of follow-up questions asked before the chat ends with the end text
+STUB_LLM_TURNS = int(os.getenv("STUB_LLM_TURNS", 3))
+STUB_LLM_END_TEXT = os.getenv("STUB_LLM_END_TEXT", "<END_REPORT>")
+STUB_LLM_SEED = os.getenv("STUB_LLM_SEED")
+# share of calls failing with a simulated 429 rate limit error, to exercise the retries of the LLM scheduler
+STUB_LLM_ERROR_RATE = float(os.getenv("STUB_LLM_ERROR_RATE", 0))
+# optional JSON file overriding the scripted replies: {"chat": [...], "generate": {call_site: text}}
+STUB_LLM_SCRIPT = os.getenv("STUB_LLM_SCRIPT")
+
+_FINISHED_RE = re.compile(r"\b(no|nothing|that's all|that is all|done|finished)\b", re.IGNORECASE)
+_CHUNK_WORDS = 4
+
+
+class StubRateLimitError(Exception):
+    """
+    Simulated provider rate limit error, with the status code google.api_core errors carry.
+    """
+    code = 429
+
+
+class LatencyModel:
+    """
+    Distribution of simulated call latencies, in seconds.
+    """
+
+    def __init__(self, distribution: str = "fixed", a: float = 0.0, b: float = 0.0, rng: Optional[random.Random] = None):
+        if distribution not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution {distribution!r}, expected 'fixed', 'uniform' or 'lognormal'")
+        self.distribution = distribution
+        self.a = a
+        self.b = b
+        self._rng = rng or random.Random()
+
+    @classmethod
+    def parse(cls, spec: str, rng: Optional[random.Random] = None) -> "LatencyModel":
+        """
+        Parses 'fixed:SECONDS', 'uniform:LOW:HIGH' or 'lognormal:MEDIAN:SIGMA'.
+        """
+        name, *params = spec.split(":")
+        values = [float(param) for param in params] + [0.0, 0.0]
+        return cls(name, values[0], values[1], rng)
+
+    def sample(self) -> float:
+        if self.distribution == "uniform":
+            return self._rng.uniform(self.a, self.b)
+        if self.distribution == "lognormal":
+            return self._rng.lognormvariate(math.log(self.a), self.b) if self.a > 0 else 0.0
+        return self.a
+
+
+class StubChatSession(ChatSession):
+    """
+    Scripted symptom interview: asks the scripted questions in order, and replies with the
+    end text once they are exhausted or the user says they are finished.
+    """
+
+    def __init__(self, backend: "StubBackend", history: List[ChatTurn], model_name: str = "", system_instruction: str = "",
+                 prefix: Optional[PrefixKey] = None):
+        self._backend = backend
+        self._history = list(history)
+        self._model_name = model_name
+        self._system_instruction = system_instruction
+        self._prefix = prefix
+
+    @property
+    def history(self) -> List[ChatTurn]:
+        return list(self._history)
+
+    def _reply(self, text: str) -> str:
+        asked = sum(1 for turn in self._history if turn.role == "model")
+        if asked >= self._backend.turns or (asked and _FINISHED_RE.search(text)):
+            return self._backend.end_text
+        return self._backend.chat_replies[asked % len(self._backend.chat_replies)]
+
+    def _record(self, text: str, reply: str) -> None:
+        self._history.append(ChatTurn("user", text))
+        self._history.append(ChatTurn("model", reply))
+
+    def _report_usage(self, text: str, reply: str, cached: bool) -> None:
+        history = "".join(turn.text for turn in self._history)
+        self._backend.report_usage(self._system_instruction, history + text, reply, cached)
+
+    async def send_async(self, text: str) -> str:
+        self._backend.maybe_fail()
+        cached = await self._backend.prefix_async(self._model_name, self._system_instruction, self._prefix) is not None
+        reply = self._reply(text)
+        await asyncio.sleep(self._backend.chat_latency.sample())
+        self._report_usage(text, reply, cached)
+        self._record(text, reply)
+        return reply
+
+    async def stream_async(self, text: str) -> AsyncIterator[str]:
+        self._backend.maybe_fail()
+        cached = await self._backend.prefix_async(self._model_name, self._system_instruction, self._prefix) is not None
+        reply = self._reply(text)
+        await asyncio.sleep(self._backend.chat_latency.sample())
+        words = reply.split(" ")
+        for start in range(0, len(words), _CHUNK_WORDS):
+            if start:
+                await asyncio.sleep(self._backend.chunk_latency.sample())
+            chunk = " ".join(words[start:start + _CHUNK_WORDS])
+            yield chunk if start + _CHUNK_WORDS >= len(words) else chunk + " "
+        self._report_usage(text, reply, cached)
+        self._record(text, reply)
+
+
+class StubBackend(LLMBackend):
+    """
+    Local stand-in for Gemini that returns scripted replies after a simulated latency,
+    for benchmarks and load tests without network access or API costs.
+    """
+    name = "stub"
+
+    DEFAULT_CHAT_REPLIES = [
+        "I'm sorry to hear that. When did this start, and has it been constant or does it come and go?",
+        "On a scale of 1 to 10, how severe is it, and does anything make it better or worse?",
+        "Have you noticed any other symptoms along with it, such as fever, nausea or fatigue?",
+        "Do you have any other symptoms you'd like to discuss?",
+    ]
+    DEFAULT_GENERATE_REPLIES = {
+        "summary": "• Reports symptoms starting two days ago.\n• Rates severity as 6/10.\n• Denies fever.",
+        "summary_title": "Recent Symptom Episode",
+        "report_reason": "Symptom Evaluation Visit",
+        "report_hpi": "• Patient reported similar symptoms in earlier entries.\n• Current visit is for evaluation of these symptoms.",
+        "report_impression": "The current presentation follows earlier reports of similar symptoms.",
+        "context_digest": "• Reported recurring mild symptoms during this period.",
+        "chat_digest": "• Reported the onset, severity and associated symptoms of the current complaint.",
+    }
+    # structured generations answer with the JSON object of the fields their single-field counterparts generate
+    STRUCTURED_FIELDS = {
+        "summary_structured": {"title": "summary_title", "summary": "summary"},
+        "report_structured": {"reason": "report_reason", "HPI": "report_hpi", "impression": "report_impression"},
+    }
+
+    def __init__(self, chat_latency: LatencyModel, generate_latency: LatencyModel, chunk_latency: LatencyModel,
+                 turns: int = STUB_LLM_TURNS, end_text: str = STUB_LLM_END_TEXT,
+                 chat_replies: Optional[List[str]] = None, generate_replies: Optional[dict[str, str]] = None,
+                 error_rate: float = 0.0, rng: Optional[random.Random] = None):
+        self.chat_latency = chat_latency
+        self.generate_latency = generate_latency
+        self.chunk_latency = chunk_latency
+        self.turns = turns
+        self.end_text = end_text
+        self.chat_replies = chat_replies or self.DEFAULT_CHAT_REPLIES
+        self.generate_replies = {**self.DEFAULT_GENERATE_REPLIES, **(generate_replies or {})}
+        self.error_rate = error_rate
+        self._rng = rng or random.Random()
+        # cached prefixes are kept in process, so the prefix cache bookkeeping runs as it would with Gemini
+        self.prefix_store = LocalPrefixStore()
+        prefix_cache.configure(self.prefix_store)
+
+    @classmethod
+    def from_env(cls) -> "StubBackend":
+        rng = random.Random(STUB_LLM_SEED)
+        script = {}
+        if STUB_LLM_SCRIPT:
+            with open(STUB_LLM_SCRIPT) as f:
+                script = json.load(f)
+        return cls(
+            chat_latency=LatencyModel.parse(STUB_LLM_CHAT_LATENCY, rng),
+            generate_latency=LatencyModel.parse(STUB_LLM_GENERATE_LATENCY, rng),
+            chunk_latency=LatencyModel.parse(STUB_LLM_CHUNK_LATENCY, rng),
+            chat_replies=script.get("chat"),
+            generate_replies=script.get("generate"),
+            error_rate=STUB_LLM_ERROR_RATE,
+            rng=rng,
+        )
+
+    def maybe_fail(self) -> None:
+        if self.error_rate and self._rng.random() < self.error_rate:
+            raise StubRateLimitError("Simulated rate limit")
+
+    @staticmethod
+    def report_usage(system_instruction: str, prompt: str, reply: str, cached: bool) -> None:
+        """
+        Reports estimated token counts, the system instruction counting as cached if it was served from a cached prefix.
+        """
+        instruction_tokens = estimate_tokens(system_instruction)
+        report_usage(instruction_tokens + estimate_tokens(prompt), estimate_tokens(reply), instruction_tokens if cached else 0)
+
+    @staticmethod
+    async def prefix_async(model_name: str, system_instruction: str, prefix: Optional[PrefixKey]) -> Optional[str]:
+        """
+        The handle of the cached prefix a call would use, if any. The replies do not depend on it.
+        """
+        return await prefix_cache.aget(model_name, system_instruction, prefix) if prefix is not None else None
+
+    def _generate_reply(self, call_site: str) -> str:
+        if call_site not in self.generate_replies and call_site in self.STRUCTURED_FIELDS:
+            return json.dumps({field: self._generate_reply(source) for field, source in self.STRUCTURED_FIELDS[call_site].items()})
+        return self.generate_replies.get(call_site, f"Stub reply for {call_site}.")
+
+    async def generate_async(self, model_name: str, system_instruction: str, prompt: str, call_site: str, pinned: bool = False,
+                             response_schema: Optional[dict] = None, prefix: Optional[PrefixKey] = None,
+                             temperature: Optional[float] = None) -> str:
+        self.maybe_fail()
+        cached = await self.prefix_async(model_name, system_instruction, prefix) is not None
+        await asyncio.sleep(self.generate_latency.sample())
+        reply = self._generate_reply(call_site)
+        self.report_usage(system_instruction, prompt, reply, cached)
+        return reply
+
+    def start_chat(self, model_name: str, system_instruction: str, history: List[ChatTurn],
+                   prefix: Optional[PrefixKey] = None) -> ChatSession:
+        return StubChatSession(self, history, model_name, system_instruction, prefix)
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, UTC
+from typing import Iterator, Optional
+
+from llm.user_context import estimate_tokens
+from telemetry.metrics import metrics
+from telemetry.tracing import current_endpoint
+
+# recent calls kept per (endpoint, call site, model) for the percentiles
+LLM_USAGE_WINDOW = int(os.getenv("LLM_USAGE_WINDOW", 1000))
+# patients whose usage is totalled per worker, the least recently active are dropped first
+LLM_USAGE_MAX_PATIENTS = int(os.getenv("LLM_USAGE_MAX_PATIENTS", 10000))
+# recent calls kept per patient for the percentiles
+_PATIENT_WINDOW = 100
+# JSONL file receiving one record per LLM call; unset keeps the records in memory only
+LLM_USAGE_LOG = os.getenv("LLM_USAGE_LOG")
+# salt of the patient pseudonyms in the usage stats, set it to the same value in every worker to compare them;
+# unset draws a random one per process
+LLM_USAGE_SALT = os.getenv("LLM_USAGE_SALT") or secrets.token_hex(16)
+
+# prompts range from a short chat turn to a full patient history
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+llm_tokens = metrics.counter("llm_tokens_total", "Tokens of LLM calls, by endpoint, call site and kind (prompt, output, cached).")
+llm_prompt_tokens = metrics.histogram("llm_prompt_tokens", "Prompt tokens per LLM call, by call site.", buckets=TOKEN_BUCKETS)
+llm_call_seconds = metrics.histogram("llm_call_seconds", "Wall time of LLM calls, queueing and retries included, by call site.")
+
+
+class LLMCall:
+    """
+    One LLM call being accounted. The backend reports the provider's token counts through
+    report_usage; if it does not, they are estimated from the characters sent and received.
+    """
+    __slots__ = ("call_site", "model", "patient", "prompt_tokens", "output_tokens", "cached_tokens",
+                 "prompt_chars", "response_chars")
+
+    def __init__(self, call_site: str, model: str, patient: Optional[str]):
+        self.call_site = call_site
+        self.model = model
+        self.patient = patient
+        self.prompt_tokens: Optional[int] = None
+        self.output_tokens: Optional[int] = None
+        self.cached_tokens = 0
+        self.prompt_chars = 0
+        self.response_chars = 0
+
+
+_current_call: ContextVar[Optional[LLMCall]] = ContextVar("current_llm_call", default=None)
+
+
+def report_usage(prompt_tokens: Optional[int], output_tokens: Optional[int], cached_tokens: Optional[int] = 0) -> None:
+    """
+    Called by backends with the token counts of the response they got, for the call being accounted, if any.
+    """
+    call = _current_call.get()
+    if call is None:
+        return
+    call.prompt_tokens = prompt_tokens
+    call.output_tokens = output_tokens
+    call.cached_tokens = cached_tokens or 0
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {f"p{p}": values[min(len(values) - 1, int(len(values) * p / 100))] for p in (50, 95, 99)}
+
+
+class _Series:
+    __slots__ = ("calls", "prompt_tokens", "output_tokens", "cached_tokens", "seconds", "estimated", "recent")
+
+    def __init__(self, window: int):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.seconds = 0.0
+        self.estimated = 0
+        # (prompt tokens, output tokens, seconds) of the latest calls
+        self.recent: deque[tuple[int, int, float]] = deque(maxlen=window)
+
+    def add(self, record: dict) -> None:
+        self.calls += 1
+        self.prompt_tokens += record["prompt_tokens"]
+        self.output_tokens += record["output_tokens"]
+        self.cached_tokens += record["cached_tokens"]
+        self.seconds += record["seconds"]
+        self.estimated += record["estimated"]
+        self.recent.append((record["prompt_tokens"], record["output_tokens"], record["seconds"]))
+
+    def totals(self) -> dict:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_tokens": self.cached_tokens,
+            "seconds": round(self.seconds, 3),
+            "estimated_calls": self.estimated,
+        }
+
+    def stats(self) -> dict:
+        recent = list(self.recent)
+        return {
+            **self.totals(),
+            "prompt_tokens_percentiles": _percentiles([prompt for prompt, _, _ in recent]),
+            "output_tokens_percentiles": _percentiles([output for _, output, _ in recent]),
+            "seconds_percentiles": _percentiles([seconds for _, _, seconds in recent]),
+        }
+
+
+def pseudonym(patient: str, salt: str = LLM_USAGE_SALT) -> str:
+    """
+    A salted hash standing for a patient id in the usage stats: the id is the only credential of the
+    patient routes, so it never leaves the server except in the JSONL log.
+    """
+    return hashlib.sha256(f"{salt}:{patient}".encode()).hexdigest()[:16]
+
+
+class UsageLedger:
+    """
+    Token counts and wall time of every LLM call, totalled per (endpoint, call site, model) with
+    percentiles over the latest calls, and per patient pseudonym; optionally appended to a JSONL file
+    with the patient ids.
+    """
+
+    def __init__(self, window: int = LLM_USAGE_WINDOW, max_patients: int = LLM_USAGE_MAX_PATIENTS,
+                 path: Optional[str] = LLM_USAGE_LOG, salt: str = LLM_USAGE_SALT):
+        self._window = window
+        self._salt = salt
+        self._max_patients = max_patients
+        self._series: dict[tuple[str, str, str], _Series] = {}
+        self._patients: OrderedDict[str, _Series] = OrderedDict()
+        self._lock = threading.Lock()
+        self._log = open(path, "a", buffering=1) if path else None
+        self._log_lock = threading.Lock()
+
+    def record(self, call: LLMCall, seconds: float, endpoint: Optional[str]) -> dict:
+        estimated = call.prompt_tokens is None or call.output_tokens is None
+        record = {
+            "timestamp": datetime.now(UTC).isoformat(),
+            "endpoint": endpoint or "unknown",
+            "call_site": call.call_site,
+            "model": call.model,
+            "patient": call.patient,
+            "prompt_tokens": estimate_tokens(call.prompt_chars) if call.prompt_tokens is None else call.prompt_tokens,
+            "output_tokens": estimate_tokens(call.response_chars) if call.output_tokens is None else call.output_tokens,
+            "cached_tokens": call.cached_tokens,
+            "seconds": round(seconds, 4),
+            "estimated": estimated,
+        }
+        with self._lock:
+            key = (record["endpoint"], call.call_site, call.model)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(self._window)
+            series.add(record)
+            if call.patient is not None and self._max_patients:
+                key = pseudonym(call.patient, self._salt)
+                patient = self._patients.pop(key, None) or _Series(min(self._window, _PATIENT_WINDOW))
+                patient.add(record)
+                self._patients[key] = patient
+                while len(self._patients) > self._max_patients:
+                    self._patients.popitem(last=False)
+        llm_tokens.inc(record["prompt_tokens"], endpoint=record["endpoint"], call_site=call.call_site, kind="prompt")
+        llm_tokens.inc(record["output_tokens"], endpoint=record["endpoint"], call_site=call.call_site, kind="output")
+        llm_tokens.inc(record["cached_tokens"], endpoint=record["endpoint"], call_site=call.call_site, kind="cached")
+        llm_prompt_tokens.observe(record["prompt_tokens"], call_site=call.call_site)
+        llm_call_seconds.observe(seconds, call_site=call.call_site)
+        if self._log is not None:
+            with self._log_lock:
+                self._log.write(json.dumps(record) + "\n")
+        return record
+
+    def stats(self, top_patients: int = 20) -> dict:
+        """
+        The usage per (endpoint, call site, model), heaviest prompts first, totals per endpoint,
+        and the top_patients patients with the most prompt tokens, by pseudonym.
+        """
+        with self._lock:
+            series = [({"endpoint": endpoint, "call_site": call_site, "model": model}, value.stats())
+                      for (endpoint, call_site, model), value in self._series.items()]
+            patients = sorted(self._patients.items(), key=lambda item: item[1].prompt_tokens, reverse=True)[:top_patients]
+            patients = [{"patient": patient, **value.stats()} for patient, value in patients]
+        endpoints: dict[str, dict] = {}
+        for labels, value in series:
+            totals = endpoints.setdefault(labels["endpoint"], {"calls": 0, "prompt_tokens": 0, "output_tokens": 0, "cached_tokens": 0})
+            for field in totals:
+                totals[field] += value[field]
+        return {
+            "calls": sum(value["calls"] for _, value in series),
+            "endpoints": dict(sorted(endpoints.items(), key=lambda item: item[1]["prompt_tokens"], reverse=True)),
+            "series": [{**labels, **value} for labels, value in sorted(series, key=lambda item: item[1]["prompt_tokens"], reverse=True)],
+            "top_patients": patients,
+            "log": self._log.name if self._log is not None else None,
+        }
+
+
+usage_ledger = UsageLedger()
+
+
+@contextmanager
+def account(call_site: str, model: str, patient: Optional[str] = None) -> Iterator[LLMCall]:
+    """
+    Accounts the LLM call made in the enclosed block in usage_ledger, unless it raises.
+    Set prompt_chars and response_chars on the yielded call for backends that report no token counts.
+    """
+    call = LLMCall(call_site, model, patient)
+    token = _current_call.set(call)
+    start = time.perf_counter()
+    try:
+        yield call
+    finally:
+        try:
+            _current_call.reset(token)
+        except ValueError:
+            # a generator finished in another context than it started in
+            pass
+    usage_ledger.record(call, time.perf_counter() - start, current_endpoint())
@@ -0,0 +1,277 @@
+import datetime
+from collections import OrderedDict
+from typing import Any, List, Optional, Union
+
+from llm.retrieval import BM25Index
+
+NO_CONTEXT_STRING = "No past medical summary provided."
+
+
+def estimate_tokens(text: Union[str, int]) -> int:
+    """
+    Rough token count of text, or of a text of that many characters (about 4 characters per token for English prose).
+    """
+    return (text if isinstance(text, int) else len(text)) // 4 + 1
+
+
+def entry_period(item: dict[str, Any]) -> str:
+    """
+    The calendar month ('YYYY-MM') of a symptom entry, used to group old entries into digests.
+    """
+    timestamp = item.get('timestamp', None)
+    if isinstance(timestamp, (int, float)):
+        try:
+            return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m')
+        except Exception:
+            return 'Unknown Time'
+    if isinstance(timestamp, str) and len(timestamp) >= 7:
+        return timestamp[:7]
+    return 'Unknown Time'
+
+
+def format_digest(digest: dict[str, Any]) -> str:
+    """
+    Formats a period digest (a dict with keys 'period', 'entry_count' and 'digest')
+    as a line of historical context for prompts.
+    """
+    return f"[{digest['period']}] Digest of {digest['entry_count']} earlier entries: {digest['digest']}"
+
+
+def format_context_entry(item: dict[str, Any]) -> str:
+    """
+    Formats one symptom entry (a dict with keys 'title', 'summary' and 'timestamp')
+    as a line of historical context for prompts.
+    """
+    title = item.get('title', 'No Title')
+    summary = item.get('summary', 'No Summary')
+    timestamp = item.get('timestamp', None)
+    if isinstance(timestamp, (int, float)):
+        # If timestamp is a Unix timestamp
+        try:
+            dt = datetime.datetime.fromtimestamp(timestamp)
+            timestamp_str = dt.strftime('%Y-%m-%d %H:%M')
+        except Exception:
+            timestamp_str = str(timestamp)
+    elif isinstance(timestamp, str):
+        timestamp_str = timestamp
+    else:
+        timestamp_str = 'Unknown Time'
+    return f"[{timestamp_str}] {title}: {summary}"
+
+
+def format_patient_background(patient: dict[str, Any]) -> Optional[str]:
+    """
+    Formats the chronic conditions and medications of a patient record
+    as a line of background for prompts, or None if there are none.
+    """
+    parts = []
+    if patient.get('chronic_diseases'):
+        parts.append(f"Known chronic conditions: {', '.join(patient['chronic_diseases'])}.")
+    if patient.get('medications'):
+        parts.append(f"Current medications: {', '.join(patient['medications'])}.")
+    return f"[Background] {' '.join(parts)}" if parts else None
+
+
+class UserContext:
+    """
+    The patient's formatted symptom history, maintained incrementally.
+
+    Each entry is formatted once, when it is added. The rendered text is kept
+    and only extended with the entries added since it was last rendered, so
+    appending a new summary costs O(1) formatting work instead of re-formatting
+    the whole history.
+
+    The oldest entries can be folded into period digests (see plan_compaction),
+    in which case the text holds the digests followed by the remaining entries.
+    """
+
+    def __init__(self, context_data: Any = None):
+        # raw entry behind each line, None for lines passed in preformatted
+        self._entries: List[Optional[dict[str, Any]]] = []
+        self._lines: List[str] = []
+        self._digests: List[dict[str, Any]] = []
+        # number of leading entries covered by the digests
+        self._digested_count: int = 0
+        self._rendered: str = ""
+        self._rendered_count: int = 0
+        # retrieval index over the entries not covered by digests, built lazily
+        self._index: Optional[BM25Index] = None
+        self._indexed_count: int = 0
+        # bumped on every change, lets holders of a rendered prompt know it is stale
+        self.version: int = 0
+        self.append(context_data)
+
+    def append(self, context_data: Any) -> int:
+        """
+        Appends entries to the context.
+
+        Args:
+            context_data (Any): A list of symptom dicts, or an already formatted string.
+
+        Returns:
+            int: The number of lines added.
+        """
+        if not context_data:
+            return 0
+        if isinstance(context_data, str):
+            self._entries.append(None)
+            self._lines.append(context_data)
+            added = 1
+        elif isinstance(context_data, list):
+            self._entries.extend(context_data)
+            self._lines.extend(format_context_entry(item) for item in context_data)
+            added = len(context_data)
+        else:
+            raise ValueError("Not supported user context type.")
+        self.version += 1
+        return added
+
+    def replace(self, context_data: Any) -> None:
+        """
+        Replaces all entries of the context, dropping any digests.
+        """
+        self._entries = []
+        self._lines = []
+        self._digests = []
+        self._digested_count = 0
+        self._reset_rendered()
+        self._index = None
+        self.append(context_data)
+        self.version += 1
+
+    def plan_compaction(self, token_budget: int, digest_share: float) -> tuple[int, OrderedDict[str, list[dict[str, Any]]]]:
+        """
+        Decides which entries no longer fit in the token budget verbatim.
+        The most recent entries are kept verbatim within (1 - digest_share) of the budget;
+        the older ones are grouped by calendar month, to be folded into one digest per month.
+        The most recent entry is always kept verbatim.
+
+        Args:
+            token_budget (int): Approximate number of tokens the context may take in a prompt.
+            digest_share (float): Share of the budget left for the digests of older entries.
+
+        Returns:
+            tuple: The number of leading entries to fold, and those entries grouped by period, oldest first.
+        """
+        window_budget = int(token_budget * (1 - digest_share))
+        used = 0
+        keep_from = len(self._lines)
+        for index in range(len(self._lines) - 1, -1, -1):
+            used += estimate_tokens(self._lines[index])
+            if used > window_budget:
+                break
+            keep_from = index
+        keep_from = min(keep_from, len(self._lines) - 1)
+        periods: OrderedDict[str, list[dict[str, Any]]] = OrderedDict()
+        folded = 0
+        # preformatted lines carry no timestamp, so folding stops at the first one
+        while folded < keep_from and self._entries[folded] is not None:
+            periods.setdefault(entry_period(self._entries[folded]), []).append(self._entries[folded])
+            folded += 1
+        return folded, periods
+
+    def apply_digests(self, digests: List[dict[str, Any]], digested_count: int) -> None:
+        """
+        Replaces the first digested_count entries in the rendered text by the given digests.
+        """
+        self._digests = list(digests)
+        self._digested_count = digested_count
+        self._reset_rendered()
+        self._index = None
+        self.version += 1
+
+    def relevant_text(self, query: str, k: int, background: Optional[str] = None) -> str:
+        """
+        The context restricted to what matters for query: the digests (the long-term background)
+        and the k entries that best match query, in chronological order. If fewer than k entries
+        match, the most recent other entries make up the rest.
+        The full text is returned when there are no more than k entries.
+
+        Args:
+            query (str): The text to rank entries against, e.g. the reason for a visit.
+            k (int): Maximum number of verbatim entries to include.
+            background (Optional[str]): A line put first, such as known chronic conditions.
+
+        Returns:
+            str: The selected context, one entry per line.
+        """
+        lines = [background] if background else []
+        lines.extend(self.digest_lines())
+        lines.extend(self.relevant_entries(query, k))
+        return "\n".join(lines) if lines else NO_CONTEXT_STRING
+
+    def digest_lines(self) -> List[str]:
+        """
+        The digests formatted for prompts, oldest period first.
+        """
+        return [format_digest(digest) for digest in self._digests]
+
+    def relevant_entries(self, query: str, k: int) -> List[str]:
+        """
+        The lines of the k entries not covered by digests that best match query, in chronological order,
+        the most recent other entries making up for missing matches; all of them if there are no more than k.
+        """
+        if len(self._lines) - self._digested_count <= k:
+            return self._lines[self._digested_count:]
+        if self._index is None:
+            self._index = BM25Index()
+            self._indexed_count = self._digested_count
+        while self._indexed_count < len(self._lines):
+            self._index.add(self._indexed_count, self._lines[self._indexed_count])
+            self._indexed_count += 1
+        chosen = {index for index, _ in self._index.search(query, k)}
+        # slots no entry matched are filled with the most recent entries
+        recent = len(self._lines) - 1
+        while len(chosen) < k:
+            chosen.add(recent)
+            recent -= 1
+        return [self._lines[index] for index in sorted(chosen)]
+
+    def to_state(self) -> dict[str, Any]:
+        """
+        The context as JSON-serializable data, see from_state.
+        Entries are stored raw, preformatted lines as strings.
+        """
+        return {
+            "entries": [line if entry is None else entry for entry, line in zip(self._entries, self._lines)],
+            "digests": list(self._digests),
+            "digested_count": self._digested_count,
+            "version": self.version,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict[str, Any]) -> "UserContext":
+        """
+        Rebuilds a context saved with to_state.
+        """
+        context = cls()
+        for item in state["entries"]:
+            context.append(item if isinstance(item, str) else [item])
+        context._digests = list(state["digests"])
+        context._digested_count = state["digested_count"]
+        context._reset_rendered()
+        context.version = state["version"]
+        return context
+
+    def _reset_rendered(self) -> None:
+        self._rendered = "\n".join(format_digest(digest) for digest in self._digests)
+        self._rendered_count = self._digested_count
+
+    @property
+    def text(self) -> str:
+        """
+        The context formatted for prompts, one entry per line.
+        """
+        if not self._lines:
+            return NO_CONTEXT_STRING
+        if self._rendered_count < len(self._lines):
+            new_text = "\n".join(self._lines[self._rendered_count:])
+            self._rendered = f"{self._rendered}\n{new_text}" if self._rendered else new_text
+            self._rendered_count = len(self._lines)
+        return self._rendered
+
+    def is_empty(self) -> bool:
+        return not self._lines
+
+    def __len__(self) -> int:
+        return len(self._lines)
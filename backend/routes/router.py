@@ -1,25 +1,40 @@
 # API endpoints for FastAPI
-from http.client import HTTPException
-from typing import List
+import asyncio
+from datetime import datetime
+from typing import List, Optional
 
+import hashlib
+import hmac
+import json
 import os
 
 import db
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from google.oauth2 import id_token
-from google.auth.transport import requests as grequests
 
+from llm.backends import get_backend
 from llm.llm_manager import LLMManager
+from llm.model_registry import models
+from llm.prefix_cache import prefix_cache
+from llm.response_cache import response_cache
+from llm.scheduler import LLMOverloaded, llm_scheduler
+from llm.usage import usage_ledger
 from uuid import uuid4, UUID
 from user.user import User
+from user.session_store import SessionStore
+from user.state_store import create_state_store
+from jobs.queue import QueueFull, job_queue
+from jobs.singleflight import flights
+from telemetry.metrics import metrics
+from telemetry.readiness import readiness
 
 
 
-from db.db import Database
+from db.cache import HistoryCursor
+from db.db import AsyncDatabase
 api_router = APIRouter()
-users_dict = {}
 class SignupData(BaseModel):
     mail: str
     age: int
@@ -28,91 +43,329 @@ class SignupData(BaseModel):
     chronic_diseases: List[str]
     medications: List[str]
 
-database = Database()
+database = AsyncDatabase()
+# token expected in the X-Admin-Token header of the /admin routes; unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# symptom history entries per /get_history page, by default and at most
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 20))
+HISTORY_MAX_PAGE_SIZE = 100
 
 
+async def load_user(user_id: UUID) -> User:
+    """
+    Builds a session from the patient's symptom history, once for concurrent requests of the same patient.
+    """
+    return await flights.do(("load_user", user_id), lambda: _create_user(user_id))
+
+
+async def _create_user(user_id: UUID) -> User:
+    user = await User.create(database=database, user_id=user_id)
+    if user.llm.needs_compaction():
+        # digesting a long history takes several generations, sign-in does not wait for them;
+        # the patient's later jobs queue behind this one, so summaries and reports see the compacted context
+        async def run():
+            # the session may have been resumed or rebuilt since, compact the current one
+            current = await get_user(user_id)
+            await current.compact_context()
+            # a session another request moved on meanwhile is not overwritten, it gets the digests on its next load
+            if await get_user(user_id) is current:
+                await sessions.asave(user_id, current)
+            return {'status': 'compacted'}
+
+        try:
+            job_queue.submit("compact_context", user_id, run, coalesce=("compact_context", user_id))
+        except QueueFull:
+            print(f"Job queue full, the session of {user_id} keeps its full history")
+    return user
+
+
+async def patient_id_by_email(email: str) -> UUID:
+    return await flights.do(("patient_by_email", email), lambda: database.get_patient_by_email(email))
+
+
+# saved chat sessions and job statuses, shared by the workers with SESSION_STATE_BACKEND=sqlite, None with memory
+state_store = create_state_store()
+job_queue.configure(state_store)
+# active chat sessions - bounded, saved after every change so any worker can resume them,
+# sessions without saved state are rebuilt from the symptom history
+sessions = SessionStore(factory=load_user,
+                        state_store=state_store,
+                        restore=lambda user_id, state: User.from_state(database=database, user_id=user_id, state=state))
+metrics.gauge("sessions_active", "Chat sessions held in memory by this worker.", function=lambda: len(sessions))
+
+
+def _import_google_auth() -> None:
+    # the sign-in verification imports these on first use, load them before the first sign-in
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+
 
+# warm-up run in the background from the app lifespan, see /ready
+readiness.add("database", lambda: database.connect())
+readiness.add("llm_backend", lambda: asyncio.to_thread(get_backend, os.getenv("API_KEY")))
+readiness.add("google_auth", lambda: asyncio.to_thread(_import_google_auth))
 
-def get_user(user_id: UUID) -> User:
 
-    if user_id in users_dict:
-        return users_dict[user_id]
-    new_user_id = UUID(os.getenv('UUID')) # for testing
 
-    users_dict[new_user_id] = User(user_id=new_user_id, database=database)
-    return users_dict[new_user_id]
 
-    # new_user_id = uuid4()
+async def get_user(user_id: UUID) -> User:
+    return await flights.do(("get_user", user_id), lambda: sessions.aget(user_id))
 
 @api_router.get("/signin_user/{user_email}")
-def signin_user(user_email: str):
+async def signin_user(user_email: str):
     """
     Signs in a user by email. If the user does not exist, it creates a new user.
     Returns the user_id.
     """
     try:
-        patient = database.get_patient_by_email(user_email)
-        user_id = UUID(patient['patient_id'])
-        users_dict[user_id] = User(user_id=user_id, database=database)
+        user_id = await patient_id_by_email(user_email)
+        # an in-progress interview is kept, only a missing session is loaded
+        await get_user(user_id)
     except Exception as e:
         # If the patient does not exist, create a new one
         print(f"Error fetching patient: {e}")
 
 @api_router.get("/response/{user_id}")
-def get_response(user_id: UUID, prompt: str):
-    answer, stop = get_user(user_id=user_id).get_response(prompt)
+async def get_response(user_id: UUID, prompt: str):
+    user = await get_user(user_id=user_id)
+    try:
+        answer, stop = await user.get_response(prompt)
+    except LLMOverloaded as e:
+        return JSONResponse(content={'detail': str(e)}, status_code=503,
+                            headers={'Retry-After': str(round(e.retry_after))})
+    await sessions.asave(user_id, user)
     return JSONResponse(content={'answer': answer, 'stop': stop})
 
 
+@api_router.get("/response_stream/{user_id}")
+async def stream_response(user_id: UUID, prompt: str):
+    """
+    Server-Sent Events variant of /response: forwards the answer as 'chunk' events
+    while it is generated, then sends the stop flag in a final 'end' event.
+    """
+    user = await get_user(user_id=user_id)
+
+    async def events():
+        try:
+            async for event, payload in user.stream_response(prompt):
+                if event == "end":
+                    await sessions.asave(user_id, user)
+                yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def submit_job(kind: str, user_id: UUID, run, *args) -> JSONResponse:
+    """
+    Queues run as a background job of the patient, after the patient's earlier jobs.
+    A job of the same kind with the same args that has not started yet is answered instead.
+    Answers 202 with the job id to poll at /jobs/{job_id}, or 503 when the queue is full.
+    """
+    try:
+        job = job_queue.submit(kind, user_id, run, coalesce=(kind, user_id, *args))
+    except QueueFull:
+        return JSONResponse(content={'detail': 'Too many pending jobs, retry later'}, status_code=503,
+                            headers={'Retry-After': '5'})
+    await job_queue.publish(job)
+    return JSONResponse(content=job.to_dict(), status_code=202)
+
+
 @api_router.post("/save_summary/{user_id}")
-def save_summary(user_id: UUID):
-    get_user(user_id=user_id).save_summary_and_update()
-    return JSONResponse(content={'status': 'saved'})
+async def save_summary(user_id: UUID):
+    async def run():
+        user = await get_user(user_id=user_id)
+        await user.save_summary_and_update()
+        await sessions.asave(user_id, user)
+        return {'status': 'saved'}
+
+    return await submit_job("save_summary", user_id, run)
 
 
-@api_router.get("/doctor_report/{user_id}")
-def get_doctors_report(user_id: UUID, prompt: str):
-    answer = get_user(user_id=user_id).get_doctor_report(prompt)
-    hpi_list  = answer['HPI'].split('\n')
-    return JSONResponse(content={'reason': answer['reason'], 'HPI': hpi_list, 'impression': answer['impression']})
+@api_router.post("/doctor_report/{user_id}")
+async def get_doctors_report(user_id: UUID, prompt: str):
+    async def run():
+        user = await get_user(user_id=user_id)
+        answer = await user.get_doctor_report(prompt)
+        await sessions.asave(user_id, user)
+        hpi_list  = answer['HPI'].split('\n')
+        return {'reason': answer['reason'], 'HPI': hpi_list, 'impression': answer['impression'],
+                'timings': answer['timings']}
+
+    return await submit_job("doctor_report", user_id, run, prompt)
+
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """
+    Returns the status of a background job, and its result once it is done.
+    With wait, holds the request up to that many seconds (at most 30) for the job to finish.
+    Jobs accepted by another worker are read from the state store.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        published = await job_queue.load(job_id, min(wait, 30))
+        if published is None:
+            return JSONResponse(content={'detail': 'Unknown or expired job'}, status_code=404)
+        return JSONResponse(content=published)
+    if wait > 0 and not job.done:
+        await job.wait(min(wait, 30))
+    return JSONResponse(content=job.to_dict())
 
 
 @api_router.get("/has_history/{user_id}")
-def has_history(user_id: UUID) -> bool:
+async def has_history(user_id: UUID) -> bool:
     """
     Checks if the user has any recorded symptoms in the database.
     Returns True if there are symptoms, False otherwise.
     """
-    history = database.get_symptoms_for_patient(patient_id=user_id)
-    return not len(history) == 0
+    latest = await database.get_symptoms_page(patient_id=user_id, limit=1)
+    return not len(latest) == 0
 
 
 @api_router.get("/get_history/{user_id}")
-def get_history(user_id: UUID):
+async def get_history(user_id: UUID, request: Request, limit: int = HISTORY_PAGE_SIZE,
+                      cursor: Optional[str] = None, since: Optional[datetime] = None):
     """
-    Checks if the user has any recorded symptoms in the database.
-    Returns True if there are symptoms, False otherwise.
+    Returns a page of the user's symptom history, newest first, with each summary split into its lines.
+    Pass next_cursor as cursor to get the next, older page, and the newest timestamp already
+    shown as since to only get the entries added after it.
+    Answers 304 without a body when the page matches the ETag sent in If-None-Match.
     """
-    symptoms = database.get_symptoms_for_patient(patient_id=user_id)
-    for symptom in symptoms:
-        symptom['summary'] = symptom['summary'].split("\n")
-    return JSONResponse(symptoms, status_code=200)
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    try:
+        after = None if cursor is None else HistoryCursor.decode(cursor)
+    except ValueError as e:
+        return JSONResponse(content={'detail': str(e)}, status_code=422)
+    # one more row than asked tells whether there is an older page
+    rows = await database.get_symptoms_page(patient_id=user_id, limit=limit + 1, cursor=after, since=since)
+    entries = [{'timestamp': row['timestamp'], 'title': row['title'], 'summary': row['summary'].split("\n")}
+               for row in rows[:limit]]
+    next_cursor = HistoryCursor.after(rows[:limit], after).encode() if len(rows) > limit else None
+    content = json.dumps({'entries': entries, 'next_cursor': next_cursor}).encode()
+    etag = f'"{hashlib.sha1(content).hexdigest()}"'
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if etag in (tag.strip() for tag in request.headers.get('if-none-match', '').split(',')):
+        return Response(status_code=304, headers=headers)
+    return Response(content, media_type='application/json', headers=headers)
 
 
 @api_router.get("/is_existing_patient/{email}")
-def has_patient(email: str) -> bool:
+async def has_patient(email: str) -> bool:
     """
     Checks if a patient exists in the database by email.
     Returns True if the patient exists, False otherwise.
     """
     try:
-        database.get_patient_by_email(email)
+        await patient_id_by_email(email)
         return True
     except Exception as e:
         # If the patient does not exist, an exception will be raised
         return False
 # consider maybe creating a function in the db for checking if a patient exists.
 
+@api_router.get("/ready")
+async def ready():
+    """
+    Returns 200 once this worker has created its clients and loaded the SDKs, 503 before or if a step failed,
+    with the status and duration of each warm-up step.
+    """
+    return JSONResponse(readiness.stats(), status_code=200 if readiness.ready else 503)
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """
+    Lets a request through to the /admin routes only with the configured admin token.
+    They answer 404 as if they did not exist while ADMIN_TOKEN is unset.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+# operational stats of the worker, for operators only
+admin_router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+
+@admin_router.get("/sessions")
+async def session_stats():
+    """
+    Returns the session store size and its hit/miss/eviction counters.
+    """
+    return sessions.stats()
+
+
+@admin_router.get("/models")
+async def model_stats():
+    """
+    Returns the model registry size and how often it avoided building a new GenerativeModel.
+    """
+    return models.stats()
+
+
+@admin_router.get("/db_cache")
+async def db_cache_stats():
+    """
+    Returns the size and hit/miss counters of the database read cache.
+    """
+    return database.cache.stats()
+
+
+@admin_router.get("/llm_cache")
+async def llm_cache_stats():
+    """
+    Returns the size and hit/miss counters of the LLM response cache.
+    """
+    return response_cache.stats()
+
+
+@admin_router.get("/llm_prefix_cache")
+async def llm_prefix_cache_stats():
+    """
+    Returns the number of cached prompt prefixes and how often calls reused one instead of resending it.
+    """
+    return prefix_cache.stats()
+
+
+@admin_router.get("/llm_scheduler")
+async def llm_scheduler_stats():
+    """
+    Returns the outbound LLM calls in flight and queued by lane, the current concurrency limit and the retry counters.
+    """
+    return llm_scheduler.stats()
+
+
+@admin_router.get("/llm_usage")
+async def llm_usage_stats(top_patients: int = 20):
+    """
+    Returns the tokens and wall time of the LLM calls per endpoint and call site, with percentiles,
+    and the pseudonyms of the patients whose calls sent the most prompt tokens.
+    """
+    return usage_ledger.stats(top_patients=max(0, top_patients))
+
+
+@admin_router.get("/jobs")
+async def job_stats():
+    """
+    Returns the size of the job worker pool and the number of running and pending jobs.
+    """
+    return job_queue.stats()
+
+
+@admin_router.get("/metrics")
+async def prometheus_metrics():
+    """
+    Returns the span durations, LLM character counts and gauges in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+api_router.include_router(admin_router)
+
+
 @api_router.post("/llm")
 def llm_endpoint(input_data: dict):
     # Call LLM wrapper logic
@@ -123,17 +376,20 @@ def llm_endpoint(input_data: dict):
 
 
 @api_router.post("/submit/report/{report_id}")
-def submit_report(report_id: str, report_data: dict):
+async def submit_report(report_id: str, report_data: dict):
     # Logic to handle report submission
     # This could involve saving to a database or processing the report
     return {"report_id": report_id, "status": "submitted", "data": report_data}
 
 @api_router.post("/auth/google")
-def auth_google(token_data: str, age: int, gender: str, allergies: list = str, chronic_diseases: list = str, medications: list = str):
+async def auth_google(token_data: str, age: int, gender: str, allergies: list = str, chronic_diseases: list = str, medications: list = str):
+    from google.oauth2 import id_token
+    from google.auth.transport import requests as grequests
     try:
         # Verify the token
-        idinfo = id_token.verify_oauth2_token(
-            token_data.token, grequests.Request(), "GOOGLE_CLIENT_ID"
+        # token verification fetches Google's certificates with a blocking client
+        idinfo = await run_in_threadpool(
+            id_token.verify_oauth2_token, token_data.token, grequests.Request(), "GOOGLE_CLIENT_ID"
         )
 
         # ID token is valid. Get user's Google Account info
@@ -141,11 +397,11 @@ def auth_google(token_data: str, age: int, gender: str, allergies: list = str, c
         email = idinfo["email"]
         name = idinfo.get("name")
         try:
-            database.get_patient(patient_id=user_id)
+            await database.get_patient(patient_id=user_id)
         except Exception as e:
             # If the patient does not exist, create a new one
-            users_dict[user_id] = User(user_id=user_id, database=database)
-            database.add_patient(patient_id=user_id,
+            sessions.put(user_id, await User.create(database=database, user_id=user_id))
+            await database.add_patient(patient_id=user_id,
                                  age=age,
                                  gender=gender,
                                  chronic_diseases=chronic_diseases,
@@ -157,11 +413,11 @@ def auth_google(token_data: str, age: int, gender: str, allergies: list = str, c
         raise HTTPException(status_code=401, detail="Invalid token")
 
 @api_router.post("/auth/complete_signup")
-def complete_signup(data: SignupData):
+async def complete_signup(data: SignupData):
     # Might need to generate a uuid myself
 
 
-    database.add_patient(age=data.age, gender=data.gender,
+    await database.add_patient(age=data.age, gender=data.gender,
                          allergies=data.allergies, chronic_diseases=data.chronic_diseases,
                          medications=data.medications, patient_id=uuid4(), email=data.mail)
 
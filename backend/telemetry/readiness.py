@@ -0,0 +1,99 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from telemetry.metrics import metrics
+
+
+class _Step:
+    __slots__ = ("name", "run", "status", "seconds", "error")
+
+    def __init__(self, name: str, run: Callable[[], Awaitable[Any]]):
+        self.name = name
+        self.run = run
+        # pending, running, ready or failed
+        self.status = "pending"
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+class Readiness:
+    """
+    Warm-up of the worker: the clients and SDKs the first requests would otherwise pay for.
+
+    Steps are registered with add and run in the background once start is called from the app
+    lifespan, so the worker accepts connections right away. Requests served before a step is done
+    still work, they create what they need on first use. The worker is ready once every step
+    succeeded; a failed step, e.g. missing credentials, keeps it unready with the error in stats.
+    """
+
+    def __init__(self):
+        self._steps: dict[str, _Step] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._started: Optional[float] = None
+        self._finished: Optional[float] = None
+
+    def add(self, name: str, run: Callable[[], Awaitable[Any]]) -> None:
+        """
+        Registers a warm-up step. run returns an awaitable, blocking work belongs in asyncio.to_thread.
+        """
+        self._steps[name] = _Step(name, run)
+
+    @property
+    def ready(self) -> bool:
+        return self._finished is not None and all(step.status == "ready" for step in self._steps.values())
+
+    async def _run(self, step: _Step) -> None:
+        step.status = "running"
+        start = time.perf_counter()
+        try:
+            await step.run()
+        except Exception as e:
+            step.status = "failed"
+            step.error = f"{type(e).__name__}: {e}"
+            print(f"Warm-up step {step.name} failed: {step.error}")
+        else:
+            step.status = "ready"
+        step.seconds = round(time.perf_counter() - start, 4)
+
+    async def _run_all(self) -> None:
+        await asyncio.gather(*(self._run(step) for step in self._steps.values()))
+        self._finished = time.perf_counter()
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        for step in self._steps.values():
+            step.status, step.seconds, step.error = "pending", None, None
+        self._started = time.perf_counter()
+        self._finished = None
+        self._task = asyncio.create_task(self._run_all(), name="warm-up")
+
+    async def wait(self) -> bool:
+        """
+        Waits for the warm-up to finish and returns whether the worker is ready.
+        """
+        if self._task is not None:
+            await asyncio.shield(self._task)
+        return self.ready
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def stats(self) -> dict:
+        finished = self._finished or (time.perf_counter() if self._started is not None else None)
+        return {
+            "ready": self.ready,
+            "seconds": round(finished - self._started, 4) if self._started is not None else None,
+            "steps": {step.name: {"status": step.status, "seconds": step.seconds, "error": step.error}
+                      for step in self._steps.values()},
+        }
+
+
+readiness = Readiness()
+metrics.gauge("app_ready", "1 once the warm-up of this worker succeeded, 0 before or if it failed.",
+              function=lambda: int(readiness.ready))
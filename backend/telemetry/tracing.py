@@ -0,0 +1,207 @@
+import functools
+import inspect
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, Optional
+
+from telemetry.metrics import metrics
+
+# requests slower than this many seconds are logged with the breakdown of their spans, 0 disables
+TRACE_SLOW_REQUEST = float(os.getenv("TRACE_SLOW_REQUEST", 5))
+# OTLP/HTTP collector to export spans to (e.g. http://localhost:4318), needs the opentelemetry packages
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "medical-assistant-backend")
+
+span_duration = metrics.histogram("span_duration_seconds", "Duration of traced operations, by span name and outcome.")
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+# OpenTelemetry tracer and provider, set by setup_tracing when export is configured
+_otel_tracer = None
+_otel_provider = None
+
+
+class Span:
+    """
+    A timed operation. Spans started while another one is active become its children.
+    """
+    __slots__ = ("name", "attributes", "parent", "children", "start", "duration", "status")
+
+    def __init__(self, name: str, attributes: dict[str, Any], parent: Optional["Span"]):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.children: list[Span] = []
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.status = "ok"
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def breakdown(self, depth: int = 0) -> list[str]:
+        duration = "unfinished" if self.duration is None else f"{self.duration:.3f}s"
+        lines = [f"{'  ' * depth}{self.name} {duration}{'' if self.status == 'ok' else ' ' + self.status}"]
+        for child in sorted(self.children, key=lambda child: child.start):
+            lines.extend(child.breakdown(depth + 1))
+        return lines
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_endpoint() -> Optional[str]:
+    """
+    What the current work is done for, from the root of the current span: the route template of
+    the HTTP request (e.g. 'GET /api/response/{user_id}') or the name of the root span, e.g. 'job.doctor_report'.
+    """
+    current = _current_span.get()
+    if current is None or current.parent is None:
+        # not part of a request or job
+        return None
+    root = current.parent
+    while root.parent is not None:
+        root = root.parent
+    scope = root.attributes.get("asgi_scope")
+    if scope is None:
+        return root.name
+    route = scope.get("route")
+    return f"{scope['method']} {route.path if route is not None else 'unmatched'}"
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Times the enclosed block as a span named name, recorded in the span_duration_seconds histogram
+    and exported to OpenTelemetry when configured. Attributes can be added on the yielded span.
+    """
+    parent = _current_span.get()
+    current = Span(name, attributes, parent)
+    token = _current_span.set(current)
+    otel_context = _otel_tracer.start_as_current_span(name) if _otel_tracer is not None else None
+    otel_span = otel_context.__enter__() if otel_context is not None else None
+    error: Optional[BaseException] = None
+    try:
+        yield current
+    except Exception as e:
+        current.status, error = "error", e
+        raise
+    except BaseException as e:
+        # cancellation, or a generator closed before it was exhausted
+        current.status, error = "cancelled", e
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # a generator finished in another context than it started in
+            pass
+        if parent is not None:
+            parent.children.append(current)
+        span_duration.observe(current.duration, span=current.name, status=current.status)
+        if otel_span is not None:
+            _end_otel_span(otel_context, otel_span, current, error)
+
+
+def traced(name: str) -> Callable:
+    """
+    Decorator running every call of a function or coroutine function in a span.
+    """
+    def decorator(function: Callable) -> Callable:
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _end_otel_span(otel_context, otel_span, current: Span, error: Optional[BaseException]) -> None:
+    from opentelemetry.trace import Status, StatusCode
+    otel_span.update_name(current.name)
+    otel_span.set_attributes({key: value for key, value in current.attributes.items()
+                              if isinstance(value, (str, bool, int, float))})
+    if error is not None:
+        otel_span.set_status(Status(StatusCode.ERROR, current.status))
+    otel_context.__exit__(None, None, None)
+
+
+def setup_tracing() -> None:
+    """
+    Starts exporting spans to the OTLP collector at OTEL_EXPORTER_OTLP_ENDPOINT, if it is set.
+    The opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages are only needed then.
+    """
+    global _otel_tracer, _otel_provider
+    if not OTEL_EXPORTER_OTLP_ENDPOINT or _otel_provider is not None:
+        return
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        print("OTEL_EXPORTER_OTLP_ENDPOINT is set but opentelemetry-sdk and "
+              "opentelemetry-exporter-otlp-proto-http are not installed, spans will not be exported")
+        return
+    _otel_provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    # the exporter reads the endpoint (and headers) from the standard OTEL_EXPORTER_OTLP_* variables
+    _otel_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    _otel_tracer = _otel_provider.get_tracer("medical-assistant")
+
+
+def shutdown_tracing() -> None:
+    """
+    Flushes the spans not exported yet.
+    """
+    global _otel_tracer, _otel_provider
+    if _otel_provider is not None:
+        _otel_provider.shutdown()
+    _otel_tracer, _otel_provider = None, None
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware running every HTTP request in a span named after its route template,
+    so /api/doctor_report/{user_id} is one series whatever the user.
+    Requests slower than TRACE_SLOW_REQUEST are logged with the breakdown of their spans.
+    """
+
+    def __init__(self, app, slow_request: float = TRACE_SLOW_REQUEST):
+        self.app = app
+        self.slow_request = slow_request
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        # the route is only matched inside the app, current_endpoint reads it from the scope
+        with span("http", asgi_scope=scope) as request_span:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = scope.get("route")
+                # unmatched paths are grouped, they would otherwise be one series each
+                request_span.name = f"http {scope['method']} {route.path if route is not None else 'unmatched'}"
+                del request_span.attributes["asgi_scope"]
+                request_span.set("status_code", status_code)
+                if 500 <= status_code and request_span.status == "ok":
+                    request_span.status = "error"
+        if self.slow_request and request_span.duration > self.slow_request:
+            print(f"Slow request {scope['method']} {scope['path']}:\n" + "\n".join(request_span.breakdown()))
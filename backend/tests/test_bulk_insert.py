@@ -0,0 +1,92 @@
+import asyncio
+from uuid import uuid4
+
+from postgrest.exceptions import APIError
+
+from db.db import AsyncDatabase, RowError
+
+
+class _Response:
+    def __init__(self, data: list[dict]):
+        self.data = data
+
+
+class _Insert:
+    def __init__(self, client: "_FakeClient", rows: list[dict]):
+        self._client = client
+        self._rows = rows
+
+    async def execute(self) -> _Response:
+        self._client.requests.append(len(self._rows))
+        if self._client.down:
+            raise ConnectionError("database unreachable")
+        bad = [row for row in self._rows if row["title"].startswith("bad")]
+        if bad:
+            # like Postgres, one bad row rejects the whole request
+            raise APIError({"message": f"rejected {bad[0]['title']}", "code": "23514"})
+        self._client.stored.extend(self._rows)
+        return _Response(self._rows)
+
+
+class _FakeClient:
+    """
+    Stand-in for the PostgREST client, answering table(...).insert(...).execute().
+    """
+
+    def __init__(self, down: bool = False):
+        self.down = down
+        self.requests: list[int] = []
+        self.stored: list[dict] = []
+
+    def table(self, name: str) -> "_FakeClient":
+        return self
+
+    def insert(self, rows: list[dict]) -> _Insert:
+        return _Insert(self, rows)
+
+
+def _database(client: _FakeClient) -> AsyncDatabase:
+    database = AsyncDatabase()
+    database._supabase = client
+    return database
+
+
+def _symptoms(*titles: str) -> list[dict]:
+    patient_id = uuid4()
+    return [{"patient_id": patient_id, "title": title, "summary": f"summary of {title}"} for title in titles]
+
+
+def test_rejected_rows_are_singled_out_and_the_others_inserted():
+    client = _FakeClient()
+    titles = [f"ok {index}" for index in range(8)]
+    titles[2], titles[7] = "bad 2", "bad 7"
+    result = asyncio.run(_database(client).add_symptoms(_symptoms(*titles), chunk_size=8))
+    assert [row["title"] for row in result.inserted] == [title for title in titles if title.startswith("ok")]
+    assert result.errors == [RowError(2, "rejected bad 2"), RowError(7, "rejected bad 7")]
+    # each rejected request is retried in halves, depth first, down to the bad rows
+    assert client.requests == [8, 4, 2, 2, 1, 1, 4, 2, 2, 1, 1]
+
+
+def test_a_chunk_without_bad_rows_is_one_request():
+    client = _FakeClient()
+    result = asyncio.run(_database(client).add_symptoms(_symptoms(*(f"ok {index}" for index in range(5))), chunk_size=2))
+    assert len(result.inserted) == 5 and result.errors == []
+    assert client.requests == [2, 2, 1]
+
+
+def test_invalid_rows_are_reported_without_a_request():
+    client = _FakeClient()
+    symptoms = _symptoms("ok 0", "ok 1")
+    del symptoms[1]["summary"]
+    result = asyncio.run(_database(client).add_symptoms(symptoms))
+    assert [row["title"] for row in result.inserted] == ["ok 0"]
+    assert result.errors == [RowError(1, "Missing field 'summary'")]
+    assert client.requests == [1]
+
+
+def test_an_unreachable_database_fails_the_chunk_without_bisecting():
+    client = _FakeClient(down=True)
+    result = asyncio.run(_database(client).add_symptoms(_symptoms("ok 0", "ok 1", "ok 2")))
+    assert result.inserted == []
+    assert [error.index for error in result.errors] == [0, 1, 2]
+    assert client.requests == [3]
@@ -0,0 +1,36 @@
+import pytest
+
+from user.user import END_REPORT_TOKEN, EndTokenFilter
+
+
+def _stream(chunks: list[str]) -> tuple[str, bool]:
+    end_filter = EndTokenFilter()
+    forwarded = "".join(end_filter.feed(chunk) for chunk in chunks)
+    return forwarded + end_filter.flush(), end_filter.stopped
+
+
+def test_text_without_the_token_is_forwarded_whole():
+    assert _stream(["Where does ", "it hurt?"]) == ("Where does it hurt?", False)
+
+
+def test_the_token_and_what_follows_are_dropped():
+    assert _stream(["Thank you.", f" {END_REPORT_TOKEN}", " trailing"]) == ("Thank you. ", True)
+
+
+@pytest.mark.parametrize("split", range(1, len(END_REPORT_TOKEN)))
+def test_the_token_split_across_chunks_never_leaks(split):
+    chunks = ["Thank you.", END_REPORT_TOKEN[:split], END_REPORT_TOKEN[split:] + " trailing"]
+    end_filter = EndTokenFilter()
+    forwarded = [end_filter.feed(chunk) for chunk in chunks]
+    assert forwarded == ["Thank you.", "", ""]
+    assert end_filter.stopped and end_filter.flush() == ""
+
+
+def test_a_held_back_prefix_that_is_not_the_token_is_released():
+    end_filter = EndTokenFilter()
+    assert end_filter.feed("Take <") == "Take "
+    assert end_filter.feed("3 days") == "<3 days"
+    assert end_filter.feed(" <END") == " "
+    # the stream ended on what looked like the start of the token
+    assert end_filter.flush() == "<END"
+    assert not end_filter.stopped
@@ -0,0 +1,54 @@
+import asyncio
+
+from llm.llm_manager import LLMManager
+from llm.stub_backend import LatencyModel, StubBackend
+
+# 39 characters, about 10 tokens
+_TEXT = "x" * 39
+
+
+def _manager(history_budget: int, **kwargs) -> LLMManager:
+    instant = LatencyModel("fixed", 0)
+    backend = StubBackend(instant, instant, instant, turns=100, **kwargs)
+    manager = LLMManager(backend=backend, history_budget=history_budget)
+    manager.restore_state([["user" if index % 2 == 0 else "model", _TEXT] for index in range(6)])
+    return manager
+
+
+def test_oldest_turns_are_folded_into_the_digest_past_the_budget():
+    manager = _manager(history_budget=40)
+    asyncio.run(manager.get_response("It still hurts."))
+    # 60 tokens of turns: folded down to half the budget, keeping a user message first
+    assert manager.digested_turns == 4
+    assert manager.chat_digest == StubBackend.DEFAULT_GENERATE_REPLIES["chat_digest"]
+    history = manager.chat_session.history
+    assert [turn.role for turn in history] == ["user", "model", "user", "model"]
+    assert history[2].text == "It still hurts."
+
+
+def test_the_history_is_kept_whole_within_the_budget_or_without_one():
+    for budget in (0, 1000):
+        manager = _manager(history_budget=budget)
+        asyncio.run(manager.get_response("It still hurts."))
+        assert manager.digested_turns == 0 and manager.chat_digest == ""
+        assert len(manager.chat_session.history) == 8
+
+
+def test_the_digest_is_saved_with_the_session_and_read_by_the_summary():
+    manager = _manager(history_budget=40)
+    asyncio.run(manager.get_response("It still hurts."))
+    exported = manager.export_history()
+    assert exported[0] == ["digest", manager.chat_digest, "4"]
+    resumed = _manager(history_budget=40)
+    resumed.restore_state(exported)
+    assert resumed.chat_digest == manager.chat_digest and resumed.digested_turns == 4
+    assert resumed.export_history() == exported
+    prompt = resumed._summary_prompt()
+    assert prompt.index(manager.chat_digest) < prompt.index("It still hurts.")
+
+
+def test_an_empty_digest_keeps_the_full_history():
+    manager = _manager(history_budget=40, generate_replies={"chat_digest": ""})
+    asyncio.run(manager.get_response("It still hurts."))
+    assert manager.digested_turns == 0
+    assert len(manager.chat_session.history) == 8
@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+from uuid import uuid4
+
+import pytest
+
+from db.cache import HistoryCursor, symptoms_page
+from db.db import AsyncDatabase
+
+START = datetime(2024, 1, 1, tzinfo=UTC)
+
+
+def _rows(*hours: int) -> list[dict]:
+    # a timestamp-ordered symptom list, several entries may share an hour
+    return [{"timestamp": (START + timedelta(hours=hour)).isoformat(), "title": f"entry {index}", "summary": "summary"}
+            for index, hour in enumerate(sorted(hours))]
+
+
+def _all_pages(fetch, limit: int) -> list[str]:
+    titles, cursor = [], None
+    while True:
+        # one more row than asked tells whether there is an older page, as /get_history does
+        rows = fetch(limit + 1, cursor)
+        titles += [row["title"] for row in rows[:limit]]
+        if len(rows) <= limit:
+            return titles
+        cursor = HistoryCursor.decode(HistoryCursor.after(rows[:limit], cursor).encode())
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 5])
+def test_pages_skip_no_entry_sharing_a_timestamp(limit):
+    rows = _rows(0, 1, 1, 1, 1, 2, 3, 3)
+    titles = _all_pages(lambda page_limit, cursor: symptoms_page(rows, page_limit, cursor), limit)
+    assert titles == [row["title"] for row in reversed(rows)]
+
+
+def test_bounds_without_an_offset_are_taken_as_utc():
+    rows = _rows(0, 1, 2, 3)
+    naive_since = (START + timedelta(hours=1)).replace(tzinfo=None)
+    assert [row["title"] for row in symptoms_page(rows, 10, since=naive_since)] == ["entry 3", "entry 2"]
+    cursor = HistoryCursor.decode((START + timedelta(hours=2)).replace(tzinfo=None).isoformat() + "|")
+    assert [row["title"] for row in symptoms_page(rows, 10, cursor)] == ["entry 2", "entry 1", "entry 0"]
+
+
+def test_database_pages_from_the_cached_list_with_naive_bounds():
+    database, patient_id = AsyncDatabase(), uuid4()
+    rows = _rows(0, 1, 1, 2)
+    database.cache.set_symptoms(patient_id, rows, database.cache.symptoms_generation())
+    naive_since = START.replace(tzinfo=None)
+    page = asyncio.run(database.get_symptoms_page(patient_id, limit=10, since=naive_since))
+    assert [row["title"] for row in page] == ["entry 3", "entry 2", "entry 1"]
+    titles = _all_pages(lambda limit, cursor: asyncio.run(database.get_symptoms_page(patient_id, limit, cursor)), 1)
+    assert titles == ["entry 3", "entry 2", "entry 1", "entry 0"]
+
+
+def test_invalid_cursors_are_refused():
+    with pytest.raises(ValueError):
+        HistoryCursor.decode("2024-01-01T00:00:00+00:00")
+    with pytest.raises(ValueError):
+        HistoryCursor.decode("yesterday|")
+
+
+class _Query:
+    """
+    Stand-in for the PostgREST select query of get_symptoms_page, filtering a list of rows.
+    """
+
+    def __init__(self, rows: list[dict]):
+        self._rows = rows
+        self.filters: list[tuple[str, str]] = []
+
+    def table(self, name: str) -> "_Query":
+        return self
+
+    def select(self, columns: str) -> "_Query":
+        return self
+
+    def eq(self, column: str, value: str) -> "_Query":
+        return self
+
+    def lte(self, column: str, value: str) -> "_Query":
+        self.filters.append(("lte", value))
+        bound = datetime.fromisoformat(value)
+        self._rows = [row for row in self._rows if datetime.fromisoformat(row["timestamp"]) <= bound]
+        return self
+
+    def gt(self, column: str, value: str) -> "_Query":
+        self.filters.append(("gt", value))
+        bound = datetime.fromisoformat(value)
+        self._rows = [row for row in self._rows if datetime.fromisoformat(row["timestamp"]) > bound]
+        return self
+
+    def order(self, column: str, desc: bool) -> "_Query":
+        # rows sharing a timestamp come back in no particular order
+        self._rows = sorted(reversed(self._rows), key=lambda row: row["timestamp"], reverse=desc)
+        return self
+
+    def limit(self, count: int) -> "_Query":
+        self._rows = self._rows[:count]
+        return self
+
+    async def execute(self):
+        return type("Response", (), {"data": self._rows})()
+
+
+def test_database_pages_from_supabase_with_naive_bounds():
+    rows = _rows(0, 1, 1, 1, 2)
+    database, patient_id = AsyncDatabase(), uuid4()
+
+    def fetch(limit, cursor, since=None):
+        database._supabase = _Query(rows)
+        return asyncio.run(database.get_symptoms_page(patient_id, limit, cursor, since=since))
+
+    assert _all_pages(fetch, 2) == [row["title"] for row in reversed(rows)]
+    fetch(10, None, since=START.replace(tzinfo=None))
+    assert database._supabase.filters == [("gt", START.isoformat())]
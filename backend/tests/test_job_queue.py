@@ -0,0 +1,176 @@
+import asyncio
+
+import pytest
+
+from jobs.queue import JobQueue, QueueFull
+from user.state_store import SQLiteSessionStateStore
+
+
+async def _started(queue: JobQueue) -> JobQueue:
+    await queue.start()
+    return queue
+
+
+def test_jobs_of_a_key_run_in_submission_order():
+    async def scenario():
+        queue = await _started(JobQueue(workers=4))
+        order = []
+
+        def job(name, delay):
+            async def run():
+                await asyncio.sleep(delay)
+                order.append(name)
+                return name
+            return run
+
+        # the first job is the slowest, the ones behind it must still wait for it
+        jobs = [queue.submit("test", "patient", job(index, delay)) for index, delay in enumerate((0.05, 0.01, 0))]
+        for submitted in jobs:
+            assert await submitted.wait(1)
+        await queue.stop()
+        return order, [submitted.result for submitted in jobs]
+
+    order, results = asyncio.run(scenario())
+    assert order == [0, 1, 2]
+    assert results == [0, 1, 2]
+
+
+def test_jobs_of_different_keys_run_concurrently():
+    async def scenario():
+        queue = await _started(JobQueue(workers=2))
+        release = asyncio.Event()
+        running = []
+
+        def job(name):
+            async def run():
+                running.append(name)
+                await release.wait()
+            return run
+
+        first, second = queue.submit("test", "a", job("a")), queue.submit("test", "b", job("b"))
+        await asyncio.sleep(0.01)
+        both_running = sorted(running) == ["a", "b"] and queue.running == 2
+        release.set()
+        await first.wait(1)
+        await second.wait(1)
+        await queue.stop()
+        return both_running
+
+    assert asyncio.run(scenario())
+
+
+def test_submit_refuses_jobs_past_max_pending():
+    async def scenario():
+        queue = await _started(JobQueue(workers=1, max_pending=2))
+        release = asyncio.Event()
+
+        async def run():
+            await release.wait()
+
+        queue.submit("test", "a", run)
+        await asyncio.sleep(0.01)
+        # the running job does not count, two more may wait
+        queue.submit("test", "a", run)
+        queue.submit("test", "b", run)
+        with pytest.raises(QueueFull):
+            queue.submit("test", "c", run)
+        pending = queue.pending
+        release.set()
+        await queue.stop()
+        return pending
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_coalesces_only_with_a_job_not_started_yet():
+    async def scenario():
+        queue = await _started(JobQueue(workers=1))
+        release = asyncio.Event()
+
+        async def run():
+            await release.wait()
+
+        running = queue.submit("summary", "a", run, coalesce=("summary", "a"))
+        await asyncio.sleep(0.01)
+        queued = queue.submit("summary", "a", run, coalesce=("summary", "a"))
+        retried = queue.submit("summary", "a", run, coalesce=("summary", "a"))
+        release.set()
+        await queued.wait(1)
+        await queue.stop()
+        return running, queued, retried
+
+    running, queued, retried = asyncio.run(scenario())
+    assert queued is not running
+    assert retried is queued
+
+
+def test_failed_and_timed_out_jobs_report_their_error():
+    async def scenario():
+        queue = await _started(JobQueue(workers=2, timeout=0.05))
+
+        async def fail():
+            raise ValueError("bad input")
+
+        async def hang():
+            await asyncio.sleep(1)
+
+        failed, timed_out = queue.submit("test", "a", fail), queue.submit("test", "b", hang)
+        await failed.wait(1)
+        await timed_out.wait(1)
+        await queue.stop()
+        return failed.to_dict(), timed_out.to_dict()
+
+    failed, timed_out = asyncio.run(scenario())
+    assert failed["status"] == "failed" and failed["error"] == "bad input"
+    assert timed_out["status"] == "failed" and timed_out["error"] == "Job timed out"
+
+
+def test_job_status_is_readable_from_another_queue_sharing_the_store(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+
+    async def scenario():
+        accepting, polled = JobQueue(workers=1), JobQueue(workers=1)
+        accepting.configure(SQLiteSessionStateStore(path))
+        polled.configure(SQLiteSessionStateStore(path))
+        await accepting.start()
+
+        async def run():
+            await asyncio.sleep(0.05)
+            return {"answer": 42}
+
+        job = accepting.submit("test", "a", run)
+        await accepting.publish(job)
+        unknown = await polled.load("unknown")
+        finished = await polled.load(job.id, wait=2)
+        await accepting.stop()
+        return unknown, finished
+
+    unknown, finished = asyncio.run(scenario())
+    assert unknown is None
+    assert finished["status"] == "done" and finished["result"] == {"answer": 42}
+
+
+def test_failed_jobs_are_published_and_queues_without_a_store_publish_nothing(tmp_path):
+    store = SQLiteSessionStateStore(str(tmp_path / "state.sqlite3"))
+
+    async def scenario():
+        queue, unpublished = JobQueue(workers=1), JobQueue(workers=1)
+        queue.configure(store)
+        unpublished.configure(None)
+        await queue.start()
+        await unpublished.start()
+
+        async def run():
+            raise ValueError("bad input")
+
+        job = queue.submit("test", "a", run)
+        await job.wait(1)
+        other = unpublished.submit("test", "a", run)
+        await other.wait(1)
+        await queue.stop()
+        await unpublished.stop()
+        return await queue.load(job.id), await unpublished.load(other.id), store.load_job(other.id)
+
+    failed, not_loaded, not_saved = asyncio.run(scenario())
+    assert failed["status"] == "failed" and failed["error"] == "bad input"
+    assert not_loaded is None and not_saved is None
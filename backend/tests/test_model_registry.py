@@ -0,0 +1,52 @@
+import pytest
+
+from llm.model_registry import ModelRegistry
+
+genai = pytest.importorskip("google.generativeai")
+
+
+class FakeModel:
+    def __init__(self, model_name, system_instruction):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+
+@pytest.fixture(autouse=True)
+def fake_models(monkeypatch):
+    monkeypatch.setattr(genai, "GenerativeModel", FakeModel)
+
+
+def test_a_model_is_built_once_per_instruction():
+    registry = ModelRegistry(max_size=4)
+    first = registry.get("model", "instruction")
+    assert registry.get("model", "instruction") is first
+    assert registry.get("model", "other instruction") is not first
+    assert registry.get("other model", "instruction") is not first
+    assert registry.stats()["hits"] == 1
+    assert registry.stats()["misses"] == 3
+
+
+def test_least_recently_used_model_is_evicted_first():
+    registry = ModelRegistry(max_size=2)
+    a = registry.get("model", "a")
+    registry.get("model", "b")
+    # using a makes b the least recently used
+    registry.get("model", "a")
+    registry.get("model", "c")
+    assert registry.get("model", "a") is a
+    assert registry.stats()["evictions"] == 1
+    assert registry.stats()["cached"] == 2
+    misses = registry.stats()["misses"]
+    registry.get("model", "b")
+    assert registry.stats()["misses"] == misses + 1
+
+
+def test_pinned_models_are_never_evicted_nor_counted_against_the_bound():
+    registry = ModelRegistry(max_size=1)
+    pinned = registry.get("model", "static", pinned=True)
+    for index in range(5):
+        registry.get("model", f"templated {index}")
+    assert registry.get("model", "static") is pinned
+    assert registry.stats()["pinned"] == 1
+    assert registry.stats()["cached"] == 1
+    assert registry.stats()["evictions"] == 4
@@ -0,0 +1,78 @@
+import time
+from uuid import uuid4
+
+from db.cache import PatientCache, TTLCache
+
+
+def _row(patient_id, timestamp, title="Cough"):
+    return {"patient_id": str(patient_id), "timestamp": timestamp, "title": title, "summary": "Reported.", "id": 7}
+
+
+def test_symptom_writes_go_through_to_the_cached_list_in_timestamp_order():
+    cache = PatientCache(max_size=8, ttl=60)
+    patient_id = uuid4()
+    cache.set_symptoms(patient_id, [_row(patient_id, "2024-01-01"), _row(patient_id, "2024-01-03")],
+                       cache.symptoms_generation())
+    cache.add_symptom(_row(patient_id, "2024-01-02", "Fever"))
+    rows = cache.get_symptoms(patient_id)
+    assert [row["timestamp"] for row in rows] == ["2024-01-01", "2024-01-02", "2024-01-03"]
+    # only the fields the context is built from are kept for written rows
+    assert rows[1] == {"timestamp": "2024-01-02", "title": "Fever", "summary": "Reported."}
+
+
+def test_a_write_does_not_create_a_list_that_was_not_cached():
+    cache = PatientCache(max_size=8, ttl=60)
+    patient_id = uuid4()
+    cache.add_symptom(_row(patient_id, "2024-01-01"))
+    assert cache.get_symptoms(patient_id) is None
+
+
+def test_a_fetch_that_raced_with_a_write_is_not_cached():
+    cache = PatientCache(max_size=8, ttl=60)
+    patient_id = uuid4()
+    generation = cache.symptoms_generation()
+    # the write lands while the fetch is in flight, its rows may miss it
+    cache.add_symptom(_row(patient_id, "2024-01-02"))
+    cache.set_symptoms(patient_id, [_row(patient_id, "2024-01-01")], generation)
+    assert cache.get_symptoms(patient_id) is None
+    cache.set_symptoms(patient_id, [_row(patient_id, "2024-01-01")], cache.symptoms_generation())
+    assert len(cache.get_symptoms(patient_id)) == 1
+
+
+def test_invalidation_drops_the_lists_and_bumps_the_generation():
+    cache = PatientCache(max_size=8, ttl=60)
+    patient_id = uuid4()
+    generation = cache.symptoms_generation()
+    cache.set_symptoms(patient_id, [_row(patient_id, "2024-01-01")], generation)
+    cache.invalidate_symptoms([str(patient_id)])
+    assert cache.get_symptoms(patient_id) is None
+    assert cache.symptoms_generation() != generation
+
+
+def test_cached_lists_are_copied_in_and_out():
+    cache = PatientCache(max_size=8, ttl=60)
+    patient_id = uuid4()
+    rows = [_row(patient_id, "2024-01-01")]
+    cache.set_symptoms(patient_id, rows, cache.symptoms_generation())
+    rows[0]["title"] = "Changed"
+    cache.get_symptoms(patient_id)[0]["title"] = "Changed too"
+    assert cache.get_symptoms(patient_id)[0]["title"] == "Cough"
+
+
+def test_an_email_change_replaces_the_old_mapping():
+    cache = PatientCache(max_size=8, ttl=60)
+    patient_id = uuid4()
+    cache.set_patient_id("old@example.com", patient_id)
+    cache.update_patient_email(patient_id, "new@example.com")
+    assert cache.get_patient_id("old@example.com") is None
+    assert cache.get_patient_id("new@example.com") == patient_id
+
+
+def test_ttl_cache_entries_expire_and_the_oldest_are_evicted():
+    cache = TTLCache(max_size=2, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("c", 3)
+    assert cache.get("a") is None and cache.get("c") == 3
+    time.sleep(0.1)
+    assert cache.get("c") is None
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+import pytest
+
+from llm.prefix_cache import LocalPrefixStore, PrefixCache, PrefixKey, PrefixStore
+
+# about 2000 tokens, above the size the provider accepts for caching
+_INSTRUCTION = "x" * 8000
+
+
+def _cache(**kwargs):
+    store = LocalPrefixStore()
+    cache = PrefixCache(**{"enabled": True, "max_size": 8, "ttl": 900, "min_tokens": 1024, **kwargs})
+    cache.configure(store)
+    return cache, store
+
+
+def _key(context: str = "history", tag: str = "patient") -> PrefixKey:
+    return PrefixKey("report_hpi", "v1", context, tag)
+
+
+def _wait_deleted(store: LocalPrefixStore, handle) -> bool:
+    # handles are deleted in a background thread
+    deadline = time.monotonic() + 1
+    while handle in store.contents and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return handle not in store.contents
+
+
+def test_a_prefix_is_created_the_second_time_it_is_asked_for_then_reused():
+    cache, store = _cache()
+    assert cache.get("model", _INSTRUCTION, _key()) is None
+    assert store.created == 0
+    handle = cache.get("model", _INSTRUCTION, _key())
+    assert handle is not None and store.contents[handle] == _INSTRUCTION
+    assert cache.get("model", _INSTRUCTION, _key()) == handle
+    assert asyncio.run(cache.aget("model", _INSTRUCTION, _key())) == handle
+    assert store.created == 1 and cache.hits == 2
+
+
+def test_prefixes_are_kept_per_model_and_key():
+    cache, store = _cache()
+    for _ in range(2):
+        first = cache.get("model", _INSTRUCTION, _key("history"))
+        second = cache.get("model", _INSTRUCTION, _key("longer history"))
+        other_model = cache.get("other model", _INSTRUCTION, _key("history"))
+    assert len({first, second, other_model}) == 3 and store.created == 3
+
+
+def test_small_instructions_and_a_disabled_cache_are_never_cached():
+    cache, store = _cache()
+    disabled, disabled_store = _cache(enabled=False)
+    for _ in range(3):
+        assert cache.get("model", "short instruction", _key()) is None
+        assert disabled.get("model", _INSTRUCTION, _key()) is None
+    assert store.created == 0 and disabled_store.created == 0
+
+
+def test_invalidated_prefixes_are_deleted_and_retired():
+    cache, store = _cache()
+    cache.get("model", _INSTRUCTION, _key())
+    handle = cache.get("model", _INSTRUCTION, _key())
+    cache.get("model", _INSTRUCTION, _key(tag="other patient"))
+    kept = cache.get("model", _INSTRUCTION, _key(tag="other patient"))
+    assert cache.invalidate("patient") == 1
+    assert _wait_deleted(store, handle)
+    # a chat started before the change may still ask for the retired key, it is never cached again
+    for _ in range(2):
+        assert cache.get("model", _INSTRUCTION, _key()) is None
+    assert cache.get("model", _INSTRUCTION, _key(tag="other patient")) == kept
+    assert store.created == 2
+
+
+def test_the_least_recently_used_prefix_is_retired_past_the_size():
+    cache, store = _cache(max_size=1)
+    for context in ("first", "first", "second", "second"):
+        cache.get("model", _INSTRUCTION, _key(context))
+    assert store.created == 2 and len(cache) == 1
+    assert _wait_deleted(store, "cachedContents/local-1")
+
+
+def test_expired_prefixes_are_not_handed_out():
+    # the handle stops being handed out a margin before the provider expires it
+    cache, store = _cache(ttl=10)
+    cache.get("model", _INSTRUCTION, _key())
+    assert cache.get("model", _INSTRUCTION, _key()) is not None
+    assert cache.get("model", _INSTRUCTION, _key()) is None
+
+
+def test_failed_creations_fall_back_to_the_full_instruction():
+    class FailingStore(PrefixStore):
+        def create(self, model_name, system_instruction, ttl):
+            raise RuntimeError("quota exceeded")
+
+        def delete(self, handle):
+            pass
+
+    cache = PrefixCache(enabled=True, min_tokens=1)
+    cache.configure(FailingStore())
+    for _ in range(2):
+        assert cache.get("model", _INSTRUCTION, _key()) is None
+    assert cache.failures == 1
+
+
+def test_a_store_must_implement_create_and_delete():
+    class Partial(PrefixStore):
+        def create(self, model_name, system_instruction, ttl):
+            return "handle"
+
+    with pytest.raises(TypeError):
+        Partial()
@@ -0,0 +1,71 @@
+import asyncio
+
+from telemetry.readiness import Readiness
+
+
+async def _instant():
+    pass
+
+
+async def _missing_credentials():
+    raise KeyError("SUPABASE_KEY")
+
+
+def test_the_worker_is_ready_once_every_step_succeeded():
+    readiness = Readiness()
+    readiness.add("db", _instant)
+    readiness.add("llm", _instant)
+    assert not readiness.ready and readiness.stats()["seconds"] is None
+
+    async def scenario():
+        readiness.start()
+        # the steps run in the background, nothing has run before the first await
+        pending = readiness.stats()
+        return pending, await readiness.wait()
+
+    pending, ready = asyncio.run(scenario())
+    assert {step["status"] for step in pending["steps"].values()} == {"pending"}
+    assert ready and readiness.ready
+    stats = readiness.stats()
+    assert stats["ready"] and stats["seconds"] >= 0
+    assert stats["steps"]["db"]["status"] == "ready" and stats["steps"]["db"]["seconds"] >= 0
+
+
+def test_a_failed_step_keeps_the_worker_unready_with_its_error():
+    readiness = Readiness()
+    readiness.add("db", _missing_credentials)
+    readiness.add("llm", _instant)
+
+    async def scenario():
+        readiness.start()
+        return await readiness.wait()
+
+    assert not asyncio.run(scenario())
+    steps = readiness.stats()["steps"]
+    assert steps["db"] == {"status": "failed", "seconds": steps["db"]["seconds"], "error": "KeyError: 'SUPABASE_KEY'"}
+    assert steps["llm"]["status"] == "ready"
+
+
+def test_stop_cancels_the_warm_up():
+    readiness = Readiness()
+    readiness.add("slow", lambda: asyncio.sleep(10))
+
+    async def scenario():
+        readiness.start()
+        await asyncio.sleep(0)
+        await readiness.stop()
+        return await readiness.wait()
+
+    assert not asyncio.run(scenario())
+    assert readiness.stats()["steps"]["slow"]["status"] != "ready"
+
+
+def test_a_worker_without_steps_is_ready_once_started():
+    readiness = Readiness()
+
+    async def scenario():
+        readiness.start()
+        return await readiness.wait()
+
+    assert not readiness.ready
+    assert asyncio.run(scenario())
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+from llm.llm_manager import LLMManager
+from llm.response_cache import ResponseCache, cache_key, response_cache
+from llm.stub_backend import LatencyModel, StubBackend
+
+
+class RecordingBackend(StubBackend):
+    def __init__(self):
+        instant = LatencyModel("fixed", 0)
+        super().__init__(instant, instant, instant)
+        self.temperatures = []
+
+    async def generate_async(self, *args, temperature=None, **kwargs):
+        self.temperatures.append(temperature)
+        return await super().generate_async(*args, temperature=temperature, **kwargs)
+
+
+def test_keys_depend_on_every_input():
+    key = cache_key("model", "instruction", "prompt", {"temperature": 0.0})
+    assert key == cache_key("model", "instruction", "prompt", {"temperature": 0.0})
+    assert key != cache_key("model", "instruction", "prompt", {"temperature": 1.0})
+    assert key != cache_key("model", "instruction", "other prompt", {"temperature": 0.0})
+    assert key != cache_key("other model", "instruction", "prompt", {"temperature": 0.0})
+
+
+def test_invalidate_drops_only_the_entries_of_the_tag():
+    cache = ResponseCache(max_size=8, ttl=60, path=None)
+    cache.set("a", "report of a", tag="patient-a")
+    cache.set("b", "report of b", tag="patient-b")
+    cache.set("static", "title")
+    cache.invalidate("patient-a")
+    assert cache.get("a") is None
+    assert cache.get("b") == "report of b"
+    assert cache.get("static") == "title"
+
+
+def test_invalidation_reaches_the_disk_tier_shared_by_other_workers(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache, other_worker = ResponseCache(8, 60, path), ResponseCache(8, 60, path)
+    cache.set("a", "report of a", tag="patient-a")
+    cache.set("b", "report of b", tag="patient-b")
+    assert other_worker.get("a") == "report of a"
+    asyncio.run(cache.ainvalidate("patient-a"))
+    assert cache.get("a") is None
+    assert ResponseCache(8, 60, path).get("a") is None
+    assert ResponseCache(8, 60, path).get("b") == "report of b"
+
+
+def test_async_access_reads_and_writes_both_tiers(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache(8, 60, path)
+
+    async def scenario():
+        await cache.aset("a", "report", tag="patient-a")
+        return await ResponseCache(8, 60, path).aget("a"), await cache.aget("missing")
+
+    assert asyncio.run(scenario()) == ("report", None)
+    assert cache.stats()["hits"] == 0 and cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entries_are_evicted_and_entries_expire():
+    cache = ResponseCache(max_size=2, ttl=0.05, path=None)
+    cache.set("a", "1", tag="patient")
+    cache.set("b", "2", tag="patient")
+    cache.get("a")
+    cache.set("c", "3", tag="patient")
+    assert cache.get("b") is None and cache.get("a") == "1"
+    time.sleep(0.1)
+    assert cache.get("a") is None and cache.get("c") is None
+    # evicted and expired entries are unlinked from their tag
+    cache.invalidate("patient")
+    assert cache.stats()["size"] == 0
+
+
+def test_a_disabled_cache_stores_nothing():
+    cache = ResponseCache(max_size=0, ttl=60, path=None)
+    cache.set("a", "report", tag="patient-a")
+    assert not cache.enabled
+    assert cache.get("a") is None
+
+
+def test_cached_call_sites_run_at_temperature_zero_and_are_dropped_when_the_history_changes():
+    backend = RecordingBackend()
+    entry = {"timestamp": "2024-01-01", "title": "Cough", "summary": "Dry cough."}
+    manager = LLMManager(user_context=[entry], backend=backend, cache_tag="patient-cached",
+                         cache_call_sites=frozenset(("report_hpi",)), hpi_top_k=0)
+    instruction, prompt, _ = manager._hpi_request("cough")
+    key, tag = manager._cache_entry(instruction, prompt, "report_hpi")
+
+    async def scenario():
+        first = await manager._report_hpi("cough")
+        second = await manager._report_hpi("cough")
+        await manager.get_report_reason("cough")
+        cached = response_cache.get(key)
+        await manager.extend_user_context([{**entry, "timestamp": "2024-02-01"}])
+        return first, second, cached
+
+    first, second, cached = asyncio.run(scenario())
+    assert first == second == cached
+    assert tag == "patient-cached"
+    # the second HPI came from the cache, the reason title is not a cached call site here
+    assert backend.temperatures == [0.0, None]
+    assert response_cache.get(key) is None
@@ -0,0 +1,74 @@
+import pytest
+
+from llm.retrieval import BM25Index, tokenize
+from llm.user_context import UserContext
+
+
+def _index(*documents: str) -> BM25Index:
+    index = BM25Index()
+    for doc_id, text in enumerate(documents):
+        index.add(doc_id, text)
+    return index
+
+
+def test_tokenize_lowercases_and_drops_stopwords():
+    assert tokenize("The patient reports a Sharp pain in the right ear.") == ["patient", "sharp", "pain", "right", "ear"]
+
+
+def test_search_ranks_matching_documents_best_first():
+    index = _index(
+        "Headache at the temples, moderate pain.",
+        "Crampy stomach pain after lunch.",
+        "Sharp ear pain in the right ear since last night.",
+    )
+    results = index.search("ear pain", k=3)
+    assert [doc_id for doc_id, _ in results][0] == 2
+    assert len(results) == 3
+    assert results == sorted(results, key=lambda item: item[1], reverse=True)
+
+
+def test_rare_terms_weigh_more_than_common_ones():
+    index = _index("pain in the knee", "pain in the back", "pain and fever")
+    assert index.search("pain fever", k=1)[0][0] == 2
+
+
+def test_documents_sharing_no_term_are_not_returned():
+    index = _index("Headache at the temples.", "Crampy stomach pain.")
+    assert index.search("rash", k=5) == []
+    assert [doc_id for doc_id, _ in index.search("stomach", k=5)] == [1]
+
+
+def test_search_returns_at_most_k_documents():
+    index = _index(*(f"cough day {day}" for day in range(10)))
+    assert len(index.search("cough", k=3)) == 3
+    assert index.search("cough", k=0) == []
+    assert BM25Index().search("cough", k=3) == []
+
+
+def test_a_document_id_can_only_be_added_once():
+    index = _index("cough")
+    with pytest.raises(ValueError):
+        index.add(0, "fever")
+    assert len(index) == 1
+
+
+def _context() -> UserContext:
+    symptoms = ["Headache", "Stomach pain", "Ear pain", "Cough", "Back pain", "Fever"]
+    return UserContext([{"timestamp": f"2024-01-0{day + 1}", "title": title, "summary": "Reported."}
+                        for day, title in enumerate(symptoms)])
+
+
+def _titles(text: str) -> list[str]:
+    return [line.split("] ")[-1].split(":")[0] for line in text.splitlines()]
+
+
+def test_relevant_text_keeps_the_matching_entries_in_chronological_order():
+    assert _titles(_context().relevant_text("ear ache and stomach cramps", k=2)) == ["Stomach pain", "Ear pain"]
+
+
+def test_relevant_text_fills_the_slots_left_by_the_matches_with_the_latest_entries():
+    assert _titles(_context().relevant_text("headache", k=3)) == ["Headache", "Back pain", "Fever"]
+
+
+def test_relevant_text_without_matching_terms_returns_the_latest_entries():
+    assert _titles(_context().relevant_text("rash", k=2, background="Asthma")) == ["Asthma", "Back pain", "Fever"]
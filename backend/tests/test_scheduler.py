@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm.scheduler import LLMOverloaded, LLMScheduler, TokenBucket
+
+
+class ProviderError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"provider error {code}")
+        self.code = code
+
+
+def test_token_bucket_allows_a_burst_then_makes_callers_wait():
+    bucket = TokenBucket(per_minute=60)
+    start = time.monotonic()
+    assert bucket.reserve(60, now=start) == 0.0
+    # one unit per second: the next unit is a second away, the one after that two
+    assert bucket.reserve(1, now=start) == pytest.approx(1.0, abs=0.01)
+    assert bucket.reserve(1, now=start) == pytest.approx(2.0, abs=0.01)
+
+
+def test_token_bucket_refills_with_time_up_to_a_minute_worth():
+    bucket = TokenBucket(per_minute=60)
+    start = time.monotonic()
+    bucket.reserve(60, now=start)
+    assert bucket.reserve(10, now=start + 10) == 0.0
+    assert bucket.reserve(1, now=start + 10) == pytest.approx(1.0, abs=0.01)
+    bucket = TokenBucket(per_minute=60)
+    # an idle hour does not bank more than a minute's worth
+    assert bucket.reserve(60, now=start + 3600) == 0.0
+    assert bucket.reserve(1, now=start + 3600) > 0
+
+
+def test_token_bucket_charge_delays_the_next_reservation():
+    bucket = TokenBucket(per_minute=60)
+    start = time.monotonic()
+    bucket.charge(90, now=start)
+    assert bucket.reserve(1, now=start) == pytest.approx(31.0, abs=0.01)
+
+
+def test_disabled_token_bucket_never_waits():
+    bucket = TokenBucket(per_minute=0)
+    assert bucket.reserve(10 ** 9, now=time.monotonic()) == 0.0
+
+
+def test_rate_limit_halves_the_concurrency_limit_and_successes_grow_it_back():
+    scheduler = LLMScheduler(rpm=0, tpm=0, max_concurrency=8, retries=1, backoff=0)
+    attempts = []
+
+    def run():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise ProviderError(429)
+        return "ok"
+
+    assert scheduler.call("chat", 10, run) == "ok"
+    assert len(attempts) == 2
+    # halved by the 429, then +1/limit by the retry that succeeded
+    assert scheduler.stats()["concurrency_limit"] == 4
+    assert scheduler.rate_limited == 1 and scheduler.retries == 1
+    for _ in range(40):
+        scheduler.call("chat", 10, lambda: "ok")
+    assert scheduler.stats()["concurrency_limit"] == 8
+
+
+def test_gives_up_with_llm_overloaded_after_the_retries():
+    scheduler = LLMScheduler(rpm=0, tpm=0, max_concurrency=4, retries=2, backoff=0)
+    attempts = []
+
+    def run():
+        attempts.append(None)
+        raise ProviderError(503)
+
+    with pytest.raises(LLMOverloaded):
+        scheduler.call("summary", 10, run)
+    assert len(attempts) == 3
+    assert scheduler.active == 0
+
+
+def test_errors_that_are_not_retriable_are_raised_at_once():
+    scheduler = LLMScheduler(rpm=0, tpm=0, max_concurrency=4, retries=3, backoff=0)
+
+    def run():
+        raise ProviderError(400)
+
+    with pytest.raises(ProviderError):
+        scheduler.call("chat", 10, run)
+    assert scheduler.retries == 0 and scheduler.active == 0
+
+
+def test_waiting_calls_are_admitted_by_lane_then_arrival():
+    async def scenario():
+        scheduler = LLMScheduler(rpm=0, tpm=0, max_concurrency=1, backoff=0)
+        release = asyncio.Event()
+        order = []
+
+        async def hold():
+            await release.wait()
+            return "held"
+
+        def call(call_site, name):
+            async def run():
+                order.append(name)
+                return name
+            return asyncio.create_task(scheduler.call_async(call_site, 10, run))
+
+        holder = asyncio.create_task(scheduler.call_async("chat", 10, hold))
+        await asyncio.sleep(0)
+        waiting = [call("summary", "summary"), call("report_hpi", "report"), call("chat", "chat 1"), call("chat", "chat 2")]
+        await asyncio.sleep(0.01)
+        assert scheduler.queued == 4
+        release.set()
+        await asyncio.gather(holder, *waiting)
+        return order
+
+    assert asyncio.run(scenario()) == ["chat 1", "chat 2", "report", "summary"]
+
+
+def test_concurrency_limit_caps_calls_in_flight_from_threads():
+    scheduler = LLMScheduler(rpm=0, tpm=0, max_concurrency=2)
+    lock = threading.Lock()
+    in_flight = peak = 0
+
+    def run():
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        threading.Event().wait(0.01)
+        with lock:
+            in_flight -= 1
+        return "ok"
+
+    threads = [threading.Thread(target=scheduler.call, args=("chat", 10, run)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == 2
+    assert scheduler.active == 0
@@ -0,0 +1,102 @@
+import asyncio
+import time
+from uuid import uuid4
+
+import pytest
+
+from user.session_store import SessionStore
+from user.state_store import SQLiteSessionStateStore
+
+
+class FakeUser:
+    def __init__(self, user_id, state_version=None):
+        self.user_id = user_id
+        self.state_version = state_version
+
+
+def test_least_recently_used_session_is_evicted_first():
+    built = []
+
+    def factory(user_id):
+        built.append(user_id)
+        return FakeUser(user_id)
+
+    sessions = SessionStore(factory, max_size=2)
+    a, b, c = uuid4(), uuid4(), uuid4()
+    sessions.get(a)
+    sessions.get(b)
+    # touching a makes b the least recently used
+    sessions.get(a)
+    sessions.get(c)
+    assert a in sessions and c in sessions and b not in sessions
+    assert sessions.evictions == 1
+    sessions.get(b)
+    assert built == [a, b, c, b]
+
+
+def test_get_returns_the_same_session_until_it_is_evicted():
+    sessions = SessionStore(FakeUser, max_size=4)
+    user_id = uuid4()
+    first = sessions.get(user_id)
+    assert sessions.get(user_id) is first
+    assert sessions.stats()["hits"] == 1
+    assert sessions.stats()["misses"] == 1
+
+
+def test_idle_sessions_expire():
+    sessions = SessionStore(FakeUser, max_size=4, idle_ttl=0.05)
+    user_id = uuid4()
+    first = sessions.get(user_id)
+    time.sleep(0.1)
+    assert sessions.get(user_id) is not first
+    assert sessions.expirations == 1
+
+
+def test_async_factories_are_awaited():
+    async def factory(user_id):
+        await asyncio.sleep(0)
+        return FakeUser(user_id)
+
+    sessions = SessionStore(factory)
+    user_id = uuid4()
+    user = asyncio.run(sessions.aget(user_id))
+    assert isinstance(user, FakeUser) and user.user_id == user_id
+
+
+def test_state_store_requires_restore():
+    with pytest.raises(ValueError):
+        SessionStore(FakeUser, state_store=SQLiteSessionStateStore(":memory:"))
+
+
+def _state_store_sessions(store):
+    restored = []
+
+    def restore(user_id, state):
+        restored.append(state.version)
+        return FakeUser(user_id, state.version)
+
+    return SessionStore(FakeUser, state_store=store, restore=restore), restored
+
+
+def test_a_session_moved_on_by_another_worker_is_restored_from_the_state_store():
+    store = SQLiteSessionStateStore(":memory:")
+    sessions, restored = _state_store_sessions(store)
+    user_id = uuid4()
+    store.save(user_id, [], {"version": 1})
+    user = sessions.get(user_id)
+    assert restored == [1] and user.state_version == 1
+    assert sessions.get(user_id) is user
+    # another worker saves the session: the copy held in memory is stale
+    store.save(user_id, [["user", "hello"]], None)
+    moved_on = sessions.get(user_id)
+    assert moved_on is not user
+    assert restored == [1, 2] and moved_on.state_version == 2
+    assert sessions.stale == 1
+
+
+def test_a_session_never_saved_is_kept_in_memory():
+    sessions, restored = _state_store_sessions(SQLiteSessionStateStore(":memory:"))
+    user_id = uuid4()
+    user = asyncio.run(sessions.aget(user_id))
+    assert asyncio.run(sessions.aget(user_id)) is user
+    assert restored == [] and sessions.stale == 0
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from jobs.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    async def scenario():
+        flights = SingleFlight()
+        runs = 0
+
+        async def load():
+            nonlocal runs
+            runs += 1
+            await asyncio.sleep(0.01)
+            return {"patient": 1}
+
+        results = await asyncio.gather(*(flights.do(("load_user", 1), load) for _ in range(5)))
+        return runs, results, len(flights)
+
+    runs, results, in_flight = asyncio.run(scenario())
+    assert runs == 1
+    assert results == [{"patient": 1}] * 5
+    assert in_flight == 0
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flights = SingleFlight()
+        runs = []
+
+        def load(key):
+            async def run():
+                runs.append(key)
+                await asyncio.sleep(0.01)
+                return key
+            return run
+
+        results = await asyncio.gather(flights.do(("load_user", 1), load(1)), flights.do(("load_user", 2), load(2)))
+        return sorted(runs), results
+
+    assert asyncio.run(scenario()) == ([1, 2], [1, 2])
+
+
+def test_the_error_reaches_every_waiting_caller_and_is_not_kept():
+    async def scenario():
+        flights = SingleFlight()
+        runs = 0
+
+        async def fail():
+            nonlocal runs
+            runs += 1
+            await asyncio.sleep(0.01)
+            raise LookupError("no such patient")
+
+        results = await asyncio.gather(*(flights.do(("patient_by_email", "a@b.c"), fail) for _ in range(3)),
+                                       return_exceptions=True)
+
+        async def succeed():
+            return "patient"
+
+        # the failure is not cached, the next call runs again
+        retried = await flights.do(("patient_by_email", "a@b.c"), succeed)
+        return runs, results, retried
+
+    runs, results, retried = asyncio.run(scenario())
+    assert runs == 1
+    assert all(isinstance(result, LookupError) and str(result) == "no such patient" for result in results)
+    assert retried == "patient"
+
+
+def test_a_cancelled_caller_does_not_cancel_the_others():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def load():
+            await asyncio.sleep(0.02)
+            return "loaded"
+
+        first = asyncio.create_task(flights.do(("load_user", 1), load))
+        second = asyncio.create_task(flights.do(("load_user", 1), load))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == "loaded"
@@ -0,0 +1,72 @@
+from uuid import uuid4
+
+import pytest
+
+from user.state_store import SQLiteSessionStateStore, SessionStateStore, create_state_store
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state.sqlite3")
+
+
+def test_every_save_bumps_the_version_and_keeps_the_context_unless_given(path):
+    store = SQLiteSessionStateStore(path)
+    user_id = uuid4()
+    assert store.version(user_id) is None and store.load(user_id) is None
+    assert store.save(user_id, [["user", "hi"]], {"version": 1}) == 1
+    assert store.save(user_id, [["user", "hi"], ["model", "hello"]], None) == 2
+    state = store.load(user_id)
+    assert state.version == 2
+    assert state.history == [["user", "hi"], ["model", "hello"]]
+    assert state.context == {"version": 1}
+    assert store.save(user_id, [], {"version": 2}) == 3
+    assert store.load(user_id).context == {"version": 2}
+
+
+def test_the_first_save_must_carry_the_context(path):
+    store = SQLiteSessionStateStore(path)
+    with pytest.raises(ValueError):
+        store.save(uuid4(), [], None)
+
+
+def test_sessions_are_shared_by_the_stores_of_one_file_and_expire(path):
+    writer, reader = SQLiteSessionStateStore(path), SQLiteSessionStateStore(path, ttl=-1)
+    user_id = uuid4()
+    writer.save(user_id, [], {"version": 1})
+    assert SQLiteSessionStateStore(path).version(user_id) == 1
+    # a session older than the ttl is gone
+    assert reader.version(user_id) is None and reader.load(user_id) is None
+    writer.delete(user_id)
+    assert writer.version(user_id) is None
+
+
+def test_a_job_status_never_goes_back_a_stage(path):
+    store = SQLiteSessionStateStore(path)
+    store.save_job("job", 1, {"status": "running"}, ttl=60)
+    store.save_job("job", 2, {"status": "done", "result": 42}, ttl=60)
+    # a late 'queued' publish must not hide the result
+    store.save_job("job", 0, {"status": "queued"}, ttl=60)
+    assert SQLiteSessionStateStore(path).load_job("job") == {"status": "done", "result": 42}
+    assert store.load_job("unknown") is None
+
+
+def test_expired_job_statuses_are_not_returned(path):
+    store = SQLiteSessionStateStore(path)
+    store.save_job("job", 2, {"status": "done"}, ttl=-1)
+    assert store.load_job("job") is None
+
+
+def test_the_memory_backend_keeps_no_state_store():
+    assert create_state_store("memory") is None
+    with pytest.raises(ValueError):
+        create_state_store("redis")
+
+
+def test_a_store_must_implement_every_method():
+    class Partial(SessionStateStore):
+        def version(self, user_id):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
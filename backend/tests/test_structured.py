@@ -0,0 +1,22 @@
+import pytest
+
+from llm.llm_manager import _object_schema, parse_structured
+
+SCHEMA = _object_schema("title", "summary")
+
+
+def test_parses_and_strips_the_required_fields():
+    reply = '{"title": " Headache ", "summary": "Throbbing headache since yesterday.\\n", "extra": 1}'
+    assert parse_structured(reply, SCHEMA) == {"title": "Headache", "summary": "Throbbing headache since yesterday."}
+
+
+@pytest.mark.parametrize("reply", [
+    "Headache",
+    '["Headache", "summary"]',
+    '{"title": "Headache"}',
+    '{"title": "Headache", "summary": 3}',
+    '{"title": "  ", "summary": "Throbbing headache."}',
+])
+def test_rejects_replies_that_do_not_match_the_schema(reply):
+    with pytest.raises(ValueError):
+        parse_structured(reply, SCHEMA)
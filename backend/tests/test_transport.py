@@ -0,0 +1,64 @@
+import asyncio
+
+import httpx
+
+from db.transport import SharedTransport, TransportConfig
+
+
+class ScriptedPool(httpx.AsyncBaseTransport):
+    """
+    Stands in for the connection pool: answers each request with the next scripted status or raises the next error.
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, type) and issubclass(outcome, Exception):
+            raise outcome("scripted failure", request=request)
+        return httpx.Response(outcome, request=request)
+
+
+def _send(method: str, *outcomes, retries: int = 2):
+    transport = SharedTransport(TransportConfig(retries=retries, backoff_base=0.0))
+    pool = transport._async_pool = ScriptedPool(*outcomes)
+
+    async def send():
+        async with transport.async_client("http://db.invalid", {}) as client:
+            return await client.request(method, "/rest/v1/symptoms")
+
+    try:
+        response = asyncio.run(send())
+    except httpx.TransportError as e:
+        return e, pool.requests
+    return response.status_code, pool.requests
+
+
+def test_connect_errors_are_retried_for_every_method():
+    assert _send("GET", httpx.ConnectError, 200) == (200, 2)
+    assert _send("POST", httpx.ConnectError, httpx.ConnectTimeout, 201) == (201, 3)
+
+
+def test_posts_are_not_retried_once_they_may_have_reached_the_server():
+    error, requests = _send("POST", httpx.ReadTimeout, 201)
+    assert isinstance(error, httpx.ReadTimeout) and requests == 1
+    assert _send("POST", 503, 201) == (503, 1)
+
+
+def test_idempotent_requests_are_retried_on_read_errors_and_gateway_statuses():
+    assert _send("GET", httpx.ReadTimeout, 200) == (200, 2)
+    assert _send("GET", httpx.RemoteProtocolError, 503, 200) == (200, 3)
+
+
+def test_other_statuses_are_returned_as_is():
+    assert _send("GET", 500, 200) == (500, 1)
+    assert _send("GET", 404) == (404, 1)
+
+
+def test_retries_are_bounded():
+    assert _send("GET", 503, 503, 503, 200, retries=2) == (503, 3)
+    error, requests = _send("POST", httpx.ConnectError, httpx.ConnectError, retries=1)
+    assert isinstance(error, httpx.ConnectError) and requests == 2
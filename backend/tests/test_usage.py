@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+import pytest
+
+import llm.usage
+from llm.usage import LLMCall, UsageLedger, account, pseudonym, report_usage
+
+
+def _call(call_site: str = "report_hpi", patient: str = "patient-a", prompt_tokens: int = 100,
+          output_tokens: int = 10) -> LLMCall:
+    call = LLMCall(call_site, "model", patient)
+    call.prompt_tokens, call.output_tokens = prompt_tokens, output_tokens
+    return call
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    ledger = UsageLedger(window=10, max_patients=2, path=None, salt="salt")
+    monkeypatch.setattr(llm.usage, "usage_ledger", ledger)
+    return ledger
+
+
+def test_calls_are_totalled_per_series_and_endpoint(ledger):
+    ledger.record(_call(prompt_tokens=100), 1.0, "GET /api/doctor_report/{user_id}")
+    ledger.record(_call(prompt_tokens=300), 3.0, "GET /api/doctor_report/{user_id}")
+    ledger.record(_call("chat", prompt_tokens=50), 0.5, "POST /api/response/{user_id}")
+    stats = ledger.stats()
+    assert stats["calls"] == 3
+    assert list(stats["endpoints"]) == ["GET /api/doctor_report/{user_id}", "POST /api/response/{user_id}"]
+    assert stats["endpoints"]["GET /api/doctor_report/{user_id}"]["prompt_tokens"] == 400
+    heaviest = stats["series"][0]
+    assert heaviest["call_site"] == "report_hpi" and heaviest["calls"] == 2 and heaviest["seconds"] == 4.0
+    assert heaviest["prompt_tokens_percentiles"] == {"p50": 300, "p95": 300, "p99": 300}
+
+
+def test_patients_appear_in_the_stats_by_pseudonym_only(ledger):
+    ledger.record(_call(patient="patient-a", prompt_tokens=10), 0.1, None)
+    ledger.record(_call(patient="patient-b", prompt_tokens=500), 0.1, None)
+    ledger.record(_call(patient=None), 0.1, None)
+    patients = ledger.stats()["top_patients"]
+    assert [patient["patient"] for patient in patients] == [pseudonym("patient-b", "salt"), pseudonym("patient-a", "salt")]
+    assert "patient-a" not in json.dumps(ledger.stats())
+    assert pseudonym("patient-a", "salt") != pseudonym("patient-a", "other salt")
+
+
+def test_the_least_recently_active_patients_are_dropped(ledger):
+    for patient in ("patient-a", "patient-b", "patient-a", "patient-c"):
+        ledger.record(_call(patient=patient), 0.1, None)
+    patients = {patient["patient"]: patient["calls"] for patient in ledger.stats()["top_patients"]}
+    assert patients == {pseudonym("patient-a", "salt"): 2, pseudonym("patient-c", "salt"): 1}
+
+
+def test_the_log_keeps_one_record_per_call_with_the_patient_id(tmp_path):
+    path = tmp_path / "usage.jsonl"
+    ledger = UsageLedger(path=str(path), salt="salt")
+    ledger.record(_call(), 0.25, "job.doctor_report")
+    ledger.record(_call("chat", patient="patient-b"), 0.5, None)
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(record["patient"], record["endpoint"]) for record in records] == [("patient-a", "job.doctor_report"), ("patient-b", "unknown")]
+    assert ledger.stats()["log"] == str(path)
+
+
+def test_reported_token_counts_are_used_and_estimated_otherwise(ledger):
+    with account("report_hpi", "model", "patient-a") as call:
+        call.prompt_chars, call.response_chars = 4000, 400
+        report_usage(900, 80, cached_tokens=512)
+    with account("chat", "model", "patient-a") as call:
+        call.prompt_chars, call.response_chars = 4000, 400
+    series = {value["call_site"]: value for value in ledger.stats()["series"]}
+    reported, estimated = series["report_hpi"], series["chat"]
+    assert (reported["prompt_tokens"], reported["output_tokens"], reported["cached_tokens"]) == (900, 80, 512)
+    assert reported["estimated_calls"] == 0
+    assert (estimated["prompt_tokens"], estimated["output_tokens"], estimated["estimated_calls"]) == (1001, 101, 1)
+    # outside an accounted call the counts go nowhere
+    report_usage(1, 1)
+    assert ledger.stats()["calls"] == 2
+
+
+def test_calls_that_raise_are_not_accounted(ledger):
+    with pytest.raises(RuntimeError):
+        with account("chat", "model"):
+            raise RuntimeError("quota exceeded")
+    assert ledger.stats()["calls"] == 0
+
+
+def test_the_admin_routes_need_the_admin_token(monkeypatch):
+    from fastapi import HTTPException
+
+    from routes import router
+
+    def status(token):
+        try:
+            asyncio.run(router.require_admin(token))
+        except HTTPException as e:
+            return e.status_code
+        return 200
+
+    monkeypatch.setattr(router, "ADMIN_TOKEN", None)
+    assert status("anything") == 404
+    monkeypatch.setattr(router, "ADMIN_TOKEN", "secret")
+    assert (status(None), status("wrong"), status("secret")) == (403, 403, 200)
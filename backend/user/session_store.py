@@ -0,0 +1,206 @@
+import asyncio
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Union
+from uuid import UUID
+
+from user.state_store import SessionState, SessionStateStore
+from user.user import User
+
+SESSION_MAX_SIZE = int(os.getenv("SESSION_MAX_SIZE", 512))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", 30 * 60))  # seconds
+
+
+class SessionStore:
+    """
+    Bounded in-memory store of active User sessions, keyed by user_id.
+
+    Sessions are evicted least-recently-used first once max_size is reached,
+    and dropped once they have been idle for longer than idle_ttl seconds.
+    An evicted session is rebuilt on its next access by the factory, which
+    reloads the patient's symptom history from the database. The factory may
+    be a coroutine function, in which case sessions are fetched with aget.
+
+    With a state_store, sessions are saved there after every change (see save),
+    and a session missing from memory is resumed from its saved state with restore
+    before falling back to the factory. A session held in memory is only used while
+    its saved version is unchanged, so workers sharing the state store can serve the
+    same user in turns.
+    """
+
+    def __init__(self, factory: Callable[[UUID], Union[User, Awaitable[User]]], max_size: int = SESSION_MAX_SIZE,
+                 idle_ttl: float = SESSION_IDLE_TTL, state_store: Optional[SessionStateStore] = None,
+                 restore: Optional[Callable[[UUID, SessionState], User]] = None):
+        if state_store is not None and restore is None:
+            raise ValueError("restore must be given along with state_store")
+        if max_size <= 0:
+            raise ValueError("max_size must be a positive integer")
+        self._factory = factory
+        self._max_size = max_size
+        self._idle_ttl = idle_ttl
+        self._state_store = state_store
+        self._restore = restore
+        # user_id -> (user, last access time), least recently used first
+        self._sessions: OrderedDict[UUID, tuple[User, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale = 0
+        self.restores = 0
+
+    def get(self, user_id: UUID) -> User:
+        """
+        Return the session for user_id, resuming it from the state store or creating
+        it with the factory if it is not in memory (or was evicted, or is stale).
+        """
+        user = self._lookup(user_id)
+        if user is not None and self._state_store is not None:
+            user = self._check_version(user, self._state_store.version(user_id))
+        if user is None:
+            state = self._state_store.load(user_id) if self._state_store is not None else None
+            # build outside the lock - the factory hits the database
+            user = self._restore_state(user_id, state) if state is not None else self._factory(user_id)
+            self.put(user_id, user)
+        return user
+
+    async def aget(self, user_id: UUID) -> User:
+        """
+        Async variant of get, awaiting the factory when it is a coroutine function.
+        """
+        user = self._lookup(user_id)
+        if user is not None and self._state_store is not None:
+            user = self._check_version(user, await self._call_store(self._state_store.version, user_id))
+        if user is None:
+            state = await self._call_store(self._state_store.load, user_id) if self._state_store is not None else None
+            if state is not None:
+                user = self._restore_state(user_id, state)
+            else:
+                user = self._factory(user_id)
+                if inspect.isawaitable(user):
+                    user = await user
+            self.put(user_id, user)
+        return user
+
+    def save(self, user_id: UUID, user: User) -> None:
+        """
+        Save the chat history of user in the state store, along with its user context if
+        that changed since the last save. Call after every request that changed the session.
+        """
+        if self._state_store is None:
+            return
+        context_version = user.llm.user_context.version
+        history, context = self._export(user, context_version)
+        user.state_version = self._state_store.save(user_id, history, context)
+        user.saved_context_version = context_version
+
+    async def asave(self, user_id: UUID, user: User) -> None:
+        """
+        Async variant of save.
+        """
+        if self._state_store is None:
+            return
+        context_version = user.llm.user_context.version
+        history, context = self._export(user, context_version)
+        user.state_version = await self._call_store(self._state_store.save, user_id, history, context)
+        user.saved_context_version = context_version
+
+    @staticmethod
+    def _export(user: User, context_version: int) -> tuple[list[list[str]], Optional[dict[str, Any]]]:
+        context = None
+        if context_version != user.saved_context_version:
+            # a summary changes the context, so the summarized turns are saved along with it
+            context = {**user.llm.user_context.to_state(), "summarized_turns": user.llm.summarized_turns}
+        return user.llm.export_history(), context
+
+    def _check_version(self, user: User, saved_version: Optional[int]) -> Optional[User]:
+        """
+        Returns user if it is at the saved version of its session, None if another worker moved it on.
+        """
+        if saved_version is None:
+            # never saved, or the saved state expired: the session in memory is the latest
+            user.state_version = None
+            user.saved_context_version = None
+            return user
+        if saved_version != user.state_version:
+            with self._lock:
+                self.stale += 1
+            return None
+        return user
+
+    def _restore_state(self, user_id: UUID, state: SessionState) -> User:
+        with self._lock:
+            self.restores += 1
+        return self._restore(user_id, state)
+
+    async def _call_store(self, function: Callable, *args):
+        if self._state_store.blocking:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    def _lookup(self, user_id: UUID) -> User | None:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._sessions.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._sessions[user_id] = (entry[0], now)
+            self._sessions.move_to_end(user_id)
+            return entry[0]
+
+    def put(self, user_id: UUID, user: User) -> None:
+        """
+        Insert or replace the session for user_id, evicting the least recently
+        used sessions if the store is full.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[user_id] = (user, now)
+            self._sessions.move_to_end(user_id)
+            self._expire(now)
+            while len(self._sessions) > self._max_size:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, user_id: UUID) -> None:
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def _expire(self, now: float) -> None:
+        # entries are ordered by last access, so stop at the first fresh one
+        while self._sessions:
+            user_id, (_, last_access) = next(iter(self._sessions.items()))
+            if now - last_access <= self._idle_ttl:
+                break
+            self._sessions.popitem(last=False)
+            self.expirations += 1
+
+    def __contains__(self, user_id: UUID) -> bool:
+        with self._lock:
+            return user_id in self._sessions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._sessions),
+                "max_size": self._max_size,
+                "idle_ttl": self._idle_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale": self.stale,
+                "restores": self.restores,
+                "state_store": type(self._state_store).__name__ if self._state_store is not None else None,
+            }
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, NamedTuple, Optional
+from uuid import UUID
+
+# 'memory' keeps no saved state besides the live sessions of this worker, 'sqlite' shares it between workers
+# through SESSION_STATE_PATH
+SESSION_STATE_BACKEND = os.getenv("SESSION_STATE_BACKEND", "memory")
+SESSION_STATE_PATH = os.getenv("SESSION_STATE_PATH", "session_state.sqlite3")
+# saved sessions untouched for this many seconds are dropped
+SESSION_STATE_TTL = float(os.getenv("SESSION_STATE_TTL", 24 * 60 * 60))
+
+
+class SessionState(NamedTuple):
+    """
+    A saved chat session: the store's version counter, the chat turns as [role, text] pairs
+    (after a ['digest', text, turn count] entry if older turns were folded into a digest),
+    and the user context as saved by UserContext.to_state, with the number of chat turns already summarized.
+    """
+    version: int
+    history: list[list[str]]
+    context: dict[str, Any]
+
+
+class SessionStateStore(ABC):
+    """
+    Where chat sessions are saved between requests, so any worker can resume any user's session.
+
+    Every save bumps the session's version, which lets a worker holding a live session in memory
+    check cheaply whether another worker has moved the session on since.
+    Stores whose calls block on I/O set blocking, async callers then run them in a thread.
+    """
+    blocking = False
+
+    @abstractmethod
+    def version(self, user_id: UUID) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def load(self, user_id: UUID) -> Optional[SessionState]:
+        ...
+
+    @abstractmethod
+    def save(self, user_id: UUID, history: list[list[str]], context: Optional[dict[str, Any]]) -> int:
+        """
+        Saves the chat turns and, unless it is None, the user context; the stored context is kept otherwise.
+        Returns the new version of the session.
+        """
+
+    @abstractmethod
+    def delete(self, user_id: UUID) -> None:
+        ...
+
+    @abstractmethod
+    def save_job(self, job_id: str, stage: int, job: dict[str, Any], ttl: float) -> None:
+        """
+        Publishes the status of a background job for ttl seconds, so any worker can answer a poll for it.
+        A save with a lower stage than the stored one is ignored, so a late 'queued' never hides its result.
+        """
+
+    @abstractmethod
+    def load_job(self, job_id: str) -> Optional[dict[str, Any]]:
+        ...
+
+
+class SQLiteSessionStateStore(SessionStateStore):
+    """
+    Session states in a SQLite file, shared by the workers of one host.
+    """
+    blocking = True
+    # expired sessions and jobs are purged once every this many saves
+    _PURGE_EVERY = 1000
+
+    def __init__(self, path: str = SESSION_STATE_PATH, ttl: float = SESSION_STATE_TTL):
+        self._ttl = ttl
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._saves = 0
+        with self._lock:
+            # WAL lets the other workers read while one of them writes
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS session_state ("
+                " user_id TEXT PRIMARY KEY,"
+                " version INTEGER NOT NULL,"
+                " history TEXT NOT NULL,"
+                " context TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS job_state ("
+                " job_id TEXT PRIMARY KEY,"
+                " stage INTEGER NOT NULL,"
+                " job TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+
+    def version(self, user_id: UUID) -> Optional[int]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version FROM session_state WHERE user_id = ? AND updated_at >= ?",
+                (str(user_id), time.time() - self._ttl)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def load(self, user_id: UUID) -> Optional[SessionState]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT version, history, context FROM session_state WHERE user_id = ? AND updated_at >= ?",
+                (str(user_id), time.time() - self._ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        return SessionState(version=row[0], history=json.loads(row[1]), context=json.loads(row[2]))
+
+    def save(self, user_id: UUID, history: list[list[str]], context: Optional[dict[str, Any]]) -> int:
+        history_json = json.dumps(history)
+        with self._lock:
+            if context is None:
+                row = self._connection.execute(
+                    "UPDATE session_state SET version = version + 1, history = ?, updated_at = ? "
+                    "WHERE user_id = ? RETURNING version",
+                    (history_json, time.time(), str(user_id))
+                ).fetchone()
+                if row is None:
+                    raise ValueError("The user context must be saved with the first save of a session")
+            else:
+                row = self._connection.execute(
+                    "INSERT INTO session_state (user_id, version, history, context, updated_at) VALUES (?, 1, ?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET version = version + 1, history = excluded.history, "
+                    "context = excluded.context, updated_at = excluded.updated_at RETURNING version",
+                    (str(user_id), history_json, json.dumps(context), time.time())
+                ).fetchone()
+            self._saves += 1
+            self._purge()
+        return row[0]
+
+    def delete(self, user_id: UUID) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM session_state WHERE user_id = ?", (str(user_id),))
+
+    def save_job(self, job_id: str, stage: int, job: dict[str, Any], ttl: float) -> None:
+        job_json = json.dumps(job)
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO job_state (job_id, stage, job, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (job_id) DO UPDATE SET stage = excluded.stage, job = excluded.job, "
+                "expires_at = excluded.expires_at WHERE excluded.stage >= job_state.stage",
+                (job_id, stage, job_json, time.time() + ttl)
+            )
+            self._saves += 1
+            self._purge()
+
+    def load_job(self, job_id: str) -> Optional[dict[str, Any]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT job FROM job_state WHERE job_id = ? AND expires_at >= ?", (job_id, time.time())
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _purge(self) -> None:
+        # called with the lock held, after counting a save
+        if self._saves % self._PURGE_EVERY == 0:
+            now = time.time()
+            self._connection.execute("DELETE FROM session_state WHERE updated_at < ?", (now - self._ttl,))
+            self._connection.execute("DELETE FROM job_state WHERE expires_at < ?", (now,))
+
+
+def create_state_store(backend: str = SESSION_STATE_BACKEND) -> Optional[SessionStateStore]:
+    """
+    The session state store selected by SESSION_STATE_BACKEND ('memory' or 'sqlite').
+    With 'memory' there is none: a second copy of every session in the same process would only
+    double the memory the bounded session store saves, so a session evicted from it is rebuilt
+    from the symptom history, and jobs are polled from the worker that accepted them.
+    """
+    if backend == "memory":
+        return None
+    if backend == "sqlite":
+        return SQLiteSessionStateStore()
+    raise ValueError(f"Unknown session state backend {backend!r}, expected 'memory' or 'sqlite'")
@@ -1,62 +1,210 @@
-from llm.llm_manager import LLMManager
-from db.db import Database
+import asyncio
+import time
+
+from llm.llm_manager import LLMManager, timed
+from llm.user_context import UserContext, format_patient_background
+from db.db import AsyncDatabase
+from telemetry.tracing import traced
+from user.state_store import SessionState
+from typing import Any, AsyncIterator, Awaitable, Optional
 from uuid import UUID
 from datetime import datetime as dt, UTC
 END_REPORT_TOKEN = "<END_REPORT>"
 
+
+class EndTokenFilter:
+    """
+    Detects END_REPORT_TOKEN in a response that arrives in chunks.
+    Text that could be the beginning of the token is held back until the next chunk
+    shows whether it is, so the token never leaks to the client split across chunks.
+    """
+    def __init__(self, token: str = END_REPORT_TOKEN):
+        self.token = token
+        self.stopped = False
+        self._pending = ""
+
+    def feed(self, chunk: str) -> str:
+        """
+        Returns the part of chunk that is safe to forward.
+        Everything from the token onwards is dropped.
+        """
+        if self.stopped:
+            return ""
+        text = self._pending + chunk
+        index = text.find(self.token)
+        if index != -1:
+            self.stopped = True
+            self._pending = ""
+            return text[:index]
+        held = self._partial_token_length(text)
+        self._pending = text[len(text) - held:] if held else ""
+        return text[:len(text) - held]
+
+    def flush(self) -> str:
+        """
+        Returns the held back text once the stream has ended.
+        """
+        text, self._pending = self._pending, ""
+        return text
+
+    def _partial_token_length(self, text: str) -> int:
+        # length of the longest suffix of text that is a proper prefix of the token
+        for length in range(min(len(self.token) - 1, len(text)), 0, -1):
+            if text.endswith(self.token[:length]):
+                return length
+        return 0
+
+
 # format 
 class User:
-    def __init__(self, database: Database, user_id: UUID = None):
-        # initialize context load from database
+    def __init__(self, database: AsyncDatabase, user_id: UUID, user_context: list[dict[str, Any]]):
+        """
+        A patient session over the given symptom history; use create to load it from the database.
+        """
         self.database = database
-        user_context = database.get_symptoms_for_patient(user_id)
-        self.llm = LLMManager(user_context=user_context, end_text=END_REPORT_TOKEN)
         self.user_id = user_id
-        # initialize context load from database
+        # version of the saved session state this object is at, and of the user context it saved last
+        self.state_version: Optional[int] = None
+        self.saved_context_version: Optional[int] = None
+        self.llm = LLMManager(user_context=user_context, end_text=END_REPORT_TOKEN, cache_tag=str(user_id))
+
+    @classmethod
+    @traced("user.create")
+    async def create(cls, database: AsyncDatabase, user_id: UUID) -> "User":
+        """
+        Builds a User from the patient's symptom history in the database.
+        The context is not compacted here, see compact_context.
+        """
+        user_context = await database.get_symptoms_for_patient(user_id)
+        return cls(database=database, user_id=user_id, user_context=user_context)
+
+    @classmethod
+    def from_state(cls, database: AsyncDatabase, user_id: UUID, state: SessionState) -> "User":
+        """
+        Resumes a session saved by a SessionStore, possibly in another worker, without touching the database.
+        """
+        user = cls(database=database, user_id=user_id, user_context=[])
+        user.llm.restore_state(state.history, UserContext.from_state(state.context))
+        user.llm.summarized_turns = state.context.get("summarized_turns", 0)
+        user.state_version = state.version
+        user.saved_context_version = state.context["version"]
+        return user
+
+    @traced("user.compact_context")
+    async def compact_context(self) -> None:
+        """
+        Folds the oldest symptom entries into period digests when the history exceeds the llm token
+        budget, run as a background job once the session is loaded. Digests are stored so later sessions
+        reuse them. A chat under way keeps its turns and continues on the compacted context.
+        On failure the session keeps the full history.
+        """
+        if not self.llm.needs_compaction():
+            return
+        try:
+            new_digests = await self.llm.compact_context(await self.database.get_digests_for_patient(self.user_id))
+            if new_digests:
+                await self.database.add_digests(self.user_id, new_digests)
+        except Exception as e:
+            print(f"Context compaction failed, using the full history: {e}")
 
-    def get_response(self, prompt: str) -> tuple[str, bool]:
-        response = self.llm.get_response(prompt)
-        stop_flag = False
+    @staticmethod
+    def _split_stop_token(response: str) -> tuple[str, bool]:
         if END_REPORT_TOKEN in response:
-            stop_flag = True
-            response = response.split(END_REPORT_TOKEN)[0]
-        return response, stop_flag
-    
-    def get_summary(self):
-        return self.llm.get_summary()
+            return response.split(END_REPORT_TOKEN)[0], True
+        return response, False
+
+    async def get_response(self, prompt: str) -> tuple[str, bool]:
+        return self._split_stop_token(await self.llm.get_response(prompt))
+
+    async def stream_response(self, prompt: str) -> AsyncIterator[tuple[str, dict]]:
+        """
+        Streams the response to prompt as ('chunk', {'answer': text}) events,
+        followed by a single ('end', {'stop': stop_flag}) event.
+        """
+        end_filter = EndTokenFilter()
+        async for chunk in self.llm.stream_response(prompt):
+            # keep consuming after the token so the exchange lands in the chat history
+            text = end_filter.feed(chunk)
+            if text:
+                yield "chunk", {"answer": text}
+        text = end_filter.flush()
+        if text:
+            yield "chunk", {"answer": text}
+        yield "end", {"stop": end_filter.stopped}
     
-    def save_summary_and_update(self) -> None:
+    @traced("user.save_summary")
+    async def save_summary_and_update(self) -> None:
+        '''
+        Summarizes the conversation into the user context and stores the summary in the database.
+        Does nothing if there is no new chat turn since the last summary.
+        '''
+        insert = await self._summarize_and_extend()
+        if insert is not None:
+            await insert
+
+    async def _summarize_and_extend(self, timings: Optional[dict[str, float]] = None) -> Optional[Awaitable[dict]]:
         '''
-        This function updates the database, asks it for a new 
-        report, and updates the llm with the updated user context. 
+        Summarizes the current conversation into the llm user context and returns the
+        (not yet awaited) database insert of the summary, or None if there was nothing new.
         '''
         try:
-            summary = self.get_summary()
-        except ValueError as e:
-            # if the summary is None, it means that there were no new prompts
-            # since the last conversation, so we don't need to update the database
-            return
-        
-        
-        summary["timestamp"] = dt.now(UTC).isoformat()
+            summary = await self.llm.get_summary(timings)
+        except ValueError:
+            return None
+        timestamp = await self._add_summary_to_context(summary)
+        return self.database.add_symptom(timestamp=timestamp,
+                                         patient_id=self.user_id,
+                                         symptom_summary=summary["summary"],
+                                         title=summary["title"])
+
+    async def _add_summary_to_context(self, summary: dict[str, str]) -> dt:
+        timestamp = dt.now(UTC)
+        summary["timestamp"] = timestamp.isoformat()
         # update llm user context to include new summary
-        self.llm.extend_user_context([summary])
-
-        # add the user_id to the summary
-        summary["patient_id"] = self.user_id
-        # add the summary to the database
-        self.database.add_symptom(timestamp=dt.fromisoformat(summary["timestamp"]), 
-                                  patient_id=self.user_id, 
-                                  symptom_summary=summary["summary"], 
-                                  title=summary["title"] )
-
-    def get_doctor_report(self, reason_for_visit): 
-        """
-        Makes sure that the user context in the LLM chat is updated
-        and creates a doctors report from it.
-        """
-        # update the user context in the LLM
-        self.save_summary_and_update()
-        # get the doctor report from the LLM
-        return self.llm.get_doctor_report(reason_for_visit)
-    
\ No newline at end of file
+        await self.llm.extend_user_context([summary])
+        return timestamp
+
+    @traced("user.doctor_report")
+    async def get_doctor_report(self, reason_for_visit):
+        """
+        Makes sure the user context includes the current conversation and creates a doctor's report
+        from it, run as a dependency graph:
+        the reason title only needs the visit reason, so it starts right away;
+        the patient's chronic background is fetched alongside;
+        the HPI waits for the conversation summary to reach the user context;
+        the summary's database insert runs in the background while the report is generated.
+        In structured output mode the reason is part of the single report generation, so it is not started early.
+        The returned report carries per-stage durations in seconds under 'timings'.
+        """
+        timings: dict[str, float] = {}
+        start = time.perf_counter()
+        reason = None
+        if not self.llm.structured_output:
+            reason = asyncio.ensure_future(timed(timings, "reason", self.llm.get_report_reason(reason_for_visit)))
+        background = asyncio.ensure_future(timed(timings, "background", self._get_background()))
+        insert = None
+        try:
+            pending_insert = await self._summarize_and_extend(timings)
+            if pending_insert is not None:
+                insert = asyncio.ensure_future(timed(timings, "save_summary", pending_insert))
+            report = await self.llm.get_doctor_report(reason_for_visit, reason=reason, timings=timings,
+                                                      background=await background)
+            if insert is not None:
+                await insert
+        finally:
+            for task in (reason, background, insert):
+                if task is not None and not task.done():
+                    task.cancel()
+        timings["total"] = round(time.perf_counter() - start, 3)
+        report["timings"] = timings
+        return report
+
+    async def _get_background(self) -> Optional[str]:
+        """
+        The patient's chronic conditions and medications for the doctor report, if any.
+        """
+        try:
+            return format_patient_background(await self.database.get_patient(patient_id=self.user_id))
+        except Exception as e:
+            print(f"Error fetching patient background: {e}")
+            return None
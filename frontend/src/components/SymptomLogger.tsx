@@ -1,7 +1,7 @@
 
 import React, { useState, useEffect, useRef } from 'react';
 import { type ChatMessage } from '../types';
-import { sendMessageInChat } from '../services/apiService';
+import { streamMessageInChat } from '../services/apiService';
 // Fix: Import Edit3Icon
 import { SendIcon, RotateCwIcon, SaveIcon, AlertCircleIcon, MessageSquareIcon, UserIcon, ZapIcon, Edit3Icon, InfoIcon } from 'lucide-react';
 import { LoadingSpinner } from './LoadingSpinner';
@@ -39,6 +39,17 @@ export const SymptomLogger: React.FC = () => {
     chatMessagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   }, [conversation]);
 
+  // answers are streamed: the first chunk adds the AI message, the next ones extend it
+  const appendAnswerChunk = (text: string) => {
+    setConversation(prev => {
+      const last = prev[prev.length - 1];
+      if (last && last.sender === 'ai') {
+        return [...prev.slice(0, -1), { ...last, text: last.text + text }];
+      }
+      return [...prev, { sender: 'ai', text, timestamp: new Date() }];
+    });
+  };
+
   const handleStartSymptomAnalysis = async () => {
     if (!initialSymptom.trim()) {
       setError("Please describe your main symptom first.");
@@ -53,8 +64,7 @@ export const SymptomLogger: React.FC = () => {
       const userMessage: ChatMessage = { sender: 'user', text: initialSymptom, timestamp: new Date() };
       setConversation([userMessage]);
       
-      const aiResponseText = await sendMessageInChat(MY_UUID, initialSymptom);
-      setConversation(prev => [...prev, { sender: 'ai', text: aiResponseText.answer, timestamp: new Date() }]);
+      await streamMessageInChat(MY_UUID, initialSymptom, appendAnswerChunk);
       aiTurnCountRef.current++;
     } catch (err) {
       console.error(err);
@@ -75,13 +85,12 @@ export const SymptomLogger: React.FC = () => {
     setCurrentUserMessage('');
 
     try {
-      const aiResponseResponse = await sendMessageInChat(MY_UUID, userMessage.text);
-      if (aiResponseResponse.stop) {
+      const stop = await streamMessageInChat(MY_UUID, userMessage.text, appendAnswerChunk);
+      if (stop) {
         // Optionally, can add a "final thoughts" AI message or directly enable saving
         setConversation(prev => [...prev, {sender: 'ai', text: "Thank you for the information. You can now save this entry.", timestamp: new Date()}]);
         setStage(LoggingStage.Saving);
       } else {
-          setConversation(prev => [...prev, { sender: 'ai', text: aiResponseResponse.answer, timestamp: new Date() }]);
           aiTurnCountRef.current++;
       }
     } catch (err) {
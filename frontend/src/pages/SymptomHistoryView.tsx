@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { getSymptomHistory } from '../services/apiService';
 import { type SymptomResponse } from '../types.ts';
 
@@ -6,11 +6,45 @@ import { type SymptomResponse } from '../types.ts';
 const SymptomHistoryView: React.FC<{isSelected: boolean}> = ({isSelected}) => {
 
   const [symptomEntries, setSymptomEntries] = useState<SymptomResponse[]>([]);
+  // cursor of the older entries not loaded yet, null once the oldest page is loaded
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const latest = useRef<string | null>(null);
   
+  const loadNewest = () => {
+    getSymptomHistory(`${process.env.UUID}`).then(page => {
+      latest.current = page.latest;
+      setSymptomEntries(page.entries);
+      setNextCursor(page.nextCursor);
+    });
+  };
+
   useEffect(() => {
-    getSymptomHistory(`${process.env.UUID}`).then(entries => setSymptomEntries(entries));
+    if (latest.current === null) {
+      loadNewest();
+      return;
+    }
+    // entries are newest first, only fetch the ones added since the last visit
+    getSymptomHistory(`${process.env.UUID}`, latest.current).then(history => {
+      if (history.nextCursor !== null) {
+        // more new entries than fit a page: start over from the newest page
+        loadNewest();
+        return;
+      }
+      latest.current = history.latest;
+      setSymptomEntries(entries => [...history.entries, ...entries]);
+    });
   }, [isSelected]);
 
+  const loadMore = () => {
+    if (!nextCursor || loadingMore) return;
+    setLoadingMore(true);
+    getSymptomHistory(`${process.env.UUID}`, null, nextCursor).then(page => {
+      setSymptomEntries(entries => [...entries, ...page.entries]);
+      setNextCursor(page.nextCursor);
+    }).finally(() => setLoadingMore(false));
+  };
+
 if (symptomEntries.length === 0) {
     return <div className="text-center text-slate-500 py-10">No symptom entries logged yet.</div>;
   }
@@ -18,7 +52,7 @@ if (symptomEntries.length === 0) {
   return (
     <div className="space-y-6">
       <h2 className="text-2xl font-semibold text-indigo-700 mb-6 border-b pb-2">Symptom History</h2>
-      {symptomEntries.slice().reverse().map((entry, index) => (
+      {symptomEntries.map((entry, index) => (
         <div
           key={index}
           className="bg-white border border-slate-200 rounded-2xl p-6 shadow-sm hover:shadow-md transition-shadow"
@@ -45,6 +79,16 @@ if (symptomEntries.length === 0) {
           </details>
         </div>
       ))}
+      {nextCursor && (
+        <button
+          type="button"
+          onClick={loadMore}
+          disabled={loadingMore}
+          className="w-full py-3 px-4 rounded-lg bg-white hover:bg-slate-50 text-indigo-600 font-medium border border-slate-300 shadow-sm transition-colors disabled:opacity-50"
+        >
+          {loadingMore ? 'Loading...' : 'Load more'}
+        </button>
+      )}
     </div>
   );
 };
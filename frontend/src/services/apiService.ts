@@ -1,5 +1,5 @@
 import axios from 'axios';
-import type { ChatResponse, DoctorReport, SymptomResponse } from '../types.ts';
+import type { ChatResponse, DoctorReport, Job, SymptomHistory, SymptomHistoryPage } from '../types.ts';
 
 export const checkPatientExists = async (email: string): Promise<boolean> => {
   const url = `${process.env.API_BASE}/is_existing_patient/${email}`;
@@ -43,12 +43,43 @@ export const sendMessageInChat = async (id: string, message: string): Promise<Ch
   }
 };
 
+export const streamMessageInChat = (id: string, message: string, onChunk: (text: string) => void): Promise<boolean> => {
+  const url = `${process.env.API_BASE}/response_stream/${id}?prompt=${encodeURIComponent(message)}`;
+  return new Promise((resolve, reject) => {
+    const source = new EventSource(url);
+    source.addEventListener('chunk', (event) => {
+      onChunk(JSON.parse((event as MessageEvent).data).answer);
+    });
+    source.addEventListener('end', (event) => {
+      source.close();
+      resolve(JSON.parse((event as MessageEvent).data).stop);
+    });
+    source.addEventListener('error', (event) => {
+      source.close();
+      const detail = event instanceof MessageEvent ? JSON.parse(event.data).detail : "Connection lost";
+      reject(new Error("Failed to stream message in chat: " + detail));
+    });
+  });
+};
+
+// summaries and reports run as background jobs: the request returns a job id, polled until the job is finished
+const waitForJob = async <T>(job: Job<T>): Promise<T> => {
+  while (job.status === 'queued' || job.status === 'running') {
+    const res = await axios.get<Job<T>>(`${process.env.API_BASE}/jobs/${job.job_id}?wait=25`, {headers: {'Accept': 'application/json'}});
+    job = res.data;
+  }
+  if (job.status === 'failed') {
+    throw new Error(job.error ?? "Job failed");
+  }
+  return job.result as T;
+};
+
 export const generateDoctorReport = async (id: string, reasonForVisit: string): Promise<DoctorReport> => {
   const url = `${process.env.API_BASE}/doctor_report/${id}?prompt=${encodeURIComponent(reasonForVisit)}`;
   try {
-    const res = await axios.get<DoctorReport>(url, {headers: {'Accept': 'application/json'}});
+    const res = await axios.post<Job<DoctorReport>>(url, null, {headers: {'Accept': 'application/json'}});
     if (res.status >= 200 && res.status < 300) {
-        return res.data;
+        return await waitForJob(res.data);
     } else {
       throw new Error(`Request failed with status: ${res.status}`);
     }
@@ -75,30 +106,40 @@ export const hasSymptomHistory = async (id: string): Promise<boolean> => {
 export const saveSymptom = async (id: string) => {
   const url = `${process.env.API_BASE}/save_summary/${id}`;
   try {
-    const res = await axios.post<{status: string}>(url, {headers: {'Accept': 'application/json'}});
+    const res = await axios.post<Job<{status: string}>>(url, {headers: {'Accept': 'application/json'}});
     if (res.status < 200 && res.status >= 300) {
       throw new Error(`Request failed with status: ${res.status}`);
     }
+    await waitForJob(res.data);
   } catch (error) {
     throw new Error("Failed to check symptom history: " + (error instanceof Error ? error.message : "Unknown error"));
   }
 };
 
-export const getSymptomHistory = async (id: string): Promise<SymptomResponse[]> => {
+// one page of the history, newest first; with since, only the entries added after it,
+// with cursor, the page after the one that returned it
+export const getSymptomHistory = async (id: string, since: string | null = null,
+                                        cursor: string | null = null): Promise<SymptomHistory> => {
   const url = `${process.env.API_BASE}/get_history/${id}`;
+  const params: Record<string, string> = {};
+  if (since) params.since = since;
+  if (cursor) params.cursor = cursor;
   try {
-    const res = await axios.get<SymptomResponse[]>(url, {headers: {'Accept': 'application/json'}});
-    if (res.status >= 200 && res.status < 300) {
-      return res.data.map(entry => ({
+    const res = await axios.get<SymptomHistoryPage>(url, {params, headers: {'Accept': 'application/json'}});
+    if (res.status < 200 || res.status >= 300) {
+      throw new Error(`Request failed with status: ${res.status}`);
+    }
+    return {
+      entries: res.data.entries.map(entry => ({
         'timestamp': new Date(entry.timestamp),
         'title': entry.title,
         'summary': entry.summary
-      }));
-    } else {
-      throw new Error(`Request failed with status: ${res.status}`);
-    }
+      })),
+      latest: !cursor && res.data.entries.length > 0 ? res.data.entries[0].timestamp : since,
+      nextCursor: res.data.next_cursor
+    };
   } catch (error) {
-    console.error("Error sending message to Gemini chat:", error);
-    throw new Error("Failed to generate doctor report: " + (error instanceof Error ? error.message : "Unknown error"));
+    console.error("Error fetching symptom history:", error);
+    throw new Error("Failed to fetch symptom history: " + (error instanceof Error ? error.message : "Unknown error"));
   }
-};
\ No newline at end of file
+};
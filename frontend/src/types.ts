@@ -16,8 +16,29 @@ export interface DoctorReport {
   impression: string;
 }
 
+export interface Job<T> {
+  job_id: string;
+  kind: string;
+  status: 'queued' | 'running' | 'done' | 'failed';
+  result?: T;
+  error?: string;
+}
+
 export interface SymptomResponse {
   timestamp: Date;
   title: string;
   summary: string[];
-}
\ No newline at end of file
+}
+
+export interface SymptomHistoryPage {
+  entries: (Omit<SymptomResponse, 'timestamp'> & { timestamp: string })[];
+  next_cursor: string | null;
+}
+
+export interface SymptomHistory {
+  entries: SymptomResponse[];
+  // server timestamp of the newest entry, to ask only for newer ones next time
+  latest: string | null;
+  // cursor of the next, older page; null on the last page
+  nextCursor: string | null;
+}